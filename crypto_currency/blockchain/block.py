@@ -1,25 +1,50 @@
-import json
-from typing import Dict, List
+from typing import Callable, Dict, List
 
-from Crypto.Hash import SHA256
+from blockchain.encoding import Encodable, digest, encode
+from blockchain.merkle import merkle_proof, merkle_root
+from blockchain.transaction import Transaction, share
 
-from blockchain.transaction import Transaction
+# Version 1 blocks hash the whole block as JSON. Version 2 blocks hash a
+# header holding the merkle root of the transactions instead
+BLOCK_VERSION = 1
+MERKLE_VERSION = 2
+VERSIONS = [BLOCK_VERSION, MERKLE_VERSION]
 
 
-class Block():
+class Block(Encodable):
+    FIELDS = frozenset(["parent_block", "timestamp", "transactions", "hash",
+                        "nonce", "coinbase", "mined", "version",
+                        "merkle_root"])
+    __slots__ = ("version", "parent_block", "timestamp", "transactions",
+                 "merkle_root", "mined", "hash", "nonce", "coinbase",
+                 "valid")
+
     def __init__(self, parent_block: str, timestamp: int, transactions: List,
                  block_hash: str = False, nonce: int = False,
-                 coinbase: str = False) -> None:
+                 coinbase: str = False, verify: bool = True,
+                 version: int = BLOCK_VERSION) -> None:
+        if version not in VERSIONS:
+            raise ValueError(f"Unknown block version {version}")
+        self.version = version
         self.parent_block = parent_block
         self.timestamp = timestamp
-        self.transactions = [Transaction(*x[:5], signature=x[5],
-                                         nonce=x[6]) for x in transactions]
-        self.mined = True if block_hash and nonce and coinbase else False
+        # Transaction objects are kept as they are so their encodings are
+        # reused
+        self.transactions = [x if isinstance(x, Transaction) else
+                             Transaction(*x) for x in transactions]
+        self.merkle_root = None
+        if version >= MERKLE_VERSION:
+            self.merkle_root = merkle_root([tran.digest
+                                            for tran in self.transactions])
+        # A nonce of 0 is valid so it is compared with the default itself
+        self.mined = bool(block_hash and nonce is not False and coinbase)
         if self.mined:
             self.hash = block_hash
             self.nonce = nonce
-            self.coinbase = coinbase
-        self.valid = self.verify()
+            self.coinbase = share(coinbase)
+        # Blocks read back from the database were checked when they were
+        # added so loading them can skip the signature checks
+        self.valid = self.verify() if verify else None
 
     def verify(self) -> bool:
         """Verfies all components of the block including transactions and block hash
@@ -29,10 +54,8 @@ class Block():
             if not transaction.valid:
                 return False, "Invalid transaction signature"
         if self.mined:
-            block_dict = dict(self)
-            block_dict.pop("hash")
-            json_str = json.dumps(block_dict, sort_keys=True)
-            block_hash = SHA256.new(json_str.encode("UTF-8")).hexdigest()
+            block_hash = self.cached("digest",
+                                     lambda: digest(self.header()))
             if block_hash == self.hash:
                 return True
             else:
@@ -40,6 +63,46 @@ class Block():
         else:
             return True
 
+    def header(self) -> Dict:
+        """Returns what the block hash is taken over, the whole block without
+        its hash for version 1 and everything but the transactions for
+        version 2
+
+        :return: Dict the hash is computed from
+        :rtype: Dict
+        """
+        block_dict = dict(self)
+        block_dict.pop("hash", None)
+        if self.version >= MERKLE_VERSION:
+            block_dict.pop("transactions")
+        return block_dict
+
+    @property
+    def encoded(self) -> bytes:
+        """Returns the canonical bytes of the whole block in dict form
+
+        :return: Encoded block
+        :rtype: bytes
+        """
+        return self.cached("encoded", lambda: encode(dict(self)))
+
+    def proof(self, digest: str) -> List[List[str]]:
+        """Returns a merkle proof that a transaction is in the block
+
+        :param digest: Digest of the transaction
+        :type digest: str
+        :raises ValueError: Raised if the block has no merkle root or the
+        transaction isn't in it
+        :return: Proof that can be checked with merkle.verify_proof
+        :rtype: List[List[str]]
+        """
+        if self.version < MERKLE_VERSION:
+            raise ValueError("Block has no merkle root")
+        digests = [tran.digest for tran in self.transactions]
+        if digest not in digests:
+            raise ValueError("Transaction isn't in the block")
+        return merkle_proof(digests, digests.index(digest))
+
     def christen(self, block_hash: str, nonce: int, miner_addr: str) -> bool:
         """Adds hash, nonce and coinbase to block then checks that they are valid
 
@@ -53,7 +116,7 @@ class Block():
         """
         self.hash = block_hash
         self.nonce = nonce
-        self.coinbase = miner_addr
+        self.coinbase = share(miner_addr)
         self.mined = True
         validity = self.verify()
         if not validity:
@@ -70,6 +133,9 @@ class Block():
         :rtype: Dict
         """
         default_attrs = ["parent_block", "timestamp", "transactions"]
+        # Version 1 blocks keep their original form so their hashes hold
+        if self.version >= MERKLE_VERSION:
+            default_attrs += ["version", "merkle_root"]
         if self.mined:
             default_attrs += ["hash", "nonce", "coinbase"]
         for attr in default_attrs:
@@ -80,3 +146,94 @@ class Block():
                 yield (attr, trans)
             else:
                 yield (attr, getattr(self, attr))
+
+
+class BlockHeader():
+    __slots__ = ("hash", "parent_block", "timestamp", "nonce", "coinbase",
+                 "height", "tx_count", "version", "merkle_root", "loader",
+                 "rows")
+
+    def __init__(self, block_hash: str, parent_block: str, timestamp: int,
+                 nonce: int, coinbase: str, height: int, tx_count: int,
+                 version: int = BLOCK_VERSION, merkle_root: str = None,
+                 loader: Callable = None) -> None:
+        """Everything about a stored block but its transactions, which are
+        only read the first time they are asked for
+
+        :param block_hash: Hash of the block
+        :type block_hash: str
+        :param parent_block: Hash of the parent block
+        :type parent_block: str
+        :param timestamp: Time the block was made
+        :type timestamp: int
+        :param nonce: Nonce of the block
+        :type nonce: int
+        :param coinbase: Address of the miner
+        :type coinbase: str
+        :param height: Height of the block, the genesis block is height 0
+        :type height: int
+        :param tx_count: Number of transactions in the block
+        :type tx_count: int
+        :param version: Block format version, defaults to BLOCK_VERSION
+        :type version: int, optional
+        :param merkle_root: Merkle root of the transactions for version 2
+        blocks, defaults to None
+        :type merkle_root: str, optional
+        :param loader: Function returning the transactions in tuple form,
+        defaults to None
+        :type loader: Callable, optional
+        """
+        self.hash = block_hash
+        self.parent_block = parent_block
+        self.timestamp = timestamp
+        self.nonce = nonce
+        self.coinbase = share(coinbase)
+        self.height = height
+        self.tx_count = tx_count
+        self.version = version
+        self.merkle_root = merkle_root
+        self.loader = loader
+        self.rows = None
+
+    def transaction_tuples(self) -> List:
+        """Returns the transactions in tuple form, loading them if needed
+
+        :return: List of transaction tuples
+        :rtype: List
+        """
+        if self.rows is None:
+            self.rows = self.loader() if self.loader is not None else []
+        return self.rows
+
+    @property
+    def transactions(self) -> List[Transaction]:
+        """Returns the transactions without checking their signatures
+
+        :return: List of Transaction objects
+        :rtype: List[Transaction]
+        """
+        return [Transaction(*x) for x in self.transaction_tuples()]
+
+    def block(self, verify: bool = False) -> Block:
+        """Returns the full block with its transactions
+
+        :param verify: Whether to check the signatures and hash, defaults to
+        False
+        :type verify: bool, optional
+        :return: The block
+        :rtype: Block
+        """
+        return Block(self.parent_block, self.timestamp,
+                     self.transaction_tuples(), self.hash, self.nonce,
+                     self.coinbase, verify=verify, version=self.version)
+
+    def __iter__(self) -> Dict:
+        """Returns the header in dict form
+
+        :return: Dict containing header data
+        :rtype: Dict
+        """
+        for attr in ["hash", "parent_block", "timestamp", "nonce",
+                     "coinbase", "height", "tx_count", "version",
+                     "merkle_root"]:
+            yield (attr, getattr(self, attr))
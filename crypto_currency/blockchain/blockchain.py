@@ -1,58 +1,454 @@
 import json
 import sqlite3
+from functools import lru_cache
 from statistics import mean
-from typing import Dict, List
+from typing import Dict, List, NamedTuple
 
 from Crypto.PublicKey import RSA
 
-from blockchain.block import Block
+from blockchain.block import MERKLE_VERSION, Block, BlockHeader
+from blockchain.encoding import encode
+from blockchain.mempool import Mempool
+from blockchain.storage import Storage, writes
+from blockchain.transaction import Transaction
+from blockchain.validation import build_block
+
+COINBASE_REWARD = 10
+
+
+class ChainTip(NamedTuple):
+    hash: str
+    height: int
+    work: int
+
+
+def block_work(block_hash: str) -> int:
+    """Returns the expected number of hashes needed to find a block hash with
+    as many leading zeros as the one given
+
+    :param block_hash: Hash of the block
+    :type block_hash: str
+    :return: Work represented by the block
+    :rtype: int
+    """
+    zeros = len(block_hash) - len(block_hash.lstrip("0"))
+    return 16 ** zeros
+
+
+@lru_cache(maxsize=4096)
+def account_key(public_key: str) -> str:
+    """Converts a public key in hex to the DER hex form accounts are stored
+    under
+
+    :param public_key: Public key in hex
+    :type public_key: str
+    :return: DER encoded public key in hex
+    :rtype: str
+    """
+    return RSA.import_key(bytes.fromhex(public_key)).export_key("DER").hex()
 
 
 class Blockchain():
-    def __init__(self, log_func, db="blockchain.db") -> None:
-        self.conn = sqlite3.connect(db)
-        self.cur = self.conn.cursor()
-        self.verify_db()
+    def __init__(self, log_func, db="blockchain.db",
+                 mempool_size=50000) -> None:
+        """Opens the blockchain, a Storage can be passed instead of a path to
+        share connections with the rest of the node
+
+        :param log_func: Function used for logging
+        :type log_func: Callable
+        :param db: Path to the database or Storage, defaults to
+        "blockchain.db"
+        :type db: Any, optional
+        :param mempool_size: Maximum transactions held in the mempool,
+        defaults to 50000
+        :type mempool_size: int, optional
+        """
+        self.storage = db if isinstance(db, Storage) else Storage(db)
+        self.mempool = Mempool(mempool_size)
+        self.tip_listeners = []
         self.log = log_func
+        self.verify_db()
+        self.storage.tip = self.load_tip()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return self.storage.conn
+
+    @property
+    def cur(self) -> sqlite3.Cursor:
+        return self.storage.cur
 
+    @writes
     def verify_db(self) -> None:
-        """If tables do not exist in DB they will be created
+        """If tables do not exist in DB they will be created and databases
+        made by older versions are migrated to the current schema
+        """
+        self.cur.execute("PRAGMA user_version;")
+        version = self.cur.fetchone()[0]
+        if version == 0:
+            version = self.legacy_version()
+        migrations = [self.create_tables, self.create_balances,
+                      self.create_keys, self.create_heights,
+                      self.create_side_chains, self.create_tx_counts,
+                      self.create_versions]
+        for number, migration in enumerate(migrations[version:],
+                                           start=version+1):
+            self.cur.execute("BEGIN;")
+            try:
+                migration()
+                self.cur.execute(f"PRAGMA user_version = {number};")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            if version != 0:
+                self.log("blockchain.py", "INFO",
+                         f"Migrated database to schema version {number}")
+
+    def legacy_version(self) -> int:
+        """Works out the schema version of a database made before the version
+        was recorded
+
+        :return: Schema version of the database
+        :rtype: int
         """
         self.cur.execute("""SELECT name FROM sqlite_master WHERE type='table'
-                            AND name='transactions' OR name='blocks'
-                            OR name='mempool';""")
-        if not (len(self.cur.fetchall()) == 3):
-            self.cur.execute("""CREATE TABLE blocks (hash VARCHAR(64),
-                                nonce INT, coinbase VARCHAR(2000),
-                                parent_block VARCHAR(64), timestamp INT);""")
-            self.cur.execute("""CREATE TABLE transactions (sender VARCHAR(2000),
-                             receiver VARCHAR(2000), value INT,
-                             data VARCHAR(256), fee INT,
-                             signature VARCHAR(512), nonce INT,
-                             parent_block VARCHAR(64));""")
-            self.cur.execute("""CREATE TABLE mempool
-                             (tran VARCHAR(10));""")
-            self.conn.commit()
-
-    def get_block(self, block_hash: str) -> Block:
-        """Returns a Block object of the desired block containing all it's data
+                            AND name IN ('blocks', 'balances');""")
+        tables = [i[0] for i in self.cur.fetchall()]
+        if "balances" in tables:
+            return 2
+        elif "blocks" in tables:
+            return 1
+        return 0
+
+    def create_tables(self) -> None:
+        """Schema version 1, creates the original tables
+        """
+        self.cur.execute("""CREATE TABLE blocks (hash VARCHAR(64),
+                            nonce INT, coinbase VARCHAR(2000),
+                            parent_block VARCHAR(64), timestamp INT);""")
+        self.cur.execute("""CREATE TABLE transactions (sender VARCHAR(2000),
+                         receiver VARCHAR(2000), value INT,
+                         data VARCHAR(256), fee INT,
+                         signature VARCHAR(512), nonce INT,
+                         parent_block VARCHAR(64));""")
+        self.cur.execute("""CREATE TABLE mempool
+                         (tran VARCHAR(10));""")
+
+    def create_balances(self) -> None:
+        """Schema version 2, adds the balances table
+        """
+        self.cur.execute("""CREATE TABLE balances
+                         (account VARCHAR(2000) PRIMARY KEY,
+                         balance REAL NOT NULL DEFAULT 0,
+                         nonce INT NOT NULL DEFAULT 0);""")
+        self.rebuild_balances()
+
+    def create_keys(self) -> None:
+        """Schema version 3, rebuilds the tables with primary keys and adds
+        indexes for every lookup the blockchain does
+        """
+        self.cur.execute("""CREATE TABLE blocks_v3 (
+                         hash VARCHAR(64) PRIMARY KEY,
+                         nonce INT, coinbase VARCHAR(2000),
+                         parent_block VARCHAR(64), timestamp INT);""")
+        self.cur.execute("""INSERT OR IGNORE INTO blocks_v3
+                         (hash, nonce, coinbase, parent_block, timestamp)
+                         SELECT hash, nonce, coinbase, parent_block, timestamp
+                         FROM blocks;""")
+        self.cur.execute("""CREATE TABLE transactions_v3 (
+                         sender VARCHAR(2000), receiver VARCHAR(2000),
+                         value INT, data VARCHAR(256), fee INT,
+                         signature VARCHAR(512), nonce INT,
+                         parent_block VARCHAR(64),
+                         id INTEGER PRIMARY KEY);""")
+        self.cur.execute("""INSERT INTO transactions_v3 (sender, receiver,
+                         value, data, fee, signature, nonce, parent_block)
+                         SELECT sender, receiver, value, data, fee, signature,
+                         nonce, parent_block FROM transactions
+                         ORDER BY rowid;""")
+        self.cur.execute("""CREATE TABLE mempool_v3
+                         (tran TEXT PRIMARY KEY);""")
+        self.cur.execute("""INSERT OR IGNORE INTO mempool_v3 (tran)
+                         SELECT tran FROM mempool ORDER BY rowid;""")
+        for table in ["blocks", "transactions", "mempool"]:
+            self.cur.execute(f"DROP TABLE {table};")
+            self.cur.execute(f"ALTER TABLE {table}_v3 RENAME TO {table};")
+        self.cur.execute("""CREATE INDEX blocks_parent
+                         ON blocks (parent_block);""")
+        self.cur.execute("""CREATE INDEX blocks_timestamp
+                         ON blocks (timestamp);""")
+        self.cur.execute("""CREATE INDEX blocks_coinbase
+                         ON blocks (coinbase);""")
+        self.cur.execute("""CREATE INDEX transactions_sender
+                         ON transactions (sender, nonce);""")
+        self.cur.execute("""CREATE INDEX transactions_receiver
+                         ON transactions (receiver);""")
+        self.cur.execute("""CREATE INDEX transactions_block
+                         ON transactions (parent_block);""")
+
+    def create_heights(self) -> None:
+        """Schema version 4, adds the height and cumulative work of each block
+        """
+        self.cur.execute("ALTER TABLE blocks ADD COLUMN height INT;")
+        self.cur.execute("ALTER TABLE blocks ADD COLUMN work INT;")
+        self.cur.execute("SELECT hash, parent_block FROM blocks;")
+        blocks = self.cur.fetchall()
+        hashes = set(i[0] for i in blocks)
+        children = {}
+        for block_hash, parent in blocks:
+            children.setdefault(parent, []).append(block_hash)
+        stack = [(block_hash, 0, 0) for parent, block_list in
+                 children.items() if parent not in hashes
+                 for block_hash in block_list]
+        rows = []
+        while stack:
+            block_hash, height, work = stack.pop()
+            work += block_work(block_hash)
+            rows.append((height, work, block_hash))
+            for child in children.get(block_hash, []):
+                stack.append((child, height+1, work))
+        self.cur.executemany("""UPDATE blocks SET height = ?, work = ?
+                             WHERE hash = ?""", rows)
+        self.cur.execute("CREATE INDEX blocks_height ON blocks (height);")
+
+    def create_side_chains(self) -> None:
+        """Schema version 5, adds the table of blocks that aren't on the main
+        chain. Blocks and transactions only ever hold the main chain so every
+        other query is unchanged, side blocks are stored whole as JSON
+        """
+        self.cur.execute("""CREATE TABLE side_blocks (
+                         hash VARCHAR(64) PRIMARY KEY,
+                         parent_block VARCHAR(64), height INT, work INT,
+                         block TEXT);""")
+        self.cur.execute("""CREATE INDEX side_blocks_parent
+                         ON side_blocks (parent_block);""")
+
+    def create_tx_counts(self) -> None:
+        """Schema version 6, stores the number of transactions in each block
+        so headers don't have to count them every time they are read
+        """
+        self.cur.execute("""ALTER TABLE blocks
+                         ADD COLUMN tx_count INT NOT NULL DEFAULT 0;""")
+        self.cur.execute("""UPDATE blocks SET tx_count = (
+                         SELECT COUNT(*) FROM transactions
+                         WHERE transactions.parent_block = blocks.hash);""")
+
+    def create_versions(self) -> None:
+        """Schema version 7, adds the block format version and the merkle
+        root of version 2 blocks so headers can be served without their
+        transactions
+        """
+        self.cur.execute("""ALTER TABLE blocks
+                         ADD COLUMN version INT NOT NULL DEFAULT 1;""")
+        self.cur.execute("""ALTER TABLE blocks
+                         ADD COLUMN merkle_root VARCHAR(64);""")
+
+    def load_tip(self) -> ChainTip:
+        """Reads the most recent block from the database
+
+        :return: Hash, height and cumulative work of the most recent block or
+        None if there are no blocks
+        :rtype: ChainTip
+        """
+        self.cur.execute("""SELECT hash, height, work FROM blocks
+                         ORDER BY height DESC LIMIT 1""")
+        tip = self.cur.fetchone()
+        return ChainTip(*tip) if tip is not None else None
+
+    @property
+    def tip(self) -> ChainTip:
+        """Returns the hash, height and cumulative work of the most recent
+        block without querying the database
+
+        :return: Chain tip or None if there are no blocks
+        :rtype: ChainTip
+        """
+        return self.storage.tip
+
+    def subscribe_tip(self, callback) -> None:
+        """Registers a function called with the new tip every time a block is
+        added, it is called holding the writer so it should return quickly
+
+        :param callback: Function taking a ChainTip
+        :type callback: Callable
+        """
+        self.tip_listeners.append(callback)
+
+    @property
+    def height(self) -> int:
+        """Returns the height of the most recent block, the genesis block is
+        height 0
+
+        :return: Height of the chain or -1 if there are no blocks
+        :rtype: int
+        """
+        tip = self.tip
+        return tip.height if tip is not None else -1
+
+    def rebuild_balances(self) -> None:
+        """Recalculates the balances table from every block and transaction
+        stored without committing, used when migrating a database created
+        without it
+        """
+        self.cur.execute("DELETE FROM balances;")
+        self.cur.execute("""SELECT sender, -SUM(value + fee), COUNT(*)
+                         FROM transactions GROUP BY sender""")
+        deltas = self.cur.fetchall()
+        # Sending to yourself only ever debited the account
+        self.cur.execute("""SELECT receiver, SUM(value), 0 FROM transactions
+                         WHERE receiver != sender GROUP BY receiver""")
+        deltas += self.cur.fetchall()
+        self.cur.execute("""SELECT coinbase, COUNT(*) * ?, 0 FROM blocks
+                         GROUP BY coinbase""", (COINBASE_REWARD,))
+        deltas += self.cur.fetchall()
+        self.apply_deltas(deltas)
+
+    def apply_deltas(self, deltas: List) -> None:
+        """Adds changes to account balances and nonces without committing so
+        they can be part of a larger transaction
+
+        :param deltas: List of tuples of account, balance change and
+                       nonce change
+        :type deltas: List
+        """
+        self.cur.executemany("""INSERT INTO balances (account, balance, nonce)
+                             VALUES (?, ?, ?)
+                             ON CONFLICT(account) DO UPDATE SET
+                             balance = balance + excluded.balance,
+                             nonce = nonce + excluded.nonce;""", deltas)
+
+    def block_deltas(self, block: Block) -> Dict:
+        """Works out the change each account in a block will go through and
+        checks no sender spends more than it has
+
+        :param block: Block to work out the changes for
+        :type block: Block
+        :raises ValueError: Raised if an account doesn't have enough funds or
+        a transaction fee is wrong
+        :return: Dict of account to a list of balance change and nonce change
+        :rtype: Dict
+        """
+        deltas = {block.coinbase: [COINBASE_REWARD, 0]}
+        for tran in block.transactions:
+            if tran.fee != (tran.value*0.05):
+                raise ValueError("Invalid transaction fee")
+            sender = deltas.setdefault(tran.sender, [0, 0])
+            if self.get_balance(tran.sender) + sender[0] < tran.required_value:
+                raise ValueError("Account doesn't have enough funds")
+            sender[0] -= tran.required_value
+            sender[1] += 1
+            if tran.receiver != tran.sender:
+                deltas.setdefault(tran.receiver, [0, 0])[0] += tran.value
+        return deltas
+
+    def get_block(self, block_hash: str, verify: bool = False) -> Block:
+        """Returns a Block object of the desired block containing all it's
+        data, blocks on side chains are included. Blocks were checked when
+        they were added so they aren't checked again unless asked
 
         :param block_hash: The hash for the requested block, defaults to None
         :type block_hash: str
-        :return: Block object containing all block data
+        :param verify: Whether to check the signatures and hash, defaults to
+        False
+        :type verify: bool, optional
+        :return: Block object containing all block data or None if it isn't
+        stored
         :rtype: Block
         """
-        self.cur.execute("SELECT * FROM blocks WHERE hash = ?",
+        header = self.get_header(block_hash)
+        if header is not None:
+            return header.block(verify)
+        self.cur.execute("SELECT block FROM side_blocks WHERE hash = ?",
                          (block_hash,))
-        block_tuple = self.cur.fetchone()
+        side_block = self.cur.fetchone()
+        if side_block is None:
+            return None
+        return build_block(json.loads(side_block[0]), verify=verify)
+
+    def header_query(self, condition: str) -> str:
+        # Headers are read straight from blocks, transactions aren't touched
+        return f"""SELECT hash, parent_block, timestamp, nonce, coinbase,
+                height, tx_count, version, merkle_root
+                FROM blocks WHERE {condition}"""
+
+    def make_header(self, row: tuple) -> BlockHeader:
+        return BlockHeader(*row, loader=lambda: self.load_transactions(row[0]))
+
+    def get_header(self, block_hash: str) -> BlockHeader:
+        """Returns the header of a main chain block, its transactions are
+        only read if they are used
+
+        :param block_hash: Hash of the block
+        :type block_hash: str
+        :return: Header of the block or None if it isn't on the main chain
+        :rtype: BlockHeader
+        """
+        self.cur.execute(self.header_query("hash = ?"), (block_hash,))
+        row = self.cur.fetchone()
+        return self.make_header(row) if row is not None else None
+
+    def load_transactions(self, block_hash: str) -> List:
+        """Reads the transactions of a main chain block
+
+        :param block_hash: Hash of the block
+        :type block_hash: str
+        :return: List of transactions in tuple form in block order
+        :rtype: List
+        """
         self.cur.execute("""SELECT sender, receiver, value, data, fee,
                          signature, nonce FROM transactions
-                         WHERE parent_block = ?""",
-                         (block_tuple[0],))
-        transaction_list = self.cur.fetchall()
-        block = Block(block_tuple[3], block_tuple[4], transaction_list,
-                      block_tuple[0], block_tuple[1], block_tuple[2])
-        return block
+                         WHERE parent_block = ? ORDER BY id""",
+                         (block_hash,))
+        return self.cur.fetchall()
+
+    def get_proof(self, block_hash: str, digest: str) -> Dict:
+        """Returns a merkle proof that a transaction is in a main chain
+        block, a light client can check it against the header alone
+
+        :param block_hash: Hash of the block
+        :type block_hash: str
+        :param digest: Digest of the transaction
+        :type digest: str
+        :raises ValueError: Raised if the block has no merkle root or the
+        transaction isn't in it
+        :return: Dict of the block hash, merkle root, transaction digest,
+        its position in the block and the proof or None if the block isn't
+        on the main chain
+        :rtype: Dict
+        """
+        header = self.get_header(block_hash)
+        if header is None:
+            return None
+        block = header.block()
+        proof = block.proof(digest)
+        digests = [tran.digest for tran in block.transactions]
+        return {
+            "hash": block.hash,
+            "merkle_root": block.merkle_root,
+            "transaction": digest,
+            "index": digests.index(digest),
+            "proof": proof
+        }
+
+    def has_block(self, block_hash: str, side: bool = True) -> bool:
+        """Returns whether a block is stored
+
+        :param block_hash: Hash of the block
+        :type block_hash: str
+        :param side: Whether blocks on side chains count, defaults to True
+        :type side: bool, optional
+        :return: True if the block is stored
+        :rtype: bool
+        """
+        self.cur.execute("SELECT 1 FROM blocks WHERE hash = ?", (block_hash,))
+        if self.cur.fetchone() is not None:
+            return True
+        if side:
+            self.cur.execute("SELECT 1 FROM side_blocks WHERE hash = ?",
+                             (block_hash,))
+            return self.cur.fetchone() is not None
+        return False
 
     def get_balance(self, public_key: str) -> float:
         """Returns account balance of a given account
@@ -62,24 +458,10 @@ class Blockchain():
         :return: Current balance
         :rtype: float
         """
-        public_key = RSA.import_key(bytes.fromhex(public_key))
-        key_str = public_key.export_key("DER").hex()
-        balance = 0.0
-        self.cur.execute("""SELECT sender, receiver, value, fee FROM transactions WHERE
-                            sender = ? OR receiver = ?""",
-                         (key_str, key_str,))
-        transactions = self.cur.fetchall()
-        for transaction in transactions:
-            if transaction[0] == key_str:
-                balance -= transaction[2]
-                balance -= transaction[3]
-            elif transaction[1] == key_str:
-                balance += transaction[2]
-        self.cur.execute("""SELECT coinbase FROM blocks WHERE coinbase = ?""",
-                         (key_str,))
-        coinbases = len(self.cur.fetchall())
-        balance += coinbases*10
-        return balance
+        self.cur.execute("SELECT balance FROM balances WHERE account = ?",
+                         (account_key(public_key),))
+        balance = self.cur.fetchone()
+        return float(balance[0]) if balance is not None else 0.0
 
     def get_transactions(self, public_key: str) -> Dict:
         """Returns transactions from a specific account
@@ -90,10 +472,10 @@ class Blockchain():
         :return: Dictionary containing all the transactions
         :rtype: Dict
         """
-        public_key = RSA.import_key(bytes.fromhex(public_key))
-        key_str = public_key.export_key("DER").hex()
-        self.cur.execute("""SELECT * FROM transactions
-                         WHERE sender=? OR receiver = ?""",
+        key_str = account_key(public_key)
+        self.cur.execute("""SELECT sender, receiver, value, data, fee,
+                         signature, nonce, parent_block FROM transactions
+                         WHERE sender = ? OR receiver = ? ORDER BY id""",
                          (key_str, key_str,))
         transaction_tuples = self.cur.fetchall()
         resp = {"account": key_str, "transactions": []}
@@ -110,6 +492,52 @@ class Blockchain():
             })
         return resp
 
+    def insert_block(self, block: Block, tip: ChainTip) -> ChainTip:
+        """Validates a block against the tip it extends and writes it without
+        committing so it can be part of a larger transaction
+
+        :param block: Block to insert
+        :type block: Block
+        :param tip: Tip the block is added on top of, None for the genesis
+        block
+        :type tip: ChainTip
+        :raises ValueError: Raised if the block is invalid
+        :return: The tip once the block is added
+        :rtype: ChainTip
+        """
+        if not block.verify():
+            raise ValueError("Invalid block")
+        genesis = tip is None
+        if self.has_block(block.hash):
+            raise ValueError("Block has already been mined and added")
+        if not genesis and block.parent_block != tip.hash:
+            self.log("blockchain.py", "ERROR", "Invalid parent hash")
+            raise ValueError("Invalid Parent Hash")
+
+        deltas = self.block_deltas(block)
+        new_tip = ChainTip(block.hash, 0, block_work(block.hash))
+        if not genesis:
+            new_tip = ChainTip(block.hash, tip.height+1,
+                               tip.work+new_tip.work)
+        block_tuple = (block.hash, block.nonce, block.coinbase,
+                       block.parent_block, block.timestamp,
+                       new_tip.height, new_tip.work, block.version,
+                       block.merkle_root, len(block.transactions))
+        self.cur.execute("""INSERT INTO blocks (hash, nonce, coinbase,
+                         parent_block, timestamp, height, work, version,
+                         merkle_root, tx_count)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);""",
+                         block_tuple)
+        self.cur.executemany("""INSERT INTO transactions (sender, receiver, value,
+                             data, fee, signature, nonce, parent_block)
+                             VALUES (?, ?, ?, ?, ?, ?, ?, ?);""",
+                             [tuple(tran) + (block.hash,)
+                              for tran in block.transactions])
+        self.apply_deltas([(account, *delta)
+                           for account, delta in deltas.items()])
+        return new_tip
+
+    @writes
     def add_block(self, block: Block) -> None:
         """Validates block and all transactions contained within then adds it
            to blockchain
@@ -119,48 +547,240 @@ class Blockchain():
         :raises ValueError: Raises error if there is an error in the validity
         of the block
         """
-        if block.verify():
-            self.cur.execute("SELECT * FROM blocks;")
-            genesis = True if self.cur.fetchone() is None else False
-            self.cur.execute("SELECT * FROM blocks WHERE parent_block = ?",
-                             (block.parent_block,))
-            dupe_block = self.cur.fetchone()
-            if dupe_block is not None:
-                raise ValueError("Block has already been mined and added")
+        self.add_blocks([block])
 
-            if genesis is True or block.parent_block == self.prev_hash:
-                for tran in block.transactions:
-                    sender_bal = self.get_balance(tran.sender)
-                    if (sender_bal < tran.required_value):
-                        raise ValueError("Account doesn't have enough funds")
-                    if tran.fee != (tran.value*0.05):
-                        raise ValueError("Invalid transaction fee")
-                block_tuple = (block.hash, block.nonce, block.coinbase,
-                               block.parent_block, block.timestamp)
-                self.cur.execute("""INSERT INTO blocks (hash, nonce, coinbase, parent_block, timestamp)
-                                 VALUES (?, ?, ?, ?, ?);""", block_tuple)
-                for tran in block.transactions:
-                    tran_tuple = tuple(tran)
-                    tran_tuple += (block.hash,)
-                    self.cur.execute("""INSERT INTO transactions (sender, receiver, value,
-                                     data, fee, signature, nonce, parent_block)
-                                     VALUES (?, ?, ?, ?, ?, ?, ?, ?);""",
-                                     tran_tuple)
-                    signed_tran = {}
-                    keys = ["sender", "receiver", "value", "data", "fee",
-                            "signature", "nonce"]
-                    for idx, i in enumerate(tran_tuple[:-1]):
-                        signed_tran[keys[idx]] = i
-                    tran_str = json.dumps(signed_tran, sort_keys=True)
-                    self.cur.execute("""DELETE FROM mempool WHERE tran = ?""",
-                                     (tran_str,))
+    @writes
+    def add_blocks(self, blocks: List[Block]) -> None:
+        """Adds a run of blocks, each the child of the one before it. A run
+        that extends the tip is added in a single database transaction and
+        nothing is added if any of them is invalid. Any other run is stored
+        as a side chain and the chain is reorganised onto it if it has more
+        work
 
-                self.conn.commit()
-                self.log("blockchain.py", "INFO",
-                         f"New block added {block.hash}")
-            else:
-                self.log("blockchain.py", "ERROR", "Invalid parent hash")
+        :param blocks: Blocks in chain order
+        :type blocks: List[Block]
+        :raises ValueError: Raised if any block is invalid
+        """
+        if not blocks:
+            return
+        tip = self.tip
+        if tip is not None and blocks[0].parent_block != tip.hash:
+            self.add_side_blocks(blocks)
+            return
+        new_tip = tip
+        try:
+            for block in blocks:
+                new_tip = self.insert_block(block, new_tip)
+        except Exception:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        self.storage.tip = new_tip
+        self.mempool.remove_digests([tran.digest for block in blocks
+                                     for tran in block.transactions])
+        for callback in self.tip_listeners:
+            callback(new_tip)
+        if len(blocks) == 1:
+            self.log("blockchain.py", "INFO",
+                     f"New block added {blocks[0].hash}")
+        else:
+            self.log("blockchain.py", "INFO",
+                     f"Added {len(blocks)} blocks up to {new_tip.hash}")
+
+    def block_tip(self, block_hash: str) -> ChainTip:
+        """Returns the height and cumulative work of a block on the main
+        chain or a side chain
+
+        :param block_hash: Hash of the block
+        :type block_hash: str
+        :return: Hash, height and work or None if the block isn't stored
+        :rtype: ChainTip
+        """
+        for table in ["blocks", "side_blocks"]:
+            self.cur.execute(f"""SELECT hash, height, work FROM {table}
+                             WHERE hash = ?""", (block_hash,))
+            row = self.cur.fetchone()
+            if row is not None:
+                return ChainTip(*row)
+        return None
+
+    def add_side_blocks(self, blocks: List[Block]) -> None:
+        """Stores a run of blocks that doesn't extend the tip then moves the
+        main chain onto it if it now has the most work. Balances aren't
+        checked until the blocks join the main chain
+
+        :param blocks: Blocks in chain order, the first extends a stored block
+        :type blocks: List[Block]
+        :raises ValueError: Raised if a block is invalid, already stored or
+        its parent is unknown
+        """
+        # A run can start with blocks already stored from an earlier attempt
+        # at the same side chain, it carries on from the last of them
+        while blocks and self.has_block(blocks[0].hash):
+            blocks = blocks[1:]
+        if not blocks:
+            return
+        parent = self.block_tip(blocks[0].parent_block)
+        if parent is None:
+            self.log("blockchain.py", "ERROR", "Invalid parent hash")
+            raise ValueError("Invalid Parent Hash")
+        rows = []
+        for block in blocks:
+            if not block.verify():
+                raise ValueError("Invalid block")
+            if block.parent_block != parent.hash:
                 raise ValueError("Invalid Parent Hash")
+            if self.has_block(block.hash):
+                raise ValueError("Block has already been mined and added")
+            parent = ChainTip(block.hash, parent.height+1,
+                              parent.work+block_work(block.hash))
+            rows.append((block.hash, block.parent_block, parent.height,
+                         parent.work, block.encoded.decode("UTF-8")))
+        self.cur.executemany("""INSERT INTO side_blocks (hash, parent_block,
+                             height, work, block)
+                             VALUES (?, ?, ?, ?, ?);""", rows)
+        self.conn.commit()
+        self.log("blockchain.py", "INFO",
+                 f"Side chain block added {parent.hash} at {parent.height}")
+        if parent.work > self.tip.work:
+            self.reorganise(parent)
+
+    def undo_deltas(self, block: Dict) -> List:
+        """Works out the changes that take away a block's effect on account
+        balances and nonces, the opposite of block_deltas
+
+        :param block: Block in dict form
+        :type block: Dict
+        :return: List of tuples of account, balance change and nonce change
+        :rtype: List
+        """
+        deltas = {block["coinbase"]: [-COINBASE_REWARD, 0]}
+        for tran in block["transactions"]:
+            sender = deltas.setdefault(tran["sender"], [0, 0])
+            sender[0] += tran["value"] + tran["fee"]
+            sender[1] -= 1
+            if tran["receiver"] != tran["sender"]:
+                deltas.setdefault(tran["receiver"], [0, 0])[0] -= tran["value"]
+        return [(account, *delta) for account, delta in deltas.items()]
+
+    def reorganise(self, new_tip: ChainTip) -> None:
+        """Moves the main chain onto a side chain in one database
+        transaction. Blocks back to the fork are undone newest first and
+        stored as side blocks, then the side chain is added on top. Only the
+        blocks after the fork are touched. Transactions from undone blocks
+        that aren't in the new chain go back to the mempool
+
+        :param new_tip: Tip of the side chain
+        :type new_tip: ChainTip
+        :raises ValueError: Raised if a block on the side chain is invalid,
+        the side chain is dropped and the main chain is left as it was
+        """
+        path = []
+        block_hash = new_tip.hash
+        while True:
+            self.cur.execute("""SELECT parent_block, block FROM side_blocks
+                             WHERE hash = ?""", (block_hash,))
+            row = self.cur.fetchone()
+            if row is None:
+                break
+            path.append((block_hash, row[1]))
+            block_hash = row[0]
+        fork = self.block_tip(block_hash)
+        if fork is None:
+            raise ValueError("Side chain doesn't join the main chain")
+        old_tip = self.tip
+        removed = []
+        added = []
+        current = None
+        try:
+            self.cur.execute("""SELECT hash, parent_block, timestamp, nonce,
+                             coinbase, height, work, version, merkle_root
+                             FROM blocks WHERE height > ?
+                             ORDER BY height DESC""", (fork.height,))
+            keys = ["hash", "parent_block", "timestamp", "nonce", "coinbase",
+                    "height", "work", "version", "merkle_root"]
+            for header in [dict(zip(keys, row))
+                           for row in self.cur.fetchall()]:
+                block = self.block_dict(header)
+                self.apply_deltas(self.undo_deltas(block))
+                self.cur.execute("""DELETE FROM transactions
+                                 WHERE parent_block = ?""", (header["hash"],))
+                self.cur.execute("DELETE FROM blocks WHERE hash = ?",
+                                 (header["hash"],))
+                self.cur.execute("""INSERT INTO side_blocks (hash,
+                                 parent_block, height, work, block)
+                                 VALUES (?, ?, ?, ?, ?);""",
+                                 (header["hash"], header["parent_block"],
+                                  header["height"], header["work"],
+                                  encode(block).decode("UTF-8")))
+                removed.append(block)
+            tip = fork
+            for current, block_json in reversed(path):
+                self.cur.execute("DELETE FROM side_blocks WHERE hash = ?",
+                                 (current,))
+                block = build_block(json.loads(block_json))
+                tip = self.insert_block(block, tip)
+                added.append(block)
+        except Exception as e:
+            self.conn.rollback()
+            self.log("blockchain.py", "ERROR",
+                     f"Side chain rejected at {current} {e}")
+            if current is not None:
+                self.drop_side_chain(current)
+            raise ValueError(f"Invalid side chain {e}")
+        self.conn.commit()
+        self.storage.tip = tip
+        digests = set(tran.digest for block in added
+                      for tran in block.transactions)
+        self.mempool.remove_digests(digests)
+        for block in reversed(removed):
+            for tran in block["transactions"]:
+                tran_obj = Transaction.from_dict(tran)
+                if tran_obj.digest not in digests:
+                    self.mempool.add(tran_obj)
+        for callback in self.tip_listeners:
+            callback(tip)
+        self.log("blockchain.py", "INFO",
+                 f"Reorganised from {old_tip.hash} to {tip.hash}, "
+                 f"{len(removed)} blocks undone and {len(added)} added")
+
+    def drop_side_chain(self, block_hash: str) -> None:
+        """Deletes a side block and every side block built on it
+
+        :param block_hash: Hash of the first block to delete
+        :type block_hash: str
+        """
+        stack = [block_hash]
+        while stack:
+            block_hash = stack.pop()
+            self.cur.execute("""SELECT hash FROM side_blocks
+                             WHERE parent_block = ?""", (block_hash,))
+            stack += [i[0] for i in self.cur.fetchall()]
+            self.cur.execute("DELETE FROM side_blocks WHERE hash = ?",
+                             (block_hash,))
+        self.conn.commit()
+
+    def get_locator(self) -> List[str]:
+        """Returns hashes of main chain blocks for a peer to find where its
+        chain and this one split, the ten newest then back in doubling steps
+        to the genesis block
+
+        :return: Block hashes newest first
+        :rtype: List[str]
+        """
+        heights = []
+        height, step = self.height, 1
+        while height > 0:
+            heights.append(height)
+            if len(heights) >= 10:
+                step *= 2
+            height -= step
+        if self.height >= 0:
+            heights.append(0)
+        self.cur.execute(f"""SELECT hash FROM blocks WHERE height IN
+                         ({", ".join("?" * len(heights))})
+                         ORDER BY height DESC""", heights)
+        return [i[0] for i in self.cur.fetchall()]
 
     @property
     def prev_hash(self) -> str:
@@ -169,14 +789,114 @@ class Blockchain():
         :return: SHA256 hash of most recent block
         :rtype: str
         """
-        self.cur.execute("SELECT MAX(timestamp) as max_number FROM blocks;")
-        prev_block = self.cur.fetchone()[0]
-        if prev_block is not None:
-            self.cur.execute("SELECT hash FROM blocks WHERE timestamp = ?",
-                             (prev_block,))
-            return self.cur.fetchone()[0]
-        else:
-            return None
+        tip = self.tip
+        return tip.hash if tip is not None else None
+
+    def get_block_at(self, height: int, verify: bool = False) -> Block:
+        """Returns the block at a given height in the chain
+
+        :param height: Height of the block, the genesis block is height 0
+        :type height: int
+        :param verify: Whether to check the signatures and hash, defaults to
+        False
+        :type verify: bool, optional
+        :return: Block object containing all block data or None if there is
+        no block at that height
+        :rtype: Block
+        """
+        self.cur.execute(self.header_query("height = ?"), (height,))
+        row = self.cur.fetchone()
+        return self.make_header(row).block(verify) if row is not None else None
+
+    def get_recent_headers(self, count: int) -> List[BlockHeader]:
+        """Returns the headers of the most recent blocks, newest first
+
+        :param count: Number of blocks
+        :type count: int
+        :return: List of BlockHeader objects
+        :rtype: List[BlockHeader]
+        """
+        self.cur.execute(self.header_query("height > ? ORDER BY height DESC"),
+                         (self.height - count,))
+        return [self.make_header(row) for row in self.cur.fetchall()]
+
+    def get_recent_blocks(self, count: int,
+                          verify: bool = False) -> List[Block]:
+        """Returns the most recent blocks in the chain, newest first
+
+        :param count: Number of blocks to return
+        :type count: int
+        :param verify: Whether to check the signatures and hashes, defaults
+        to False
+        :type verify: bool, optional
+        :return: List of Block objects
+        :rtype: List[Block]
+        """
+        return [header.block(verify)
+                for header in self.get_recent_headers(count)]
+
+    def get_headers(self, start: int, count: int) -> List[Dict]:
+        """Returns the headers of a run of blocks, everything but the
+        transactions
+
+        :param start: Height of the first block
+        :type start: int
+        :param count: Number of blocks
+        :type count: int
+        :return: List of headers in height order
+        :rtype: List[Dict]
+        """
+        self.cur.execute("""SELECT hash, parent_block, timestamp, nonce,
+                         coinbase, height, version, merkle_root FROM blocks
+                         WHERE height >= ? AND height < ? ORDER BY height""",
+                         (start, start + count))
+        keys = ["hash", "parent_block", "timestamp", "nonce", "coinbase",
+                "height", "version", "merkle_root"]
+        return [dict(zip(keys, row)) for row in self.cur.fetchall()]
+
+    def get_block_dicts(self, start: int, count: int) -> List[Dict]:
+        """Returns a run of blocks in the dict form they are sent to peers
+        in, built straight from the database without checking signatures
+
+        :param start: Height of the first block
+        :type start: int
+        :param count: Number of blocks
+        :type count: int
+        :return: List of blocks in height order
+        :rtype: List[Dict]
+        """
+        return [self.block_dict(header)
+                for header in self.get_headers(start, count)]
+
+    def block_dict(self, header: Dict) -> Dict:
+        """Loads the transactions of a main chain block and returns it in
+        dict form
+
+        :param header: Header of the block
+        :type header: Dict
+        :return: Block in dict form
+        :rtype: Dict
+        """
+        self.cur.execute("""SELECT sender, receiver, value, data, fee,
+                         signature, nonce FROM transactions
+                         WHERE parent_block = ? ORDER BY id""",
+                         (header["hash"],))
+        keys = ["sender", "receiver", "value", "data", "fee", "signature",
+                "nonce"]
+        block = {
+            "parent_block": header["parent_block"],
+            "timestamp": header["timestamp"],
+            "transactions": [dict(zip(keys, row))
+                             for row in self.cur.fetchall()],
+            "hash": header["hash"],
+            "nonce": header["nonce"],
+            "coinbase": header["coinbase"]
+        }
+        # Matches dict(Block), version 1 blocks are sent without a version
+        if header.get("version", 1) >= MERKLE_VERSION:
+            block["version"] = header["version"]
+            block["merkle_root"] = header["merkle_root"]
+        return block
 
     def get_tran_nonce(self, addr: str) -> int:
         """Get the nonce value for transactions from specified account
@@ -186,13 +906,23 @@ class Blockchain():
         :return: Nonce of account
         :rtype: int
         """
-        self.cur.execute("SELECT sender FROM transactions WHERE sender = ?",
+        self.cur.execute("SELECT nonce FROM balances WHERE account = ?",
                          (addr,))
-        try:
-            nonce = len(self.cur.fetchall())
-        except TypeError:
-            nonce = 0
-        return nonce
+        nonce = self.cur.fetchone()
+        return nonce[0] if nonce is not None else 0
+
+    def get_pending_nonce(self, addr: str) -> int:
+        """Get the nonce the next transaction from an account should use,
+        counting transactions waiting in the mempool
+
+        :param addr: Address of account to get nonce from
+        :type addr: str
+        :return: Nonce for the next transaction
+        :rtype: int
+        """
+        nonce = self.get_tran_nonce(addr)
+        pending = self.mempool.next_nonce(addr)
+        return max(nonce, pending) if pending is not None else nonce
 
     @property
     def mem_pool(self) -> List:
@@ -201,37 +931,59 @@ class Blockchain():
         :return: List of all transactions in dictionary form
         :rtype: List
         """
-        self.cur.execute("""SELECT * FROM mempool""")
-        tran_strings = self.cur.fetchall()
-        transactions = []
-        for i in tran_strings:
-            transactions.append(json.loads(i[0]))
-        return transactions
+        return [tran.tran_dict() for tran in self.mempool.transactions()]
 
-    def add_to_mempool(self, transaction: Dict) -> bool:
-        """Adds a transaction to mempool
+    def add_to_mempool(self, transaction: Transaction) -> bool:
+        """Adds a transaction to mempool unless its nonce has already been
+        used on the chain, which is how an announced transaction that was
+        mined already is turned away
 
-        :param transaction: Transaction sata
-        :type transaction: Dict
+        :param transaction: Signed transaction
+        :type transaction: Transaction
         :return: Whether or not it succeeded
         :rtype: bool
         """
-        tran_str = json.dumps(transaction, sort_keys=True)
-        self.cur.execute("""SELECT * FROM mempool WHERE tran = ?""",
-                         (tran_str,))
-        if self.cur.fetchone() is None:
-            self.cur.execute("""INSERT INTO mempool (tran) VALUES (?);""",
-                             (tran_str,))
-            self.conn.commit()
+        if transaction.nonce < self.get_tran_nonce(transaction.sender):
+            return False
+        if self.mempool.add(transaction):
             self.log("blockchain.py", "INFO", "Added transaction to mempool")
             return True
         return False
 
+    @writes
     def flush_mempool(self):
-        """Deletes all transactions from mempool
+        """Deletes all transactions from mempool and its snapshot
+        """
+        self.mempool.clear()
+        self.cur.execute("DELETE FROM mempool;")
+        self.conn.commit()
+
+    @writes
+    def save_mempool(self) -> None:
+        """Replaces the snapshot of the mempool on disk with its current
+        contents
         """
         self.cur.execute("DELETE FROM mempool;")
+        self.cur.executemany("""INSERT OR IGNORE INTO mempool (tran)
+                             VALUES (?);""",
+                             [(tran.encoded.decode("UTF-8"),)
+                              for tran in self.mempool.transactions()])
         self.conn.commit()
+        self.log("blockchain.py", "INFO",
+                 f"Saved {len(self.mempool)} mempool transactions")
+
+    def load_mempool(self) -> None:
+        """Adds the transactions in the snapshot on disk to the mempool
+        """
+        self.cur.execute("SELECT tran FROM mempool ORDER BY rowid")
+        for tran_str in self.cur.fetchall():
+            try:
+                tran = Transaction.from_dict(json.loads(tran_str[0]))
+            except (KeyError, TypeError, ValueError):
+                continue  # Written by an older version and no longer valid
+            self.mempool.add(tran)
+        self.log("blockchain.py", "INFO",
+                 f"Loaded {len(self.mempool)} mempool transactions")
 
     def get_current_diff(self) -> str:
         """Get the current difficulty and return it
@@ -0,0 +1,94 @@
+"""
+Canonical encoding of blocks, transactions and messages.
+
+Everything that is hashed, signed, stored or sent as JSON goes through
+encode so the bytes are always sorted key JSON and every digest agrees.
+Blocks and transactions keep the bytes and digests they have worked out and
+only throw them away when one of their fields is set again.
+"""
+import hashlib
+import json
+from typing import Any, Callable, Hashable
+
+
+def encode(data: Any) -> bytes:
+    """Returns the canonical bytes of JSON compatible data
+
+    :param data: Data to encode
+    :type data: Any
+    :raises ValueError: Raised if the data can't be encoded
+    :return: UTF-8 JSON with sorted keys
+    :rtype: bytes
+    """
+    try:
+        return json.dumps(data, sort_keys=True).encode("UTF-8")
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Unable to encode {e}")
+
+
+def digest_bytes(encoded: bytes) -> str:
+    """Returns the SHA256 of bytes that have already been encoded, used by
+    objects that keep their encoding
+
+    :param encoded: Canonical bytes from encode
+    :type encoded: bytes
+    :return: Hex digest
+    :rtype: str
+    """
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def digest(data: Any) -> str:
+    """Returns the SHA256 of the canonical bytes of JSON compatible data
+
+    :param data: Data to hash
+    :type data: Any
+    :raises ValueError: Raised if the data can't be encoded
+    :return: Hex digest
+    :rtype: str
+    """
+    return digest_bytes(encode(data))
+
+
+class Encodable():
+    """Base for objects that cache their encodings. Subclasses list the
+    attributes the encodings depend on in FIELDS, setting any of them
+    clears the cache. Lists held in those attributes must be replaced
+    rather than changed in place
+    """
+    FIELDS = frozenset()
+    __slots__ = ("encodings",)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        if name in self.FIELDS and getattr(self, "encodings", None):
+            self.encodings = {}
+        super().__setattr__(name, value)
+
+    def cached(self, key: Hashable, build: Callable) -> Any:
+        """Returns an encoding, building it the first time it is asked for
+
+        :param key: Name of the encoding
+        :type key: Hashable
+        :param build: Function returning the encoding
+        :type build: Callable
+        :return: The encoding
+        :rtype: Any
+        """
+        encodings = getattr(self, "encodings", None)
+        if encodings is None:
+            encodings = self.encodings = {}
+        if key not in encodings:
+            encodings[key] = build()
+        return encodings[key]
+
+    def keep(self, *keys: Hashable) -> None:
+        """Drops every cached encoding but the ones named, used by objects
+        that are held for a long time
+
+        :param keys: Names of the encodings to keep
+        :type keys: Hashable
+        """
+        encodings = getattr(self, "encodings", None)
+        if encodings:
+            self.encodings = {key: encodings[key] for key in keys
+                              if key in encodings}
@@ -0,0 +1,221 @@
+import heapq
+import itertools
+import threading
+from bisect import insort
+from typing import List
+
+from blockchain.transaction import Transaction
+
+
+class Mempool():
+    def __init__(self, max_size: int = 50000) -> None:
+        """In memory pool of transactions waiting to be mined, indexed by
+        digest and by sender and nonce
+
+        :param max_size: Maximum number of transactions held, the lowest fee
+        rate transactions are evicted when it is full, defaults to 50000
+        :type max_size: int, optional
+        """
+        self.max_size = max_size
+        self.entries = {}  # digest -> (transaction, fee rate, sequence)
+        self.senders = {}  # sender -> (sorted nonces, {nonce: digest})
+        self.evict_heap = []  # (fee rate, sequence, digest), lowest first
+        self.sequence = itertools.count()
+        self.lock = threading.RLock()
+        self.listeners = []
+
+    def subscribe(self, callback) -> None:
+        """Registers a function called with every transaction added to the pool
+
+        :param callback: Function taking the Transaction
+        :type callback: Callable
+        """
+        self.listeners.append(callback)
+
+    def __contains__(self, digest: str) -> bool:
+        return digest in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, transaction: Transaction) -> bool:
+        """Adds a transaction to the pool. A transaction with the same sender
+        and nonce as one already held replaces it only if it pays a higher fee
+        rate and when the pool is full the lowest fee rate transaction that
+        is the last one from its sender is evicted to make room
+
+        :param transaction: Signed transaction
+        :type transaction: Transaction
+        :return: Whether or not it was added
+        :rtype: bool
+        """
+        digest = transaction.digest
+        fee_rate = transaction.fee / transaction.size
+        sender, nonce = transaction.sender, transaction.nonce
+        # Only what the pool needs is kept while it waits to be mined
+        transaction.keep("digest", "size")
+        with self.lock:
+            if digest in self.entries:
+                return False
+            if sender in self.senders and nonce in self.senders[sender][1]:
+                existing = self.senders[sender][1][nonce]
+                if self.entries[existing][1] >= fee_rate:
+                    return False
+                self.discard(existing)
+            elif len(self.entries) >= self.max_size:
+                lowest = self.lowest()
+                if lowest is None or self.entries[lowest][1] >= fee_rate:
+                    return False
+                evicted = self.entries[lowest][0]
+                # Evicting the sender's own last transaction would leave
+                # this one waiting on a nonce that is gone
+                if evicted.sender == sender and evicted.nonce < nonce:
+                    return False
+                self.discard(lowest)
+            seq = next(self.sequence)
+            self.entries[digest] = (transaction, fee_rate, seq)
+            nonces, by_nonce = self.senders.setdefault(sender, ([], {}))
+            insort(nonces, nonce)
+            by_nonce[nonce] = digest
+            heapq.heappush(self.evict_heap, (fee_rate, seq, digest))
+            if len(self.evict_heap) > 2 * len(self.entries) + 64:
+                self.evict_heap = [(i[1], i[2], d) for d, i
+                                   in self.entries.items()]
+                heapq.heapify(self.evict_heap)
+        for callback in self.listeners:
+            callback(transaction)
+        return True
+
+    def get(self, digest: str) -> Transaction:
+        """Returns a transaction in the pool by digest
+
+        :param digest: Digest of the transaction
+        :type digest: str
+        :return: The transaction or None if it isn't in the pool
+        :rtype: Transaction
+        """
+        entry = self.entries.get(digest)
+        return entry[0] if entry is not None else None
+
+    def lowest(self) -> str:
+        """Returns the digest of the transaction with the lowest fee rate out
+        of the last transaction of every sender. Evicting one with a higher
+        nonce still waiting would leave those stuck in the pool, unable to
+        be mined
+
+        :return: Digest or None if the pool is empty
+        :rtype: str
+        """
+        skipped = []
+        lowest = None
+        with self.lock:
+            while self.evict_heap:
+                digest = self.evict_heap[0][2]
+                if digest not in self.entries:
+                    heapq.heappop(self.evict_heap)
+                    continue
+                transaction = self.entries[digest][0]
+                nonces = self.senders[transaction.sender][0]
+                if nonces[-1] != transaction.nonce:
+                    skipped.append(heapq.heappop(self.evict_heap))
+                    continue
+                lowest = digest
+                break
+            for item in skipped:
+                heapq.heappush(self.evict_heap, item)
+        return lowest
+
+    def discard(self, digest: str) -> Transaction:
+        """Removes a transaction from the pool by digest
+
+        :param digest: Digest of the transaction
+        :type digest: str
+        :return: The transaction removed or None if it wasn't in the pool
+        :rtype: Transaction
+        """
+        with self.lock:
+            entry = self.entries.pop(digest, None)
+            if entry is None:
+                return None
+            transaction = entry[0]
+            nonces, by_nonce = self.senders[transaction.sender]
+            if by_nonce.get(transaction.nonce) == digest:
+                del by_nonce[transaction.nonce]
+                nonces.remove(transaction.nonce)
+            if not nonces:
+                del self.senders[transaction.sender]
+            return transaction
+
+    def remove(self, transactions: List[Transaction]) -> None:
+        """Removes transactions from the pool, used once they are in a block
+
+        :param transactions: Signed transactions
+        :type transactions: List[Transaction]
+        """
+        self.remove_digests([tran.digest for tran in transactions])
+
+    def remove_digests(self, digests: List[str]) -> None:
+        """Removes transactions from the pool by digest
+
+        :param digests: Digests of the transactions
+        :type digests: List[str]
+        """
+        with self.lock:
+            for digest in digests:
+                self.discard(digest)
+
+    def next_nonce(self, sender: str) -> int:
+        """Returns the nonce following the highest one a sender has in the pool
+
+        :param sender: Address of the sender
+        :type sender: str
+        :return: Next nonce or None if the sender has nothing in the pool
+        :rtype: int
+        """
+        with self.lock:
+            if sender not in self.senders:
+                return None
+            return self.senders[sender][0][-1] + 1
+
+    def clear(self) -> None:
+        """Removes every transaction from the pool
+        """
+        with self.lock:
+            self.entries = {}
+            self.senders = {}
+            self.evict_heap = []
+
+    def transactions(self) -> List[Transaction]:
+        """Returns every transaction in the order they arrived
+
+        :return: List of transactions
+        :rtype: List[Transaction]
+        """
+        with self.lock:
+            return [entry[0] for entry in self.entries.values()]
+
+    def by_fee(self, count: int = None) -> List[Transaction]:
+        """Returns the highest fee rate transactions while keeping the
+        transactions of each sender in nonce order. Only the lowest nonce of
+        every sender is a candidate at a time so this is O(k log n)
+
+        :param count: Maximum number of transactions, defaults to all
+        :type count: int, optional
+        :return: List of transactions, best first
+        :rtype: List[Transaction]
+        """
+        with self.lock:
+            heads = []
+            for nonces, by_nonce in self.senders.values():
+                entry = self.entries[by_nonce[nonces[0]]]
+                heads.append((-entry[1], entry[2], 0, nonces, by_nonce))
+            heapq.heapify(heads)
+            selected = []
+            while heads and (count is None or len(selected) < count):
+                _, _, idx, nonces, by_nonce = heapq.heappop(heads)
+                selected.append(self.entries[by_nonce[nonces[idx]]][0])
+                if idx + 1 < len(nonces):
+                    entry = self.entries[by_nonce[nonces[idx+1]]]
+                    heapq.heappush(heads, (-entry[1], entry[2], idx+1,
+                                           nonces, by_nonce))
+            return selected
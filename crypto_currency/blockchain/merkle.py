@@ -0,0 +1,102 @@
+"""
+Merkle trees over transaction digests.
+
+Leaves are the hex digests of the signed transactions in block order. Each
+pair is hashed with a one byte prefix so an inner node can never be passed
+off as a transaction digest. A level with an odd number of nodes moves the
+last one up unchanged rather than pairing it with itself, which would let
+two different transaction lists have the same root.
+"""
+import hashlib
+from typing import List
+
+EMPTY_ROOT = hashlib.sha256(b"").hexdigest()
+NODE_PREFIX = b"\x01"
+
+
+def hash_pair(left: str, right: str) -> str:
+    """Returns the parent of two nodes
+
+    :param left: Hex digest of the left node
+    :type left: str
+    :param right: Hex digest of the right node
+    :type right: str
+    :return: Hex digest of the parent
+    :rtype: str
+    """
+    return hashlib.sha256(NODE_PREFIX + bytes.fromhex(left)
+                          + bytes.fromhex(right)).hexdigest()
+
+
+def next_level(level: List[str]) -> List[str]:
+    parents = [hash_pair(level[idx], level[idx+1])
+               for idx in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+        parents.append(level[-1])
+    return parents
+
+
+def merkle_root(digests: List[str]) -> str:
+    """Returns the root of the tree over a list of transaction digests
+
+    :param digests: Hex digests in block order
+    :type digests: List[str]
+    :return: Hex digest of the root, EMPTY_ROOT for no transactions
+    :rtype: str
+    """
+    if not digests:
+        return EMPTY_ROOT
+    level = list(digests)
+    while len(level) > 1:
+        level = next_level(level)
+    return level[0]
+
+
+def merkle_proof(digests: List[str], index: int) -> List[List[str]]:
+    """Returns the nodes needed to rebuild the root from one transaction
+
+    :param digests: Hex digests in block order
+    :type digests: List[str]
+    :param index: Position of the transaction in the block
+    :type index: int
+    :raises IndexError: Raised if there is no transaction at index
+    :return: List of side and digest pairs from the leaf up, side is "l" or
+    "r" for the side the sibling is on
+    :rtype: List[List[str]]
+    """
+    if not 0 <= index < len(digests):
+        raise IndexError("No transaction at index")
+    proof = []
+    level = list(digests)
+    while len(level) > 1:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append(["l" if sibling < index else "r", level[sibling]])
+        level = next_level(level)
+        index //= 2
+    return proof
+
+
+def verify_proof(digest: str, proof: List[List[str]], root: str) -> bool:
+    """Checks a transaction digest is in the tree with the given root
+
+    :param digest: Hex digest of the transaction
+    :type digest: str
+    :param proof: Proof from merkle_proof
+    :type proof: List[List[str]]
+    :param root: Merkle root from the block header
+    :type root: str
+    :return: True if the proof leads from the digest to the root
+    :rtype: bool
+    """
+    try:
+        for side, sibling in proof:
+            if side == "l":
+                digest = hash_pair(sibling, digest)
+            elif side == "r":
+                digest = hash_pair(digest, sibling)
+            else:
+                return False
+    except (ValueError, TypeError):
+        return False
+    return digest == root
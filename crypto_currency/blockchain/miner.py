@@ -1,9 +1,17 @@
+import hashlib
 import json
 import multiprocessing as mp
+import queue
+import threading
 import time
-from typing import Any, Dict
+from collections import deque
+from typing import Any, Dict, List, Tuple
 
-from Crypto.Hash import SHA256
+from blockchain.processes import get_context
+
+# Upper bound on bytes a worker hashes between checks for cancellation so
+# large blocks are abandoned as quickly as small ones
+CHECK_BYTES = 1 << 24
 
 
 class Miner():
@@ -25,59 +33,356 @@ class Miner():
         self.difficulty = difficulty
         self.miner_addr = miner_addr
         self.workers = workers
+        self.prefix, self.suffix = self.split_block(self.block)
 
-    def hash_block(self, block_dict: Dict) -> Any:
-        """Turns the dict into a string and then hashes it and checks if it is valid
+    @staticmethod
+    def split_block(block_dict: Dict) -> Tuple[bytes, bytes]:
+        """Serializes the block once into the bytes either side of the nonce so
+        only the nonce has to be encoded for each attempt. The output joined
+        around a nonce is identical to the string Block.verify hashes, for
+        version 2 blocks that is the header without the transactions
 
-        :param block_dict: Dictionary to be hashed
+        :param block_dict: Dictionary of the block to be mined
         :type block_dict: Dict
-        :return: False if the hash isnt valid and the has and nonce in a
-        tuple if it is
-        :rtype: Any
+        :raises ValueError: Raised if the split does not match the full
+        serialization of the block
+        :return: The prefix up to and the suffix after the nonce value
+        :rtype: Tuple[bytes, bytes]
         """
-        json_str = json.dumps(block_dict, sort_keys=True)
-        block_hash = SHA256.new(json_str.encode("UTF-8")).hexdigest()
-        if block_hash[:len(self.difficulty)] == self.difficulty:
-            return (block_hash, block_dict["nonce"])
-        else:
-            return False
+        block_dict = dict(block_dict)
+        block_dict.pop("hash", None)
+        block_dict.pop("nonce", None)
+        # Blocks with a merkle root only hash their header
+        if "merkle_root" in block_dict:
+            block_dict.pop("transactions", None)
+        head = {k: v for k, v in block_dict.items() if k < "nonce"}
+        tail = {k: v for k, v in block_dict.items() if k > "nonce"}
+        prefix = json.dumps(head, sort_keys=True)[:-1]
+        prefix += ', "nonce": ' if head else '"nonce": '
+        suffix = json.dumps(tail, sort_keys=True)[1:]
+        suffix = ", " + suffix if tail else "}"
+        block_dict["nonce"] = 0
+        if prefix + "0" + suffix != json.dumps(block_dict, sort_keys=True):
+            raise ValueError("Unable to split block around nonce")
+        return prefix.encode("UTF-8"), suffix.encode("UTF-8")
 
-    def mine_section(self, nonce_range: tuple, queue: mp.Queue) -> None:
-        """Mines a batch of nonces and if any are valid submits the result
-        to master process
+    def mine_block(self, pool: "MiningPool" = None,
+                   timeout: float = None) -> bool:
+        """Hands the block to a pool of workers and waits for a valid hash
 
-        :param nonce_range: The range for nonces to be mined
-        :type nonce_range: tuple
-        :param queue: Queue to submit result to
-        :type queue: mp.Queue
-        """
-        block_dict = dict(self.block.copy())
-        for nonce in range(nonce_range[0], nonce_range[1]):
-            block_dict["nonce"] = nonce
-            res = self.hash_block(block_dict)
-            if res is not False:
-                queue.put(res)
-
-    def mine_block(self) -> bool:
-        """Creates workers to hash batches of nonces and then wait for valid hash
-
-        :return: True when the process has mined the block
+        :param pool: Persistent pool to mine with, a temporary one is created
+        if not given, defaults to None
+        :type pool: MiningPool, optional
+        :param timeout: Seconds to wait before giving up, defaults to None
+        :type timeout: float, optional
+        :return: True when the process has mined the block and False if it
+        was cancelled or timed out
         :rtype: bool
         """
-        with mp.Pool(processes=self.workers) as pool:
-            manager = mp.Manager()
-            queue = manager.Queue(maxsize=1)
-            nonce = 0
-            batch_size = 30000
+        own_pool = pool is None
+        if own_pool:
+            pool = MiningPool(self.workers)
+            pool.start()
+        try:
             start = time.time()
-            while queue.empty():
-                pool.apply_async(self.mine_section,
-                                 ((nonce, nonce+batch_size), queue))
-                nonce += batch_size
-                time.sleep(0.1)
-            res = queue.get()
+            start_attempts = pool.attempts
+            job_id = pool.submit(self.prefix, self.suffix, self.difficulty)
+            res = pool.wait(job_id, timeout)
             taken = time.time()-start
+            self.attempts = pool.attempts - start_attempts
+        finally:
+            if own_pool:
+                pool.close()
+        self.hash_speed = self.attempts/taken if taken > 0 else 0.0
+        if res is None:
+            return False
         self.hash = res[0]
         self.nonce = res[1]
-        self.hash_speed = res[1]/taken
         return True
+
+
+def mine_worker(index: int, stride: int, jobs: mp.Queue, results: mp.Queue,
+                stop_event: Any, job_id: Any, attempts: Any,
+                check_every: int) -> None:
+    """Worker loop run by every process in the pool. Each worker hashes the
+    nonces index, index+stride, index+2*stride... of the current job until it
+    finds a valid hash, the search is stopped or a new job is submitted
+
+    :param index: Position of this worker in the pool and first nonce tried
+    :type index: int
+    :param stride: Number of workers in the pool
+    :type stride: int
+    :param jobs: Queue this worker receives new block templates from
+    :type jobs: mp.Queue
+    :param results: Queue shared by all workers to submit solutions to
+    :type results: mp.Queue
+    :param stop_event: Shared event set when the current search should end
+    :type stop_event: Any
+    :param job_id: Shared id of the most recently submitted job
+    :type job_id: Any
+    :param attempts: Shared array of hashes done by each worker
+    :type attempts: Any
+    :param check_every: Number of attempts between checks for cancellation
+    :type check_every: int
+    """
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        current_job, prefix, suffix, difficulty = job
+        prefix_state = hashlib.sha256(prefix)
+        chunk = max(1, min(check_every, CHECK_BYTES // (len(suffix) + 16)))
+        nonce = index
+        found = False
+        while (not found and not stop_event.is_set()
+               and job_id.value == current_job):
+            for attempt in range(chunk):
+                block_hash = prefix_state.copy()
+                block_hash.update(str(nonce).encode("UTF-8") + suffix)
+                block_hash = block_hash.hexdigest()
+                if block_hash.startswith(difficulty):
+                    found = True
+                    break
+                nonce += stride
+            # Counted before the result is sent so the miner reading the
+            # counters once it has the result sees every attempt
+            attempts[index] += attempt + 1
+            if found:
+                results.put((current_job, block_hash, nonce))
+
+
+class MiningPool():
+    def __init__(self, workers: int = 4, check_every: int = 5000,
+                 window: float = 10.0) -> None:
+        """Sets up a pool of mining processes that lives across blocks
+
+        :param workers: Number of worker processes, defaults to 4
+        :type workers: int, optional
+        :param check_every: Attempts each worker makes between checks for
+        cancellation or a new job, defaults to 5000
+        :type check_every: int, optional
+        :param window: Seconds the rolling hashrate is averaged over,
+        defaults to 10.0
+        :type window: float, optional
+        """
+        self.workers = workers
+        self.check_every = check_every
+        self.window = window
+        self.context = get_context()
+        self.stop_event = self.context.Event()
+        self.job_id = self.context.Value("i", 0)
+        self.worker_counters = self.context.Array("Q", workers)
+        self.samples = deque()
+        self.samples_lock = threading.Lock()
+        self.results = self.context.Queue()
+        self.jobs = [self.context.Queue() for _ in range(workers)]
+        self.processes = []
+        self.cancelled = threading.Event()
+        # Held while cancelled and stop_event are changed together
+        self.cancel_lock = threading.Lock()
+
+    def start(self) -> None:
+        """Starts the worker processes, they wait idle until a job is submitted
+        """
+        if self.processes:
+            return
+        for index, jobs in enumerate(self.jobs):
+            proc = self.context.Process(target=mine_worker,
+                                        args=(index, self.workers, jobs,
+                                              self.results, self.stop_event,
+                                              self.job_id,
+                                              self.worker_counters,
+                                              self.check_every),
+                                        daemon=True)
+            proc.start()
+            self.processes.append(proc)
+
+    def submit(self, prefix: bytes, suffix: bytes, difficulty: str) -> int:
+        """Hands a new block template to every worker, any search in progress
+        is abandoned. If the pool has been cancelled the job is not searched
+        until resume is called
+
+        :param prefix: Serialized block up to the nonce
+        :type prefix: bytes
+        :param suffix: Serialized block after the nonce
+        :type suffix: bytes
+        :param difficulty: Required start of a valid hash
+        :type difficulty: str
+        :return: Id of the submitted job
+        :rtype: int
+        """
+        with self.job_id.get_lock():
+            self.job_id.value += 1
+            job_id = self.job_id.value
+        # A cancelled pool keeps stop_event set so the workers drop the job
+        with self.cancel_lock:
+            if not self.cancelled.is_set():
+                self.stop_event.clear()
+        for jobs in self.jobs:
+            jobs.put((job_id, prefix, suffix, difficulty))
+        return job_id
+
+    def wait(self, job_id: int, timeout: float = None) -> Any:
+        """Waits for a solution to the given job
+
+        :param job_id: Id returned by submit
+        :type job_id: int
+        :param timeout: Seconds to wait before giving up, defaults to None
+        :type timeout: float, optional
+        :return: Tuple of hash and nonce or None if the job was cancelled,
+        replaced or timed out
+        :rtype: Any
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self.sample()
+            if job_id != self.job_id.value:
+                return None
+            if self.cancelled.is_set():
+                self.stop_event.set()
+                return None
+            remaining = 0.1
+            if deadline is not None:
+                remaining = min(remaining, deadline - time.time())
+                if remaining <= 0:
+                    self.stop_event.set()
+                    return None
+            try:
+                res = self.results.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if res[0] == job_id:
+                self.stop_event.set()
+                return res[1:]
+
+    @property
+    def worker_attempts(self) -> List[int]:
+        """Returns the number of hashes each worker has done since starting
+
+        :return: Hashes done per worker
+        :rtype: List[int]
+        """
+        return list(self.worker_counters)
+
+    @property
+    def attempts(self) -> int:
+        """Returns the total number of hashes done by the pool
+
+        :return: Hashes done by all workers
+        :rtype: int
+        """
+        return sum(self.worker_attempts)
+
+    def sample(self) -> None:
+        """Records the current worker counters for the rolling hashrate and
+        drops samples that have fallen out of the window
+        """
+        now = time.time()
+        with self.samples_lock:
+            self.samples.append((now, self.worker_attempts))
+            while (len(self.samples) > 2
+                   and now - self.samples[1][0] >= self.window):
+                self.samples.popleft()
+
+    def worker_hashrates(self) -> List[float]:
+        """Returns the hashes per second of each worker over the rolling window
+
+        :return: Hashrate per worker
+        :rtype: List[float]
+        """
+        self.sample()
+        with self.samples_lock:
+            first_time, first = self.samples[0]
+            last_time, last = self.samples[-1]
+        taken = last_time - first_time
+        if taken <= 0:
+            return [0.0] * self.workers
+        return [(end - begin)/taken for begin, end in zip(first, last)]
+
+    def hashrate(self) -> float:
+        """Returns the hashes per second of the pool over the rolling window
+
+        :return: Hashrate of all workers
+        :rtype: float
+        """
+        return sum(self.worker_hashrates())
+
+    def telemetry(self) -> Dict:
+        """Returns the counters and hashrates of the pool
+
+        :return: Dict containing total and per worker attempts and hashrates
+        :rtype: Dict
+        """
+        worker_rates = self.worker_hashrates()
+        return {
+            "attempts": self.attempts,
+            "worker_attempts": self.worker_attempts,
+            "hashrate": sum(worker_rates),
+            "worker_hashrates": worker_rates,
+            "window": self.window
+        }
+
+    def cancel(self) -> None:
+        """Stops the search in progress and any job submitted afterwards until
+        resume is called, workers go idle until then
+        """
+        with self.cancel_lock:
+            self.cancelled.set()
+            self.stop_event.set()
+
+    def resume(self) -> None:
+        """Allows jobs to be searched again after cancel
+        """
+        self.cancelled.clear()
+
+    def close(self) -> None:
+        """Stops all the worker processes
+        """
+        self.cancel()
+        for jobs in self.jobs:
+            jobs.put(None)
+        for proc in self.processes:
+            proc.join(timeout=1)
+            if proc.is_alive():
+                proc.terminate()
+        self.processes = []
+
+
+def bench(seconds: float = 10.0, workers: int = 4,
+          transactions: int = 100) -> Dict:
+    """Mines a fixed synthetic block that can never be solved for a set time
+    and reports the hashrate
+
+    :param seconds: How long to mine for, defaults to 10.0
+    :type seconds: float, optional
+    :param workers: Number of worker processes, defaults to 4
+    :type workers: int, optional
+    :param transactions: Number of transactions in the synthetic block,
+    defaults to 100
+    :type transactions: int, optional
+    :return: Telemetry of the pool after the run
+    :rtype: Dict
+    """
+    tran = {"sender": "ab"*294, "receiver": "cd"*294, "value": 5, "data": "",
+            "fee": 0.25, "signature": "ef"*256, "nonce": 0}
+    block = {"parent_block": "0"*64, "timestamp": 0,
+             "transactions": [tran]*transactions}
+    miner = Miner(block, "0"*64, "12"*294, workers)
+    pool = MiningPool(workers, window=seconds)
+    pool.start()
+    try:
+        pool.sample()
+        job_id = pool.submit(miner.prefix, miner.suffix, miner.difficulty)
+        pool.wait(job_id, seconds)
+        stats = pool.telemetry()
+    finally:
+        pool.close()
+    stats["template_bytes"] = len(miner.prefix) + len(miner.suffix)
+    return stats
+
+
+if __name__ == "__main__":
+    import sys
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else mp.cpu_count()
+    print(bench(seconds, workers))
@@ -0,0 +1,21 @@
+"""
+Start method for the worker processes used to mine and to check signatures.
+
+Workers are started by a clean server process instead of being forked from
+the node, which holds threads, locks and database connections a fork would
+copy mid use. Windows only has spawn.
+"""
+import multiprocessing as mp
+
+START_METHOD = ("forkserver" if "forkserver" in mp.get_all_start_methods()
+                else "spawn")
+
+
+def get_context() -> mp.context.BaseContext:
+    """Returns the context worker processes and the queues, events and shared
+    values passed to them are created from
+
+    :return: Multiprocessing context using START_METHOD
+    :rtype: mp.context.BaseContext
+    """
+    return mp.get_context(START_METHOD)
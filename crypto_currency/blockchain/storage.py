@@ -0,0 +1,147 @@
+import queue
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable
+
+
+def writes(func: Callable) -> Callable:
+    """Decorator for methods of objects with a storage attribute that runs the
+    method holding the writer connection
+
+    :param func: Method that writes to the database
+    :type func: Callable
+    :return: Wrapped method
+    :rtype: Callable
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.storage.writing():
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+class Storage():
+    def __init__(self, db: str = "blockchain.db", readers: int = 8) -> None:
+        """Shared access to the blockchain database for every thread in a node.
+        There is one writer connection guarded by a lock and a pool of reader
+        connections, each handed to one thread at a time. The database is put
+        in WAL mode so readers are not blocked by the writer
+
+        :param db: Path to the database, defaults to "blockchain.db"
+        :type db: str, optional
+        :param readers: Number of idle reader connections kept open,
+        defaults to 8
+        :type readers: int, optional
+        """
+        self.db = db
+        self.writer = self.connect()
+        self.writer_cur = self.writer.cursor()
+        self.write_lock = threading.RLock()
+        self.writer_thread = None
+        self.write_depth = 0
+        self.local = threading.local()
+        self.idle = queue.LifoQueue(maxsize=readers)
+        self.tip = None
+
+    def connect(self) -> sqlite3.Connection:
+        """Opens a new connection to the database
+
+        :return: Connection to the database
+        :rtype: sqlite3.Connection
+        """
+        conn = sqlite3.connect(self.db, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        # In WAL mode NORMAL only syncs at checkpoints, a power loss can lose
+        # the latest commits but never corrupts the database
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        return conn
+
+    @property
+    def writing_thread(self) -> bool:
+        """Returns whether the calling thread is currently holding the writer
+
+        :return: True if the calling thread is inside writing()
+        :rtype: bool
+        """
+        return self.writer_thread == threading.get_ident()
+
+    @contextmanager
+    def writing(self) -> Any:
+        """Holds the writer connection for the calling thread, every cursor
+        the thread asks for until the block ends is on the writer
+
+        :yield: The writer connection
+        :rtype: Any
+        """
+        with self.write_lock:
+            self.writer_thread = threading.get_ident()
+            self.write_depth += 1
+            try:
+                yield self.writer
+            finally:
+                self.write_depth -= 1
+                if self.write_depth == 0:
+                    self.writer_thread = None
+
+    def reader(self) -> Any:
+        """Returns the reader connection and cursor of the calling thread,
+        taking one from the pool the first time the thread asks. The
+        connection goes back to the pool when the thread ends
+
+        :return: Tuple of connection and cursor
+        :rtype: Any
+        """
+        reader = getattr(self.local, "reader", None)
+        if reader is None:
+            try:
+                conn = self.idle.get_nowait()
+            except queue.Empty:
+                conn = self.connect()
+            reader = (conn, conn.cursor())
+            self.local.reader = reader
+            weakref.finalize(threading.current_thread(), self.release, conn)
+        return reader
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        """Returns a reader connection to the pool or closes it if the pool is
+        full
+
+        :param conn: Reader connection
+        :type conn: sqlite3.Connection
+        """
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Returns the connection the calling thread should use
+
+        :return: The writer inside writing() and a reader otherwise
+        :rtype: sqlite3.Connection
+        """
+        return self.writer if self.writing_thread else self.reader()[0]
+
+    @property
+    def cur(self) -> sqlite3.Cursor:
+        """Returns the cursor the calling thread should use
+
+        :return: The writer cursor inside writing() and a reader otherwise
+        :rtype: sqlite3.Cursor
+        """
+        return self.writer_cur if self.writing_thread else self.reader()[1]
+
+    def close(self) -> None:
+        """Closes the writer and every idle reader connection
+        """
+        with self.write_lock:
+            self.writer.close()
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
@@ -1,23 +1,157 @@
-import json
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from typing import Any, Dict
 
 from Crypto.Hash import SHA256
 from Crypto.PublicKey import RSA
 from Crypto.Signature.pkcs1_15 import PKCS115_SigScheme
 
+from blockchain.encoding import Encodable, digest_bytes, encode
+
+SIGNATURE_CACHE_SIZE = 100000
+KEY_CACHE_SIZE = 65536
+
+
+class SignatureCache():
+    def __init__(self, size: int) -> None:
+        """Bounded least recently used set of digests of transactions whose
+        signatures have already been verified
+
+        :param size: Maximum number of digests kept
+        :type size: int
+        """
+        self.size = size
+        self.digests = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, digest: str) -> bool:
+        with self.lock:
+            if digest in self.digests:
+                self.digests.move_to_end(digest)
+                return True
+            return False
+
+    def __len__(self) -> int:
+        return len(self.digests)
+
+    def add(self, digest: str) -> None:
+        """Records a transaction digest as verified, evicting the least
+        recently used digest if the cache is full
+
+        :param digest: Digest of the verified transaction
+        :type digest: str
+        """
+        with self.lock:
+            self.digests[digest] = True
+            self.digests.move_to_end(digest)
+            while len(self.digests) > self.size:
+                self.digests.popitem(last=False)
+
+
+verified_signatures = SignatureCache(SIGNATURE_CACHE_SIZE)
+
+
+@lru_cache(maxsize=4096)
+def get_verifier(public_key: str) -> PKCS115_SigScheme:
+    """Parses a public key once and returns a signature verifier for it
+
+    :param public_key: Public key in hex
+    :type public_key: str
+    :return: Verifier for signatures made by the matching private key
+    :rtype: PKCS115_SigScheme
+    """
+    return PKCS115_SigScheme(RSA.import_key(bytes.fromhex(public_key)))
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def shared_key(key: str) -> str:
+    """Returns the first copy seen of an address so every transaction and
+    block from the same account holds one string instead of its own
+
+    :param key: Address in hex
+    :type key: str
+    :return: Equal string shared with other holders of the address
+    :rtype: str
+    """
+    return key
+
+
+def share(key: Any) -> Any:
+    return shared_key(key) if isinstance(key, str) else key
+
+
+def raw_signature(signature: str) -> bytes:
+    """Converts a signature to the bytes it is held as, half the size of
+    the hex. Only lowercase hex is accepted so it converts back exactly and
+    digests and block hashes are unchanged
+
+    :param signature: Signature in hex
+    :type signature: str
+    :raises ValueError: Raised if the signature isn't lowercase hex
+    :return: Signature bytes
+    :rtype: bytes
+    """
+    try:
+        raw = bytes.fromhex(signature)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid signature encoding")
+    if raw.hex() != signature:
+        raise ValueError("Invalid signature encoding")
+    return raw
+
+
+class Transaction(Encodable):
+    FIELDS = frozenset(["sender", "receiver", "value", "data", "fee",
+                        "raw_signature", "nonce"])
+    # Mempools and blocks hold many transactions so they have no __dict__
+    __slots__ = ("sender", "receiver", "value", "data", "fee",
+                 "raw_signature", "nonce", "valid")
 
-class Transaction():
     def __init__(self, sender: str, receiver: str, value: int, data: str,
                  fee: int, signature: str = False, nonce: int = False) -> None:
-        self.sender = sender
-        self.receiver = receiver
+        self.sender = share(sender)
+        self.receiver = share(receiver)
         self.value = value
         self.data = data
         self.fee = fee
-        self.required_value = fee + value
-        self.signed = True if signature and nonce is not False else False
-        self.signature = signature if self.signed else None
-        self.nonce = nonce if self.signed else None
+        signed = True if signature and nonce is not False else False
+        self.raw_signature = raw_signature(signature) if signed else None
+        self.nonce = nonce if signed else None
+
+    @classmethod
+    def from_dict(cls, tran: Dict) -> "Transaction":
+        """Builds a signed transaction from the dict form it is sent and
+        stored in
+
+        :param tran: Signed transaction in dict form
+        :type tran: Dict
+        :raises KeyError: Raised if a field is missing
+        :return: The transaction
+        :rtype: Transaction
+        """
+        return cls(tran["sender"], tran["receiver"], tran["value"],
+                   tran["data"], tran["fee"], tran["signature"],
+                   tran["nonce"])
+
+    @property
+    def signed(self) -> bool:
+        return self.raw_signature is not None
+
+    @property
+    def signature(self) -> str:
+        """Returns the signature in hex
+
+        :return: Signature or None if the transaction isn't signed
+        :rtype: str
+        """
+        if self.raw_signature is None:
+            return None
+        return self.raw_signature.hex()
+
+    @property
+    def required_value(self) -> float:
+        return self.fee + self.value
 
     def tran_dict(self, verify: bool = False) -> Dict:
         tran_props = ["sender", "receiver", "value", "data", "fee"]
@@ -28,6 +162,49 @@ class Transaction():
             tran_dict[prop] = getattr(self, prop)
         return tran_dict
 
+    @property
+    def encoded(self) -> bytes:
+        """Returns the canonical bytes of the signed transaction, the form it
+        is stored in the mempool and hashed as
+
+        :return: Encoded transaction
+        :rtype: bytes
+        """
+        return self.cached("encoded", lambda: encode(self.tran_dict()))
+
+    @property
+    def digest(self) -> str:
+        """Returns the SHA256 of the signed transaction, used to identify it
+
+        :return: Hex digest of the transaction
+        :rtype: str
+        """
+        return self.cached("digest", lambda: digest_bytes(self.encoded))
+
+    @property
+    def size(self) -> int:
+        """Returns the length of the encoded transaction
+
+        :return: Size in bytes
+        :rtype: int
+        """
+        return self.cached("size", lambda: len(self.encoded))
+
+    def signing_hash(self, nonce: int) -> SHA256.SHA256Hash:
+        """Returns the hash that is signed, the transaction with a nonce and
+        without a signature
+
+        :param nonce: Nonce the transaction is signed with
+        :type nonce: int
+        :return: SHA256 of the unsigned transaction
+        :rtype: SHA256.SHA256Hash
+        """
+        def build():
+            tran_data = self.tran_dict(verify=True)
+            tran_data["nonce"] = nonce
+            return encode(tran_data)
+        return SHA256.new(self.cached(("signing", nonce), build))
+
     def sign(self, priv_string: str, nonce: int) -> None:
         """Takes in private key and signs the transaction to prove it was
            sent by the owner of the account
@@ -38,35 +215,33 @@ class Transaction():
         :type nonce: int
         """
         if not self.signed:
-            tran_data = self.tran_dict(verify=True).copy()
-            tran_data["nonce"] = nonce
-            transaction_string = json.dumps(tran_data, sort_keys=True)
             priv_key = RSA.import_key(bytes.fromhex(priv_string))
             signer = PKCS115_SigScheme(priv_key)
-            tran_hash = SHA256.new(transaction_string.encode("UTF-8"))
-            signature = signer.sign(tran_hash)
-            self.signature = signature.hex()
+            self.raw_signature = signer.sign(self.signing_hash(nonce))
             self.nonce = nonce
-            self.signed = True
 
     def verify_signature(self) -> bool:
-        """Checks if the signature of the transaction is valid
+        """Checks if the signature of the transaction is valid, signatures
+        that have been verified before are looked up in the cache
 
-        :return: Returns True if it is a valid signature and False if not
+        :raises ValueError: Raised if the signature is invalid
+        :return: Returns True if it is a valid signature
         :rtype: bool
         """
-        tran_dict = self.tran_dict(verify=True)
-        tran_dict["nonce"] = self.nonce
-        transaction_string = json.dumps(tran_dict, sort_keys=True)
-        tran_hash = SHA256.new(transaction_string.encode("UTF-8"))
-        pub_key = RSA.import_key(bytes.fromhex(self.sender))
-        verifier = PKCS115_SigScheme(pub_key)
+        digest = self.digest
+        if digest in verified_signatures:
+            self.valid = True
+            return True
         try:
-            verifier.verify(tran_hash, bytes.fromhex(self.signature))
+            verifier = get_verifier(self.sender)
+            verifier.verify(self.signing_hash(self.nonce),
+                            self.raw_signature)
             self.valid = True
-        except ValueError:
+        except (ValueError, TypeError):
             self.valid = False
             raise ValueError("Invalid transaction signature")
+        verified_signatures.add(digest)
+        return True
 
     def __iter__(self) -> Any:
         """Returns transaction in iter format for inserting into DB
@@ -0,0 +1,114 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Dict, List
+
+from blockchain.block import BLOCK_VERSION, Block
+from blockchain.processes import get_context
+from blockchain.transaction import Transaction, verified_signatures
+
+
+def verify_batch(transactions: List) -> int:
+    """Verifies the signatures of a batch of transactions in a worker process
+
+    :param transactions: Transactions in tuple form
+    :type transactions: List
+    :return: Position of the first invalid transaction in the batch or -1 if
+    they are all valid
+    :rtype: int
+    """
+    for idx, tran in enumerate(transactions):
+        tran_obj = Transaction(*tran)
+        try:
+            tran_obj.verify_signature()
+        except ValueError:
+            return idx
+    return -1
+
+
+class BlockValidator():
+    def __init__(self, workers: int = 4, min_parallel: int = 16) -> None:
+        """Spreads the signature checks of a block across a pool of processes
+
+        :param workers: Number of worker processes, defaults to 4
+        :type workers: int, optional
+        :param min_parallel: Blocks with fewer unverified transactions than
+        this are checked in the calling thread, defaults to 16
+        :type min_parallel: int, optional
+        """
+        self.workers = workers
+        self.min_parallel = min_parallel
+        self.pool = ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=get_context())
+
+    def verify_signatures(self, transactions: List[Transaction]) -> bool:
+        """Checks every signature in a block and stops at the first invalid
+        one. Transactions already in the verified signature cache are skipped
+        and the rest are added to it when they all pass
+
+        :param transactions: Transactions to check
+        :type transactions: List[Transaction]
+        :return: True if every signature is valid
+        :rtype: bool
+        """
+        pending = []
+        for tran in transactions:
+            digest = tran.digest
+            if digest not in verified_signatures:
+                pending.append((digest, tuple(tran)))
+        if len(pending) < self.min_parallel:
+            return verify_batch([i[1] for i in pending]) == -1
+
+        batch_size = max(1, len(pending) // (self.workers * 4))
+        futures = set()
+        for idx in range(0, len(pending), batch_size):
+            batch = [i[1] for i in pending[idx:idx+batch_size]]
+            futures.add(self.pool.submit(verify_batch, batch))
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.result() != -1:
+                    for remaining in futures:
+                        remaining.cancel()
+                    return False
+        for digest, _ in pending:
+            verified_signatures.add(digest)
+        return True
+
+    def close(self) -> None:
+        """Shuts down the worker processes
+        """
+        self.pool.shutdown(cancel_futures=True)
+
+
+def build_block(block: Dict, validator: BlockValidator = None,
+                verify: bool = True) -> Block:
+    """Builds a Block from the dict form it is sent between peers in. The
+    signatures are checked first, in parallel if there is a validator, so
+    Block only has to look them up in the verified signature cache before
+    checking the hash
+
+    :param block: Block in dict form
+    :type block: Dict
+    :param validator: Validator used to check signatures, defaults to None
+    :type validator: BlockValidator, optional
+    :param verify: Whether to check the block at all, defaults to True
+    :type verify: bool, optional
+    :raises ValueError: Raised if the block is malformed, a signature is
+    invalid or the merkle root is wrong
+    :return: The block
+    :rtype: Block
+    """
+    try:
+        transactions = [Transaction.from_dict(tran)
+                        for tran in block["transactions"]]
+        if verify and validator is not None:
+            if not validator.verify_signatures(transactions):
+                raise ValueError("Invalid transaction signature in block")
+        block_obj = Block(block["parent_block"], block["timestamp"],
+                          transactions, block["hash"], block["nonce"],
+                          block["coinbase"], verify=verify,
+                          version=block.get("version", BLOCK_VERSION))
+        if block.get("merkle_root") != block_obj.merkle_root:
+            raise ValueError("Merkle root doesn't match transactions")
+        return block_obj
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Invalid block {e}")
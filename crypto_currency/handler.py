@@ -1,7 +1,14 @@
+import threading
+import time
+from collections import OrderedDict
+
 from blockchain.transaction import Transaction
-from blockchain.block import Block
 from blockchain.blockchain import Blockchain
+from blockchain.encoding import digest
+from blockchain.validation import BlockValidator, build_block
+from p2p.inventory import KINDS, MAX_ITEMS
 from p2p.node import Node
+from sync import ChainSync, serve_blocks, serve_headers
 
 """
 msg format
@@ -12,72 +19,268 @@ msg format
 }
 """
 
+# Messages carrying a transaction or block, the ones worth remembering
+PAYLOAD_TYPES = ["add_transaction", "new_block"]
+
+
+class SeenMessages():
+    def __init__(self, max_size: int = 100000, ttl: float = 600) -> None:
+        """Bounded set of digests of messages that have already been handled
+        so the same transaction or block relayed by several peers is only
+        verified once. Digests are forgotten after ttl seconds or once the
+        set is full, oldest first
+
+        :param max_size: Maximum number of digests kept, defaults to 100000
+        :type max_size: int, optional
+        :param ttl: Seconds a digest is remembered for, defaults to 600
+        :type ttl: float, optional
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.digests = OrderedDict()  # digest -> time first seen
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.digests)
+
+    @staticmethod
+    def digest(msg: dict) -> str:
+        """Returns the digest of a message's type and payload, the node it
+        came from isn't included so relays of the same payload match
+
+        :param msg: Message received
+        :type msg: dict
+        :return: Hex SHA256 of the type and payload
+        :rtype: str
+        """
+        return digest([msg["type"], msg["data"]])
+
+    def add(self, digest: str) -> bool:
+        """Records a message as seen
+
+        :param digest: Digest of the message
+        :type digest: str
+        :return: False if it had already been seen
+        :rtype: bool
+        """
+        now = time.monotonic()
+        with self.lock:
+            while self.digests:
+                oldest, seen_at = next(iter(self.digests.items()))
+                if now - seen_at < self.ttl:
+                    break
+                del self.digests[oldest]
+            if digest in self.digests:
+                return False
+            self.digests[digest] = now
+            while len(self.digests) > self.max_size:
+                self.digests.popitem(last=False)
+            return True
+
+    def forget(self, digest: str) -> None:
+        """Removes a digest so the message is handled again if it is relayed
+        once more, used when handling it failed
+
+        :param digest: Digest of the message
+        :type digest: str
+        """
+        with self.lock:
+            self.digests.pop(digest, None)
+
 
 class Handler():
-    def __init__(self, msg, blockchain: Blockchain, node: Node, log) -> None:
+    def __init__(self, msg, blockchain: Blockchain, node: Node, log,
+                 validator: BlockValidator = None,
+                 seen: SeenMessages = None, sync: ChainSync = None) -> None:
         self.msg = msg
         self.log = log
-        self.blockchain = Blockchain(self.log, blockchain)
+        self.blockchain = blockchain
         self.node = node
+        self.validator = validator
+        self.seen = seen
+        self.sync = sync
+        self.digest = None  # Set while a payload message is being handled
         self.parse_msg()
 
+    def duplicate(self) -> bool:
+        """Checks the message against the messages already handled, before
+        any transaction or block objects are built from it. The digest is
+        recorded straight away so copies arriving while this one is handled
+        are dropped, parse_msg forgets it again if handling fails
+
+        :return: True if the same payload has already been handled
+        :rtype: bool
+        """
+        if self.seen is None or self.msg["type"] not in PAYLOAD_TYPES:
+            return False
+        try:
+            digest = self.seen.digest(self.msg)
+        except (KeyError, TypeError, ValueError):
+            return False  # Left for the handler to reject
+        if not self.seen.add(digest):
+            return True
+        self.digest = digest
+        return False
+
     def add_transaction(self):
-        tran = self.msg["data"]
-        tran_obj = Transaction(tran["sender"], tran["receiver"], tran["value"],
-                               tran["data"], tran["fee"], tran["signature"],
-                               tran["nonce"])
+        tran_obj = Transaction.from_dict(self.msg["data"])
         tran_obj.verify_signature()
         if tran_obj.valid is True:
-            if self.blockchain.add_to_mempool(tran):
-                new_msg = self.msg.copy()
-                new_msg["node_id"] = self.node.id
-                self.node.send_all(new_msg, exclude=[self.msg["node_id"]])
+            digest = tran_obj.digest
+            self.node.received(self.msg["node_id"], "transactions", digest)
+            if self.blockchain.add_to_mempool(tran_obj):
+                self.node.announce("transactions", [digest])
             return True
         else:
             self.log("handler.py", "ERORR", "Invalid transaction")
             return False  # Invalid transaction received
 
     def add_block(self):
-        block = self.msg["data"]
-        transaction_dicts = self.msg["data"]["transactions"]
-        transactions = []
-        for tran in transaction_dicts:
-            tran_obj = Transaction(tran["sender"], tran["receiver"],
-                                   tran["value"], tran["data"], tran["fee"],
-                                   tran["signature"], tran["nonce"])
-            tran_obj.verify_signature()
-            transactions.append(tuple(tran_obj))
-        block_obj = Block(block["parent_block"], block["timestamp"],
-                          transactions,
-                          block["hash"], block["nonce"], block["coinbase"])
+        try:
+            block_obj = build_block(self.msg["data"], self.validator)
+        except ValueError as e:
+            self.log("handler.py", "ERROR", f"Invalid block {e}")
+            return False
         if block_obj.verify() is True:
             try:
+                self.node.received(self.msg["node_id"], "blocks",
+                                   block_obj.hash)
                 self.blockchain.add_block(block_obj)
-                new_msg = self.msg.copy()
-                new_msg["node_id"] = self.node.id
-                self.node.send_all(new_msg, exclude=[self.msg["node_id"]])
+                # Blocks that only went on a side chain aren't passed on
+                if self.blockchain.prev_hash == block_obj.hash:
+                    self.node.announce("blocks", [block_obj.hash])
                 return True
             except ValueError:
+                if (self.sync is not None and not
+                        self.blockchain.has_block(block_obj.parent_block)):
+                    # The peer is ahead, find out by how much
+                    self.sync.request_tip(self.msg["node_id"])
                 return False
         else:
             return False  # Invalid Block
 
+    def inventory(self):
+        # Digests announced or requested by the peer keyed by kind
+        data = self.msg["data"]
+        return {kind: data[kind][:MAX_ITEMS] for kind in KINDS
+                if isinstance(data.get(kind), list)}
+
+    def inv(self):
+        announced = self.inventory()
+        conn = self.node.peer(self.msg["node_id"])
+        if conn is None:
+            return
+        for digests in announced.values():
+            conn.known.add(digests)
+        wanted = {}
+        if "transactions" in announced:
+            wanted["transactions"] = [
+                i for i in announced["transactions"]
+                if i not in self.blockchain.mempool]
+        if "blocks" in announced:
+            wanted["blocks"] = [i for i in announced["blocks"]
+                                if not self.blockchain.has_block(i)]
+        self.node.request(self.msg["node_id"], wanted)
+
+    def getdata(self):
+        requested = self.inventory()
+        conn = self.node.peer(self.msg["node_id"])
+        if conn is None:
+            return
+        for digest in requested.get("transactions", []):
+            tran = self.blockchain.mempool.get(digest)
+            if tran is not None:
+                conn.known.add([digest])
+                conn.send({
+                    "type": "add_transaction",
+                    "data": tran.tran_dict(),
+                    "node_id": self.node.id
+                })
+        for block_hash in requested.get("blocks", []):
+            if self.blockchain.has_block(block_hash):
+                conn.known.add([block_hash])
+                conn.send({
+                    "type": "new_block",
+                    "data": dict(self.blockchain.get_block(block_hash)),
+                    "node_id": self.node.id
+                })
+
+    def send_tip(self):
+        tip = self.blockchain.tip
+        self.node.send(self.msg["node_id"], {
+            "type": "tip",
+            "data": {
+                "height": tip.height if tip is not None else -1,
+                "hash": tip.hash if tip is not None else None,
+                "work": tip.work if tip is not None else 0
+            },
+            "node_id": self.node.id
+        })
+
+    def send_headers(self):
+        start, headers = serve_headers(self.blockchain, self.msg["data"])
+        self.node.send(self.msg["node_id"], {
+            "type": "headers",
+            "data": {
+                "start": start,
+                "headers": headers
+            },
+            "node_id": self.node.id
+        })
+
+    def send_blocks(self):
+        self.node.send(self.msg["node_id"], {
+            "type": "blocks",
+            "data": {
+                "start": self.msg["data"]["start"],
+                "blocks": serve_blocks(self.blockchain, self.msg["data"])
+            },
+            "node_id": self.node.id
+        })
+
     def disconnect(self):
+        # The connection removes itself from the node once it has closed
         for conn in self.node.total_nodes:
             if conn.id == self.msg["node_id"]:
                 conn.stop()
-                if conn in self.node.inbound:
-                    self.node.inbound.remove(conn)
-                elif conn in self.node.outbound:
-                    self.node.outbound.remove(conn)
 
     def parse_msg(self):
-        match self.msg["type"]:
-            case "add_transaction":
-                self.add_transaction()
-                self.log("handler.py", "INFO", "New transaction received")
-            case "new_block":
-                self.add_block()
-                self.log("handler.py", "INFO", "New block received")
-            case "disconnect":
-                self.disconnect()
+        if self.duplicate():
+            self.log("handler.py", "INFO",
+                     f"Dropped duplicate {self.msg['type']}")
+            return
+        handled = False
+        try:
+            match self.msg["type"]:
+                case "add_transaction":
+                    handled = self.add_transaction()
+                    self.log("handler.py", "INFO",
+                             "New transaction received")
+                case "new_block":
+                    handled = self.add_block()
+                    self.log("handler.py", "INFO", "New block received")
+                case "inv":
+                    self.inv()
+                case "getdata":
+                    self.getdata()
+                case "get_tip":
+                    self.send_tip()
+                case "get_headers":
+                    self.send_headers()
+                case "get_blocks":
+                    self.send_blocks()
+                case "tip" if self.sync is not None:
+                    self.sync.tip(self.msg["node_id"], self.msg["data"])
+                case "headers" if self.sync is not None:
+                    self.sync.receive_headers(self.msg["node_id"],
+                                              self.msg["data"])
+                case "blocks" if self.sync is not None:
+                    self.sync.receive_blocks(self.msg["node_id"],
+                                             self.msg["data"])
+                case "disconnect":
+                    self.disconnect()
+        finally:
+            # A payload that failed, possibly for a reason that has since
+            # passed, is handled again when a peer relays it once more
+            if not handled and self.digest is not None:
+                self.seen.forget(self.digest)
@@ -1,11 +1,15 @@
 from p2p.node import Node
 from web_api import main
-from handler import Handler
+from handler import Handler, SeenMessages
 from datetime import datetime
 import atexit
 import os
+import threading
 from blockchain.blockchain import Blockchain
+from blockchain.storage import Storage
+from blockchain.validation import BlockValidator
 from miner import minerAgent
+from sync import ChainSync
 
 
 class cryptoNode():
@@ -15,7 +19,12 @@ class cryptoNode():
                             ("crypto.morgan-thomas.co.uk", 14067)],
                  verbose=3, log_file=f"{os.getcwd()}/crypto.log",
                  max_connections=0, blockchain="blockchain.db", api=True,
-                 web_port=5555, miner=False, miner_addr=None) -> None:
+                 web_port=5555, miner=False, miner_addr=None,
+                 validation_workers=4, mempool_size=50000,
+                 keep_mempool=False, miner_batch_delay=0.5,
+                 miner_max_latency=5.0, seen_messages=100000,
+                 seen_ttl=600, handler_workers=4, handler_queue=1024,
+                 peer_queue=64, block_version=1) -> None:
         self.verbose = verbose
         self.log_file = log_file
 
@@ -24,37 +33,63 @@ class cryptoNode():
 
         self.miner = miner
         self.miner_addr = miner_addr
+        self.miner_agent = None
+        self.miner_batch_delay = miner_batch_delay
+        self.miner_max_latency = miner_max_latency
+        self.block_version = block_version
 
         if self.web_api and self.miner:
             raise ValueError("Cannot have miner and web api enabled")
 
+        self.validator = BlockValidator(validation_workers)
+        self.seen = SeenMessages(seen_messages, seen_ttl)
+
         self.node = Node(host, port, self.handler, bootstrap, max_connections,
-                         self.log)
+                         self.log, handler_workers=handler_workers,
+                         max_queue=handler_queue, max_pending=peer_queue)
 
-        self.blockchain = blockchain
+        self.keep_mempool = keep_mempool
+        self.storage = Storage(blockchain)
+        self.blockchain = Blockchain(self.log, self.storage, mempool_size)
         self.init_blockchain()
+        self.sync = ChainSync(self.blockchain, self.node, self.log,
+                              self.validator)
 
     def init_blockchain(self):
-        blockchain = Blockchain(self.log)
-        blockchain.flush_mempool()
+        if self.keep_mempool:
+            self.blockchain.load_mempool()
+        else:
+            self.blockchain.flush_mempool()
 
     def handler(self, msg) -> None:
-        Handler(msg, self.blockchain, self.node, self.log)
+        Handler(msg, self.blockchain, self.node, self.log, self.validator,
+                self.seen, self.sync)
 
     def start(self):
         atexit.register(self.stop)
         self.node.start()
+        threading.Thread(target=self.sync.start, daemon=True).start()
         if self.web_api:
             app = main.create_app(self.blockchain, self.node, self.log)
             app.run(port=self.web_port)
         elif self.miner:
-            miner = minerAgent(self.blockchain, self.log,
-                               self.miner_addr, self.node)
-            miner.start()
+            self.miner_agent = minerAgent(
+                self.blockchain, self.log, self.miner_addr, self.node,
+                batch_delay=self.miner_batch_delay,
+                max_latency=self.miner_max_latency,
+                block_version=self.block_version)
+            self.miner_agent.start()
 
     def stop(self):
+        if self.miner_agent is not None:
+            self.miner_agent.stop()
+        self.sync.stop()
         self.node.stop()
         self.node.join()
+        self.validator.close()
+        if self.keep_mempool:
+            self.blockchain.save_mempool()
+        self.storage.close()
 
     def log(self, event_location, event_type, event):
         log_msg = f"{str(datetime.utcnow())} || {event_type} @ {event_location} > {event}"
@@ -1,29 +1,188 @@
+import threading
 import time
+from typing import List
 
-from blockchain.block import Block
+from blockchain.block import BLOCK_VERSION, Block
 from blockchain.blockchain import Blockchain
-from blockchain.miner import Miner
+from blockchain.miner import Miner, MiningPool
 from blockchain.transaction import Transaction
 
 
+class BlockTemplate():
+    def __init__(self, blockchain: Blockchain, max_bytes: int = 1000000,
+                 max_transactions: int = 2000,
+                 version: int = BLOCK_VERSION) -> None:
+        """Set of mempool transactions for the next block, chosen by fee rate
+        and checked against a working copy of the account state so that the
+        mined block is accepted by Blockchain.add_block
+
+        :param blockchain: Blockchain the block will be added to
+        :type blockchain: Blockchain
+        :param max_bytes: Maximum total size of the transactions in JSON,
+        defaults to 1000000
+        :type max_bytes: int, optional
+        :param max_transactions: Maximum number of transactions, defaults to
+        2000
+        :type max_transactions: int, optional
+        :param version: Format of the blocks created, defaults to
+        BLOCK_VERSION
+        :type version: int, optional
+        """
+        self.blockchain = blockchain
+        self.max_bytes = max_bytes
+        self.max_transactions = max_transactions
+        self.version = version
+        self.lock = threading.RLock()
+        self.rebuild()
+
+    def rebuild(self) -> None:
+        """Starts a new template on the current chain tip, filling it with the
+        highest fee rate transactions that fit and are valid. Transactions
+        whose nonce has already been used are dropped from the mempool
+        """
+        with self.lock:
+            self.parent_block = self.blockchain.prev_hash
+            self.transactions = []
+            self.digests = set()
+            self.size = 0
+            self.accounts = {}
+            stale = []
+            for tran in self.blockchain.mempool.by_fee():
+                if self.full:
+                    break
+                if tran.nonce < self.account(tran.sender)[1]:
+                    stale.append(tran)
+                    continue
+                self.try_add(tran)
+            self.blockchain.mempool.remove(stale)
+
+    @property
+    def full(self) -> bool:
+        return (len(self.transactions) >= self.max_transactions
+                or self.size >= self.max_bytes)
+
+    def account(self, addr: str) -> List:
+        """Returns the working balance and nonce of an account, loading it
+        from the blockchain the first time
+
+        :param addr: Address of the account
+        :type addr: str
+        :return: List of balance and nonce
+        :rtype: List
+        """
+        if addr not in self.accounts:
+            try:
+                balance = self.blockchain.get_balance(addr)
+            except ValueError:
+                balance = 0.0
+            self.accounts[addr] = [balance,
+                                   self.blockchain.get_tran_nonce(addr)]
+        return self.accounts[addr]
+
+    def try_add(self, tran_obj: Transaction) -> bool:
+        """Adds a transaction to the template if it fits, pays the right fee,
+        has the sender's next nonce and the sender can afford it
+
+        :param tran_obj: Signed transaction from the mempool
+        :type tran_obj: Transaction
+        :return: Whether or not it was added
+        :rtype: bool
+        """
+        with self.lock:
+            size = tran_obj.size
+            if (len(self.transactions) >= self.max_transactions
+                    or self.size + size > self.max_bytes):
+                return False
+            if tran_obj.digest in self.digests:
+                return False
+            if tran_obj.fee != (tran_obj.value*0.05):
+                return False
+            sender = self.account(tran_obj.sender)
+            if tran_obj.nonce != sender[1]:
+                return False
+            if sender[0] < tran_obj.required_value:
+                return False
+            sender[0] -= tran_obj.required_value
+            sender[1] += 1
+            if tran_obj.receiver != tran_obj.sender:
+                self.account(tran_obj.receiver)[0] += tran_obj.value
+            self.transactions.append(tran_obj)
+            self.digests.add(tran_obj.digest)
+            self.size += size
+            return True
+
+    def add(self, tran: Transaction) -> None:
+        """Called when a transaction arrives in the mempool, adds it to the
+        template unless the template is for an old chain tip
+
+        :param tran: Signed transaction
+        :type tran: Transaction
+        """
+        with self.lock:
+            if self.parent_block == self.blockchain.prev_hash:
+                self.try_add(tran)
+
+    def refresh(self) -> None:
+        """Rebuilds the template if the chain tip has moved since it was built
+        """
+        with self.lock:
+            if self.parent_block != self.blockchain.prev_hash:
+                self.rebuild()
+
+    def create_block(self) -> Block:
+        """Returns an unmined block containing the template's transactions,
+        rebuilding the template first if the chain tip has moved
+
+        :return: Block to be mined
+        :rtype: Block
+        """
+        with self.lock:
+            self.refresh()
+            return Block(self.parent_block, time.time(),
+                         list(self.transactions), version=self.version)
+
+
 class minerAgent():
-    def __init__(self, blockchain, log_func, miner_addr, node) -> None:
-        self.blockchain = Blockchain(log_func, db=blockchain)
+    def __init__(self, blockchain, log_func, miner_addr, node,
+                 workers=4, max_block_bytes=1000000,
+                 max_block_transactions=2000, batch_delay=0.5,
+                 max_latency=5.0, block_version=BLOCK_VERSION) -> None:
+        self.blockchain = blockchain
         self.miner_addr = miner_addr
         self.log = log_func
         self.node = node
+        self.pool = MiningPool(workers)
+        self.hash_speed = 0.0
+        self.template = BlockTemplate(blockchain, max_block_bytes,
+                                      max_block_transactions, block_version)
+        self.mining_parent = None
+        # Mining starts once no transaction has arrived for batch_delay
+        # seconds or max_latency seconds after the first one waiting
+        self.batch_delay = batch_delay
+        self.max_latency = max_latency
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        self.blockchain.mempool.subscribe(self.new_transaction)
+        self.blockchain.subscribe_tip(self.new_tip)
+
+    def new_transaction(self, tran):
+        self.template.add(tran)
+        self.wake.set()
 
-    def create_block(self, transaction_dicts):
-        transaction_dicts = transaction_dicts
-        transactions = []
-        parent_block = self.blockchain.prev_hash
-        for tran in transaction_dicts:
-            tran_obj = Transaction(tran["sender"], tran["receiver"],
-                                   tran["value"], tran["data"], tran["fee"],
-                                   tran["signature"], tran["nonce"])
-            transactions.append(tuple(tran_obj))
-        proposed_block = Block(parent_block, time.time(), transactions)
-        self.log("miner.py", "INFO", "Created block")
+    def new_tip(self, tip):
+        # Any search in progress is building on the old tip and can never be
+        # added so it is abandoned, the template is rebuilt next round
+        if self.mining_parent is not None and tip.hash != self.mining_parent:
+            self.pool.cancel()
+            self.log("miner.py", "INFO",
+                     f"Chain tip moved to {tip.hash}, abandoned mining")
+        self.wake.set()
+
+    def create_block(self):
+        proposed_block = self.template.create_block()
+        self.log("miner.py", "INFO",
+                 f"Created block with {len(proposed_block.transactions)} "
+                 "transactions")
         return proposed_block
 
     def mine_block(self, block: Block):
@@ -32,30 +191,85 @@ class minerAgent():
         else:
             difficulty = "0000"
         miner = Miner(dict(block), difficulty, self.miner_addr)
+        # Tips only change holding the writer, so after this either the tip
+        # has already moved or new_tip will see mining_parent and cancel
+        with self.blockchain.storage.writing():
+            if block.parent_block != self.blockchain.prev_hash:
+                return None
+            self.pool.resume()
+            self.mining_parent = block.parent_block
         self.log("miner.py", "INFO", "Started mining block")
-        miner.mine_block()
+        try:
+            mined = miner.mine_block(pool=self.pool)
+        finally:
+            self.mining_parent = None
+        if not mined:
+            return None
         block.christen(miner.hash, miner.nonce, self.miner_addr)
-        self.log("miner.py", "INFO", f"Mined block @ {miner.hash_speed}H/s")
+        self.hash_speed = miner.hash_speed
+        self.log("miner.py", "INFO",
+                 f"Mined block @ {miner.hash_speed:.0f}H/s "
+                 f"({miner.attempts} hashes)")
         return block
 
-    def share_block(self, block):
-        block_dict = dict(block)
-        self.node.send_all(block_dict)
+    def share_block(self, block: Block):
+        # Peers are sent the hash and fetch the block if they don't have it
+        self.node.announce("blocks", [block.hash])
+
+    @property
+    def hashrate(self):
+        return self.pool.hashrate()
+
+    def telemetry(self):
+        stats = self.pool.telemetry()
+        stats["last_block_hash_speed"] = self.hash_speed
+        return stats
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+        self.pool.close()
+
+    def wait_for_batch(self):
+        """Waits for transactions to stop arriving so they are mined together,
+        never waiting more than max_latency in total
+        """
+        deadline = time.time() + self.max_latency
+        while not self.stopped.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            self.wake.clear()
+            if not self.wake.wait(min(self.batch_delay, remaining)):
+                return
 
     def start(self):
-        counter = 0
-        while True:
-            time.sleep(1)
-            counter += 1
-            if counter == 15:
-                counter = 0
-                if self.blockchain.mem_pool != []:
-                    transactions = self.blockchain.mem_pool
-                    proposed_block = self.create_block(transactions)
-                    mined_block = self.mine_block(proposed_block)
-                    self.blockchain.add_block(mined_block)
-                    self.share_block({
-                        "type": "new_block",
-                        "data": dict(mined_block),
-                        "node_id": self.node.id
-                    })
+        self.pool.start()
+        self.wake.set()
+        while not self.stopped.is_set():
+            self.wake.wait()
+            self.wake.clear()
+            if self.stopped.is_set():
+                break
+            self.template.refresh()
+            if not self.template.transactions:
+                continue
+            self.wait_for_batch()
+            proposed_block = self.create_block()
+            mined_block = self.mine_block(proposed_block)
+            if mined_block is None:
+                continue  # The tip moved, new_tip has woken the loop
+            try:
+                self.blockchain.add_block(mined_block)
+            except ValueError as e:
+                # Mining the same transactions again would be rejected the
+                # same way so the loop waits for the next event
+                self.log("miner.py", "ERROR", f"Mined block rejected {e}")
+                self.template.rebuild()
+                continue
+            # Go round again straight away in case there is more to mine
+            self.wake.set()
+            if self.blockchain.prev_hash != mined_block.hash:
+                self.log("miner.py", "INFO", "Mined block is on a side chain")
+                continue
+            self.share_block(mined_block)
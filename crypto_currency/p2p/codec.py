@@ -0,0 +1,179 @@
+"""
+Compact binary encoding for messages, it round trips anything JSON can so
+block hashes and signatures computed over the JSON form stay the same.
+
+Every value starts with a one byte tag
+    N None, T True, F False
+    i signed 64 bit int, I int too big for 64 bits as a decimal string
+    d 64 bit float
+    h lowercase hex string sent as raw bytes, s UTF-8 string
+    l list, m map
+    k map key from KEYS sent as one byte
+Strings, bytes, lists and maps are prefixed with their length as an unsigned
+32 bit int.
+"""
+import struct
+from typing import Any, Tuple
+
+
+# Keys used by blocks, transactions and protocol messages, sent as an index
+KEYS = ["type", "data", "node_id", "sender", "receiver", "value", "fee",
+        "signature", "nonce", "parent_block", "timestamp", "transactions",
+        "hash", "coinbase", "id", "clients", "act_host", "formats",
+        "blocks", "start", "count", "headers", "height", "work",
+        "locator", "version", "merkle_root"]
+KEY_INDEX = {key: idx for idx, key in enumerate(KEYS)}
+HEX_CHARS = frozenset("0123456789abcdef")
+
+LENGTH = struct.Struct(">I")
+INT = struct.Struct(">q")
+FLOAT = struct.Struct(">d")
+
+
+def is_hex(value: str) -> bool:
+    """Returns whether a string can be sent as raw bytes and turned back into
+    exactly the same string
+
+    :param value: String to check
+    :type value: str
+    :return: True if it is non empty, even length lowercase hex
+    :rtype: bool
+    """
+    return (len(value) >= 2 and len(value) % 2 == 0
+            and HEX_CHARS.issuperset(value))
+
+
+def encode_value(value: Any, out: bytearray) -> None:
+    """Appends the encoding of a JSON compatible value to a buffer
+
+    :param value: Value to encode
+    :type value: Any
+    :param out: Buffer to append to
+    :type out: bytearray
+    :raises ValueError: Raised if the value can't be encoded
+    """
+    if value is None:
+        out += b"N"
+    elif value is True:
+        out += b"T"
+    elif value is False:
+        out += b"F"
+    elif isinstance(value, int):
+        if -2**63 <= value < 2**63:
+            out += b"i"
+            out += INT.pack(value)
+        else:
+            digits = str(value).encode("UTF-8")
+            out += b"I" + LENGTH.pack(len(digits)) + digits
+    elif isinstance(value, float):
+        out += b"d"
+        out += FLOAT.pack(value)
+    elif isinstance(value, str):
+        if is_hex(value):
+            raw = bytes.fromhex(value)
+            out += b"h"
+        else:
+            raw = value.encode("UTF-8")
+            out += b"s"
+        out += LENGTH.pack(len(raw))
+        out += raw
+    elif isinstance(value, (list, tuple)):
+        out += b"l" + LENGTH.pack(len(value))
+        for item in value:
+            encode_value(item, out)
+    elif isinstance(value, dict):
+        out += b"m" + LENGTH.pack(len(value))
+        for key, item in value.items():
+            if key in KEY_INDEX:
+                out += b"k" + bytes((KEY_INDEX[key],))
+            else:
+                encode_value(str(key), out)
+            encode_value(item, out)
+    else:
+        raise ValueError(f"Unable to encode {type(value)}")
+
+
+def decode_value(view: memoryview, pos: int) -> Tuple[Any, int]:
+    """Decodes one value from a buffer without copying the buffer
+
+    :param view: View of the encoded message
+    :type view: memoryview
+    :param pos: Position the value starts at
+    :type pos: int
+    :raises ValueError: Raised if the data is invalid
+    :return: The value and the position after it
+    :rtype: Tuple[Any, int]
+    """
+    tag = view[pos]
+    pos += 1
+    if tag == 0x4e:  # N
+        return None, pos
+    elif tag == 0x54:  # T
+        return True, pos
+    elif tag == 0x46:  # F
+        return False, pos
+    elif tag == 0x69:  # i
+        return INT.unpack_from(view, pos)[0], pos + 8
+    elif tag == 0x64:  # d
+        return FLOAT.unpack_from(view, pos)[0], pos + 8
+    elif tag == 0x6b:  # k
+        return KEYS[view[pos]], pos + 1
+    length = LENGTH.unpack_from(view, pos)[0]
+    pos += 4
+    if tag == 0x68:  # h
+        return view[pos:pos+length].hex(), pos + length
+    elif tag == 0x73:  # s
+        return str(view[pos:pos+length], "UTF-8"), pos + length
+    elif tag == 0x49:  # I
+        return int(str(view[pos:pos+length], "UTF-8")), pos + length
+    elif tag == 0x6c:  # l
+        items = []
+        for _ in range(length):
+            item, pos = decode_value(view, pos)
+            items.append(item)
+        return items, pos
+    elif tag == 0x6d:  # m
+        items = {}
+        for _ in range(length):
+            key, pos = decode_value(view, pos)
+            # Keys are always sent as strings, anything else can't be a
+            # dict key or is from a malformed frame
+            if not isinstance(key, str):
+                raise ValueError("Invalid map key")
+            items[key], pos = decode_value(view, pos)
+        return items, pos
+    raise ValueError(f"Unknown tag {tag}")
+
+
+def encode_message(msg: dict) -> bytes:
+    """Encodes a message as a length prefixed binary frame
+
+    :param msg: Message to encode
+    :type msg: dict
+    :return: Frame ready to be sent
+    :rtype: bytes
+    """
+    out = bytearray(4)
+    encode_value(msg, out)
+    LENGTH.pack_into(out, 0, len(out) - 4)
+    return bytes(out)
+
+
+def decode_message(payload: bytes) -> dict:
+    """Decodes the payload of a binary frame
+
+    :param payload: Frame without its length prefix
+    :type payload: bytes
+    :raises ValueError: Raised if the payload is invalid
+    :return: The message
+    :rtype: dict
+    """
+    view = memoryview(payload)
+    try:
+        msg, pos = decode_value(view, 0)
+    except (IndexError, struct.error, UnicodeDecodeError, TypeError,
+            RecursionError) as e:
+        raise ValueError(f"Invalid message {e}")
+    if pos != len(view) or not isinstance(msg, dict):
+        raise ValueError("Invalid message")
+    return msg
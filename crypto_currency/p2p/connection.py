@@ -1,38 +1,126 @@
-import socket
-import threading
+import asyncio
+import concurrent.futures
 import json
 import time
 
+from blockchain.encoding import encode
+from p2p import codec
+from p2p.inventory import KnownInventory
 
-class Connection(threading.Thread):
-    def __init__(self, parent_proc, sock_obj, host, port, client,
-                 log_func) -> None:
-        super(Connection, self).__init__()
+EOT_CHAR = 0x14.to_bytes(1, 'big')
+# Largest frame a peer may send, blocks with many transactions are big
+MAX_FRAME = 32 * 1024 * 1024
+# Wire formats this node understands, the handshake is always JSON and both
+# sides switch to binary afterwards if they both support it
+FORMATS = ["binary", "json"]
+
+
+class Connection():
+    def __init__(self, parent_proc, reader, writer, host, port, client,
+                 log_func, queue_size=256, timeout=15,
+                 max_pending=64) -> None:
+        """A connection to a peer running on the node's event loop. Frames are
+        read from the stream as they arrive and written by a separate task so
+        a slow peer only holds up its own queue
+
+        :param parent_proc: Node the connection belongs to
+        :type parent_proc: Node
+        :param reader: Stream to read frames from
+        :type reader: asyncio.StreamReader
+        :param writer: Stream to write frames to
+        :type writer: asyncio.StreamWriter
+        :param host: Host of the peer
+        :type host: str
+        :param port: Port of the peer
+        :type port: int
+        :param client: True if this node opened the connection
+        :type client: bool
+        :param log_func: Function used for logging
+        :type log_func: Callable
+        :param queue_size: Frames waiting to be sent before senders have to
+        wait, defaults to 256
+        :type queue_size: int, optional
+        :param timeout: Seconds to wait for the handshake or for room in the
+        send queue, defaults to 15
+        :type timeout: int, optional
+        :param max_pending: Messages from the peer waiting to be handled
+        before it stops being read from, defaults to 64
+        :type max_pending: int, optional
+        """
         self.parent_proc = parent_proc
-        self._stop_event = threading.Event()
+        self.reader = reader
+        self.writer = writer
         self.client = client  # True if connecting to another server
-        self.sock = sock_obj
         self.id = None
         self.host = host
         self.port = port
-        self.EOT_CHAR = 0x14.to_bytes(1, 'big')
-        self.sock.settimeout(15)
-        self.ping_pong()
+        self.act_host = (host, port)
         self.log = log_func
+        self.timeout = timeout
+        self.EOT_CHAR = EOT_CHAR
+        self.loop = asyncio.get_running_loop()
+        self.outbox = asyncio.Queue(maxsize=queue_size)
+        self.closed = False
+        self.write_task = None
+        self.binary = False
+        self.known = KnownInventory()  # Digests the peer already has
+        self.pending = asyncio.Semaphore(max_pending)
+        self.dropped = 0  # Messages dropped because the handlers were busy
 
     def __str__(self):
         return f"{self.host}:{self.port} {self.id[:8]}"
 
-    def send(self, data: dict):
+    def encode(self, data: dict) -> bytes:
+        if self.binary:
+            return codec.encode_message(data)
         try:
-            msg_str = json.dumps(data, sort_keys=True)
-        except Exception:
+            return encode(data) + self.EOT_CHAR
+        except ValueError:
             raise ValueError("Invalid dict unable to convert to string")
-        msg_bytes = msg_str.encode("UTF-8") + self.EOT_CHAR
+
+    def send(self, data: dict):
+        """Queues a message to be sent, it can be called from any thread. When
+        the queue is full threads other than the event loop wait for room, a
+        message still not queued after timeout seconds is dropped
+
+        :param data: Message to send
+        :type data: dict
+        """
+        frame = self.encode(data)
+        if self.closed:
+            return
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            try:
+                self.outbox.put_nowait(frame)
+            except asyncio.QueueFull:
+                self.log("connection.py", "ERROR",
+                         f"Send queue full, dropped message to {self.host}")
+            return
+        future = None
         try:
-            self.sock.sendall(msg_bytes)
-        except BrokenPipeError:
-            self.stop()
+            future = asyncio.run_coroutine_threadsafe(
+                self.put_frame(frame, time.monotonic() + self.timeout),
+                self.loop)
+            # A stalled or stopped loop never runs the put so the wait for
+            # it is bounded too
+            future.result(self.timeout)
+        except (asyncio.TimeoutError, concurrent.futures.TimeoutError,
+                RuntimeError):
+            if future is not None:
+                future.cancel()
+            self.log("connection.py", "ERROR",
+                     f"Send timed out, dropped message to {self.host}")
+
+    async def put_frame(self, frame: bytes, deadline: float) -> None:
+        # Waits for room in the send queue until the deadline, by then the
+        # sending thread has given up and counted the message as dropped
+        remaining = deadline - time.monotonic()
+        if remaining > 0:
+            await asyncio.wait_for(self.outbox.put(frame), remaining)
 
     def parse_message(self, msg: bytes) -> dict:
         json_str = msg.decode("UTF-8")
@@ -42,81 +130,142 @@ class Connection(threading.Thread):
             raise ValueError("Invalid message cannot convert to dict")
         return msg_dict
 
-    def handle_msg(self, msg):
-        self.parent_proc.callback(msg)
+    async def read_message(self) -> dict:
+        """Reads the next non empty frame from the peer
 
-    def stop(self):
-        self._stop_event.set()
+        :raises ConnectionError: Raised if the peer sends a frame larger than
+        MAX_FRAME
+        :return: Message received
+        :rtype: dict
+        """
+        if self.binary:
+            header = await self.reader.readexactly(codec.LENGTH.size)
+            length = codec.LENGTH.unpack(header)[0]
+            if length > MAX_FRAME:
+                raise ConnectionError("Frame too large")
+            return codec.decode_message(await self.reader.readexactly(length))
+        while True:
+            frame = await self.reader.readuntil(self.EOT_CHAR)
+            if len(frame) > 1:
+                return self.parse_message(frame[:-1])
+
+    async def handle_msg(self, msg):
+        # Handlers use SQLite and RSA so they run on the node's handler
+        # threads, this only waits if too many messages from the peer are
+        # already waiting
+        await self.parent_proc.dispatcher.submit(self, msg)
 
-    def run(self):
-        buffer = b""
-        while not self._stop_event.is_set():
-            transmission = b""
+    async def write_loop(self):
+        while True:
+            frame = await self.outbox.get()
+            if frame is None:
+                break
+            self.writer.write(frame)
+            await self.writer.drain()
+
+    def stop(self):
+        """Closes the connection, it can be called from any thread
+        """
+        if self.closed:
+            return
+        try:
+            on_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            asyncio.ensure_future(self.close())
+        else:
             try:
-                transmission = self.sock.recv(4096)
-            except socket.timeout:
+                asyncio.run_coroutine_threadsafe(self.close(), self.loop)
+            except RuntimeError:
                 pass
-            except Exception:
-                self.stop()
-            if transmission != b"":
-                buffer += transmission
-                eot_pos = buffer.find(self.EOT_CHAR)
-                while eot_pos > 0:
-                    msg_bytes = buffer[:eot_pos]
-                    buffer = buffer[eot_pos+1:]
-                    try:
-                        msg_dict = self.parse_message(msg_bytes)
-                        self.handle_msg(msg_dict)
-                    except ValueError:
-                        self.log("connection.py", "INFO", "Error handling or parsing message")
-                    eot_pos = buffer.find(self.EOT_CHAR)
-            time.sleep(0.05)
-        self.send({
-            "type": "disconnect",
-            "data": {},
-            "node_id": self.parent_proc.id
-        })
+
+    async def close(self, notify: bool = True):
+        """Tells the peer it is disconnecting, flushes queued frames and closes
+        the stream
+
+        :param notify: Whether to send a disconnect message, defaults to True
+        :type notify: bool, optional
+        """
+        if self.closed:
+            return
+        if notify and self.id is not None:
+            self.send({
+                "type": "disconnect",
+                "data": {},
+                "node_id": self.parent_proc.id
+            })
+        self.closed = True
+        if self.write_task is not None:
+            try:
+                self.outbox.put_nowait(None)
+                await asyncio.wait_for(self.write_task, self.timeout)
+            except (asyncio.QueueFull, asyncio.TimeoutError, OSError):
+                self.write_task.cancel()
+        self.writer.close()
         try:
-            self.sock.settimeout(None)
-            self.sock.shutdown(2)
-            self.sock.close()
-        except OSError as e:
-            if str(e) != "[Errno 57] Socket is not connected":
-                raise e
+            await self.writer.wait_closed()
+        except OSError:
+            pass
         self.parent_proc.disconnected_node(self)
-        self.log("connection.py", "INFO", f"Client disconnected {self.host}:{self.port}")
+        self.log("connection.py", "INFO",
+                 f"Client disconnected {self.host}:{self.port}")
+
+    async def start(self):
+        """Starts the writer and exchanges ids with the peer
+
+        :raises ValueError: Raised if the handshake is invalid
+        """
+        self.write_task = asyncio.ensure_future(self.write_loop())
+        await asyncio.wait_for(self.ping_pong(), self.timeout)
 
-    def ping_pong(self):
+    async def run(self):
+        """Reads and handles frames until the connection is closed
+        """
+        try:
+            while not self.closed:
+                try:
+                    msg = await self.read_message()
+                    await self.handle_msg(msg)
+                except ValueError:
+                    self.log("connection.py", "INFO",
+                             "Error handling or parsing message")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError):
+            pass
+        finally:
+            await self.close(notify=False)
+
+    async def ping_pong(self):
         if self.client:
             self.send({
                 "type": "init_ping",
                 "data": {
                     "id": self.parent_proc.id,
                     "clients": self.parent_proc.client_tuples,
-                    "act_host": (self.parent_proc.host, self.parent_proc.port)
+                    "act_host": (self.parent_proc.host, self.parent_proc.port),
+                    "formats": FORMATS
                     }
                 })
-        full_msg = False
-        buffer = b""
-        while not full_msg:
-            data = b""
-            data = self.sock.recv(4096)
-            if data != b"":
-                buffer += data
-                eot_pos = buffer.find(self.EOT_CHAR)
-                if eot_pos != -1:
-                    msg_bytes = buffer[:eot_pos]
-                    msg = self.parse_message(msg_bytes)
-                    break
-        self.parent_proc.connect_list += [(i[0], i[1]) for i in msg["data"]["clients"]]
-        self.id = msg["data"]["id"]
-        self.act_host = msg["data"]["act_host"]
+        try:
+            msg = await self.read_message()
+            self.parent_proc.connect_list += [(i[0], i[1]) for i in msg["data"]["clients"]]
+            self.id = msg["data"]["id"]
+            self.act_host = msg["data"]["act_host"]
+            # Peers that don't list formats only speak JSON
+            peer_binary = "binary" in msg["data"].get("formats", [])
+        except (KeyError, TypeError, IndexError, AttributeError):
+            raise ValueError("Invalid handshake")
         if msg["type"] == "init_ping":
             self.send({
                 "type": "resp_pong",
                 "data": {
                     "id": self.parent_proc.id,
                     "clients": self.parent_proc.client_tuples,
-                    "act_host": (self.parent_proc.host, self.parent_proc.port)
+                    "act_host": (self.parent_proc.host, self.parent_proc.port),
+                    "formats": FORMATS
                     }
                 })
+        # Frames are encoded when queued so everything sent from here on uses
+        # the agreed format, the peer has switched by the time it reads them
+        self.binary = peer_binary
@@ -0,0 +1,178 @@
+import heapq
+import itertools
+import threading
+
+# Lower numbers are handled first, anything not listed goes with inv
+PRIORITIES = {
+    "new_block": 0,
+    "blocks": 0,
+    "disconnect": 1,
+    "inv": 1,
+    "getdata": 1,
+    "add_transaction": 2,
+    "heart_beat": 3
+}
+
+
+def priority(msg: dict) -> int:
+    """Returns the priority of a message, lower is more urgent
+
+    :param msg: Message received
+    :type msg: dict
+    :return: Priority of the message
+    :rtype: int
+    """
+    if not isinstance(msg, dict):
+        return PRIORITIES["heart_beat"]
+    return PRIORITIES.get(msg.get("type"), PRIORITIES["inv"])
+
+
+class Dispatcher():
+    def __init__(self, callback, log_func, workers: int = 4,
+                 max_queue: int = 1024) -> None:
+        """Hands messages read by connections to a pool of handler threads
+        through a bounded priority queue, blocks before transactions before
+        heart beats. Messages from one peer are handled one at a time so a
+        peer's blocks are still added in the order it sent them. When the
+        queue is full the least urgent message is dropped
+
+        :param callback: Function that handles a message
+        :type callback: Callable
+        :param log_func: Function used for logging
+        :type log_func: Callable
+        :param workers: Number of handler threads, defaults to 4
+        :type workers: int, optional
+        :param max_queue: Most messages waiting to be handled, defaults to
+        1024
+        :type max_queue: int, optional
+        """
+        self.callback = callback
+        self.log = log_func
+        self.workers = workers
+        self.max_queue = max_queue
+        self.queue = []  # (priority, sequence, connection, message)
+        self.deferred = {}  # connection -> messages waiting for it to be free
+        self.active = set()  # Connections with a message being handled
+        self.size = 0
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+        self.threads = []
+        self.stopped = False
+        self.handled = 0
+        self.dropped = 0
+
+    def start(self) -> None:
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    async def submit(self, conn, msg: dict) -> None:
+        """Queues a message from a connection. It waits while the connection
+        already has its limit of messages queued so a peer that sends faster
+        than it can be handled is no longer read from
+
+        :param conn: Connection the message came from
+        :type conn: Connection
+        :param msg: Message received
+        :type msg: dict
+        """
+        await conn.pending.acquire()
+        item = (priority(msg), next(self.sequence), conn, msg)
+        with self.cond:
+            if self.stopped:
+                self.release(conn)
+                return
+            dropped = None
+            if self.size >= self.max_queue:
+                # Only queued messages can be dropped, the ones waiting for
+                # their connection to be free will be handled soon anyway
+                worst = max(self.queue) if self.queue else item
+                dropped = worst if worst[:2] > item[:2] else item
+                if dropped is worst:
+                    self.queue.remove(worst)
+                    heapq.heapify(self.queue)
+                    self.size -= 1
+            if dropped is not item:
+                heapq.heappush(self.queue, item)
+                self.size += 1
+                self.cond.notify()
+        if dropped is not None:
+            self.drop(dropped)
+
+    def drop(self, item) -> None:
+        conn, msg = item[2], item[3]
+        conn.dropped += 1
+        self.dropped += 1
+        self.release(conn)
+        msg_type = msg.get("type") if isinstance(msg, dict) else None
+        self.log("dispatcher.py", "ERROR",
+                 f"Handler queue full, dropped {msg_type} from {conn.host}")
+
+    def release(self, conn) -> None:
+        # Lets the connection's reader queue another message
+        try:
+            conn.loop.call_soon_threadsafe(conn.pending.release)
+        except RuntimeError:
+            pass  # Loop has already finished
+
+    def work(self) -> None:
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                item = heapq.heappop(self.queue)
+                conn = item[2]
+                if conn in self.active:
+                    heapq.heappush(self.deferred.setdefault(conn, []), item)
+                    continue
+                self.active.add(conn)
+            try:
+                self.callback(item[3])
+            except ValueError:
+                self.log("dispatcher.py", "INFO",
+                         "Error handling or parsing message")
+            except Exception as e:
+                self.log("dispatcher.py", "ERROR",
+                         f"Handler failed {type(e).__name__} {e}")
+            finally:
+                with self.cond:
+                    self.active.discard(conn)
+                    self.size -= 1
+                    self.handled += 1
+                    waiting = self.deferred.get(conn)
+                    if waiting:
+                        heapq.heappush(self.queue, heapq.heappop(waiting))
+                        self.cond.notify()
+                        if not waiting:
+                            del self.deferred[conn]
+                self.release(conn)
+
+    def stats(self) -> dict:
+        """Returns counters for the handler queue
+
+        :return: Messages queued, handled and dropped
+        :rtype: dict
+        """
+        with self.cond:
+            return {
+                "workers": self.workers,
+                "queued": self.size,
+                "handled": self.handled,
+                "dropped": self.dropped
+            }
+
+    def close(self, timeout: float = 5) -> None:
+        """Stops the handler threads, messages still queued are discarded
+
+        :param timeout: Seconds to wait for each running handler, defaults
+        to 5
+        :type timeout: float, optional
+        """
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join(timeout)
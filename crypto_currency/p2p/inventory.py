@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, List
+
+# Kinds of inventory that can be announced and requested
+KINDS = ["transactions", "blocks"]
+# Most digests of each kind accepted in one inv or getdata message
+MAX_ITEMS = 5000
+
+
+class KnownInventory():
+    def __init__(self, max_size: int = 50000) -> None:
+        """Digests of transactions and blocks a peer is known to have, either
+        because it announced or sent them or because they were announced to
+        it. The oldest digests are forgotten once it is full
+
+        :param max_size: Number of digests remembered, defaults to 50000
+        :type max_size: int, optional
+        """
+        self.max_size = max_size
+        self.digests = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, digest: str) -> bool:
+        with self.lock:
+            return digest in self.digests
+
+    def __len__(self) -> int:
+        return len(self.digests)
+
+    def add(self, digests: Iterable[str]) -> List[str]:
+        """Marks digests as known
+
+        :param digests: Digests to add
+        :type digests: Iterable[str]
+        :return: The digests that weren't already known
+        :rtype: List[str]
+        """
+        new = []
+        with self.lock:
+            for digest in digests:
+                if digest in self.digests:
+                    self.digests.move_to_end(digest)
+                    continue
+                self.digests[digest] = None
+                new.append(digest)
+            while len(self.digests) > self.max_size:
+                self.digests.popitem(last=False)
+        return new
+
+
+class PendingRequests():
+    def __init__(self, timeout: float = 30) -> None:
+        """Digests that have been requested from a peer and not yet received,
+        so an item announced by several peers is only fetched from one. A
+        request that isn't answered in time can be made again to another peer
+
+        :param timeout: Seconds before a request can be repeated, defaults
+        to 30
+        :type timeout: float, optional
+        """
+        self.timeout = timeout
+        self.requested = {}  # digest -> time requested
+        self.lock = threading.Lock()
+
+    def claim(self, digests: Iterable[str]) -> List[str]:
+        """Marks digests as requested
+
+        :param digests: Digests that are about to be requested
+        :type digests: Iterable[str]
+        :return: The digests that aren't already waiting on another request
+        :rtype: List[str]
+        """
+        now = time.monotonic()
+        claimed = []
+        with self.lock:
+            if len(self.requested) > MAX_ITEMS:
+                self.requested = {d: t for d, t in self.requested.items()
+                                  if now - t < self.timeout}
+            for digest in digests:
+                if (digest in self.requested
+                        and now - self.requested[digest] < self.timeout):
+                    continue
+                self.requested[digest] = now
+                claimed.append(digest)
+        return claimed
+
+    def received(self, digest: str) -> None:
+        """Marks a requested digest as received
+
+        :param digest: Digest of the item received
+        :type digest: str
+        """
+        with self.lock:
+            self.requested.pop(digest, None)
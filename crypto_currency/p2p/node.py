@@ -1,15 +1,18 @@
+import asyncio
 import hashlib
-import socket
 import threading
 import time
 from typing import Dict, List
 
-from p2p.connection import Connection
+from p2p.connection import MAX_FRAME, Connection
+from p2p.dispatcher import Dispatcher
+from p2p.inventory import PendingRequests
 
 
 class Node(threading.Thread):
     def __init__(self, host, port, callback, bootstrap,
-                 max_connections, log_func) -> None:
+                 max_connections, log_func, heartbeat_interval=10,
+                 handler_workers=4, max_queue=1024, max_pending=64) -> None:
         super(Node, self).__init__()
 
         self.terminate_flag = threading.Event()
@@ -17,6 +20,7 @@ class Node(threading.Thread):
         self.port = port
         self.callback = callback
         self.max_connections = max_connections
+        self.heartbeat_interval = heartbeat_interval
         self.log = log_func
 
         self.inbound = []
@@ -25,7 +29,13 @@ class Node(threading.Thread):
 
         self.id = hashlib.sha256((str(host)+str(port)+str(time.time())
                                   ).encode("UTF-8")).hexdigest()
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.loop = None
+        self.stopping = None
+        self.pending = PendingRequests()
+        self.max_pending = max_pending
+        self.listeners = []
+        self.dispatcher = Dispatcher(callback, log_func, handler_workers,
+                                     max_queue)
 
         self.message_recv = 0
         self.message_send = 0
@@ -43,13 +53,6 @@ class Node(threading.Thread):
             temp.append((i.act_host[0], i.act_host[1]))
         return temp
 
-    def init_sock(self):
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind((self.host, self.port))
-        self.sock.settimeout(5.0)
-        self.sock.listen(10)
-        self.log("node.py", "INFO", "Initialised socket")
-
     def send_all(self, msg: Dict, exclude: List = []):
         connections = self.total_nodes
         for conn in connections:
@@ -58,62 +61,167 @@ class Node(threading.Thread):
         self.log("node.py",  "INFO", f"Sent message to all {msg['type']}")
 
     def send(self, conn_id, msg):
-        try:
-            conn = self.total_nodes.index(conn_id)
-        except ValueError:
-            self.log("node.py", "ERROR",
-                     "Invalid node id or node disconnected")
-        conn.send(msg)
+        conn = self.peer(conn_id)
+        if conn is not None:
+            conn.send(msg)
+            return
+        self.log("node.py", "ERROR", "Invalid node id or node disconnected")
 
-    def create_conn(self, sock, host, port, client):
-        return Connection(self, sock, host, port, client, self.log)
+    def subscribe(self, callback) -> None:
+        """Registers a function called with every new connection once its
+        handshake is done, it runs on the event loop so it should return
+        quickly
 
-    def connect_node(self, host, port):
-        if host == self.host and port == self.port:
-            return 1  # Tried to connect to self
+        :param callback: Function taking a Connection
+        :type callback: Callable
+        """
+        self.listeners.append(callback)
+
+    def peer(self, conn_id):
+        for conn in self.total_nodes:
+            if conn.id == conn_id:
+                return conn
+        return None
+
+    def announce(self, kind: str, digests: List[str], exclude: List = []):
+        """Tells every peer about new transactions or blocks with an inv
+        message, skipping digests a peer is already known to have. Peers
+        fetch the ones they are missing with getdata
+
+        :param kind: "transactions" or "blocks"
+        :type kind: str
+        :param digests: Transaction digests or block hashes
+        :type digests: List[str]
+        :param exclude: Ids of nodes not to announce to, defaults to []
+        :type exclude: List, optional
+        """
+        for conn in self.total_nodes:
+            if conn.id in exclude:
+                continue
+            new = conn.known.add(digests)
+            if new:
+                conn.send({
+                    "type": "inv",
+                    "data": {kind: new},
+                    "node_id": self.id
+                })
+
+    def received(self, conn_id, kind: str, digest: str):
+        """Records that a peer sent a transaction or block
 
+        :param conn_id: Id of the node it came from
+        :type conn_id: str
+        :param kind: "transactions" or "blocks"
+        :type kind: str
+        :param digest: Transaction digest or block hash
+        :type digest: str
+        """
+        self.pending.received(digest)
+        conn = self.peer(conn_id)
+        if conn is not None:
+            conn.known.add([digest])
+
+    def request(self, conn_id, wanted: Dict[str, List[str]]):
+        """Asks a peer for transactions and blocks it announced, digests
+        already requested from another peer are left out
+
+        :param conn_id: Id of the node to ask
+        :type conn_id: str
+        :param wanted: Digests to fetch keyed by kind
+        :type wanted: Dict[str, List[str]]
+        """
+        data = {}
+        for kind, digests in wanted.items():
+            claimed = self.pending.claim(digests)
+            if claimed:
+                data[kind] = claimed
+        if data:
+            self.send(conn_id, {
+                "type": "getdata",
+                "data": data,
+                "node_id": self.id
+            })
+
+    def create_conn(self, reader, writer, host, port, client):
+        return Connection(self, reader, writer, host, port, client, self.log,
+                          max_pending=self.max_pending)
+
+    def connected_to(self, host, port):
+        if host == self.host and port == self.port:
+            return True  # Tried to connect to self
         for node in self.total_nodes:
-            if host == node.host and port == node.port:
-                return 1
+            if ((host == node.host and port == node.port)
+                    or (host, port) == tuple(node.act_host)):
+                return True
+        return False
+
+    @property
+    def full(self):
+        return (self.max_connections != 0
+                and len(self.total_nodes) >= self.max_connections)
+
+    async def add_conn(self, conn, connections):
+        """Completes the handshake of a new connection and then handles its
+        messages until it closes
+
+        :param conn: The new connection
+        :type conn: Connection
+        :param connections: List the connection belongs in, inbound or
+        outbound
+        :type connections: List
+        """
+        try:
+            await conn.start()
+        except (ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, ConnectionError):
+            await conn.close(notify=False)
+            return
+        if conn.id == self.id or conn.id in [i.id for i in self.total_nodes]:
+            await conn.close()
+            return
+        connections.append(conn)
+        self.log("node.py", "INFO",
+                 f"New client connected {conn.host}:{conn.port} {conn.id}")
+        for callback in self.listeners:
+            callback(conn)
+        await conn.run()
+
+    async def accept(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        if self.full:
+            writer.close()
+            return
+        conn = self.create_conn(reader, writer, addr[0], addr[1], False)
+        await self.add_conn(conn, self.inbound)
+
+    async def connect_node(self, host, port):
+        if self.connected_to(host, port):
+            return 1
+        if self.full:
+            self.log("node.py", "ERROR", "Too many clients")
+            return
         try:
-            if (self.max_connections == 0 or len(self.total_nodes) < self.max_connections):
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((host, port))
-
-                client_thread = self.create_conn(sock, host, port, True)
-                client_thread.start()
-                while client_thread.id is None:
-                    time.sleep(0.01)
-                connected = False
-                for connection in self.total_nodes:
-                    if connection.id == client_thread.id:
-                        connected = True
-                        break
-                if connected is False:
-                    self.outbound.append(client_thread)
-                    self.log("node.py", "INFO",
-                             f"New client connected {host}:{port} {client_thread.id}")
-                else:
-                    client_thread.stop()
-            else:
-                self.log("node.py", "ERROR", "Too many clients")
-        except Exception as e:
-            self.log("node.py", "ERROR", "Unable to connect"+e)
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, limit=MAX_FRAME), 5)
+        except (OSError, asyncio.TimeoutError) as e:
+            self.log("node.py", "ERROR", f"Unable to connect {e}")
             return 2
+        conn = self.create_conn(reader, writer, host, port, True)
+        asyncio.ensure_future(self.add_conn(conn, self.outbound))
 
-    def reconnect_nodes(self):
+    async def reconnect_nodes(self):
         self.connect_list = list(
                                  set([(i[0], i[1]) for i in self.connect_list])
                                  )
-        for node in self.connect_list:
-            connected = False
-            for client in self.outbound:
-                if client.port == node[1] and client.host == node[0]:
-                    connected = True
-                    break
-            if not connected:
-                if self.connect_node(node[0], node[1]) in [1, 3]:
-                    self.connect_list.remove(node)
+        for node in list(self.connect_list):
+            if await self.connect_node(node[0], node[1]) in [1, 3]:
+                self.connect_list.remove(node)
+
+    async def maintain(self):
+        while True:
+            await self.reconnect_nodes()
+            self.send_all({"type": "heart_beat"})
+            await asyncio.sleep(self.heartbeat_interval)
 
     def disconnected_node(self, conn):
         if conn in self.inbound:
@@ -121,54 +229,47 @@ class Node(threading.Thread):
         elif conn in self.outbound:
             self.outbound.remove(conn)
 
+    def stats(self) -> Dict:
+        """Returns the handler queue counters and messages dropped per peer
+
+        :return: Dispatcher counters with a dropped count for each peer
+        :rtype: Dict
+        """
+        stats = self.dispatcher.stats()
+        stats["peers"] = {conn.id: conn.dropped for conn in self.total_nodes}
+        return stats
+
     def stop(self):
         self.terminate_flag.set()
+        if self.loop is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.stopping.set)
+            except RuntimeError:
+                pass  # Loop has already finished
 
-    def run(self):
-        self.init_sock()
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        if self.terminate_flag.is_set():
+            return
+        server = await asyncio.start_server(self.accept, self.host, self.port,
+                                            limit=MAX_FRAME,
+                                            reuse_address=True)
+        self.log("node.py", "INFO", "Initialised socket")
         self.log("node.py", "INFO", "Node Starting")
-        counter = 0
-        while not self.terminate_flag.is_set():
-            try:
-                conn, addr = self.sock.accept()
-                if self.max_connections == 0 or len(self.total_nodes) < self.max_connections:
-                    conn_thread = self.create_conn(conn, addr[0],
-                                                   addr[1], False)
-                    conn_thread.start()
-                    while conn_thread.id is None:
-                        time.sleep(0.01)
-                    connected = False
-                    for connection in self.total_nodes:
-                        if connection.id == conn_thread.id:
-                            connected = True
-                            break
-                    if connected is False:
-                        self.inbound.append(conn_thread)
-                        self.log("node.py", "INFO",
-                                 f"New client connected {addr[0]}:{addr[1]} {conn_thread.id}")
-                    else:
-                        conn_thread.stop()
-                else:
-                    conn.close()
-            except socket.timeout:
-                pass
-            counter += 1
-            if counter == 2:
-                counter = 0
-                self.send_all({"type": "heart_beat"})
-            self.reconnect_nodes()
-            time.sleep(0.01)
+        maintenance = asyncio.ensure_future(self.maintain())
+        await self.stopping.wait()
 
         self.log("node.py", "INFO", "Shutting Down")
-        for thread in self.inbound:
-            thread.stop()
-        for thread in self.outbound:
-            thread.stop()
-
-        for thread in self.inbound:
-            thread.join()
-        for thread in self.outbound:
-            thread.join()
-
-        self.sock.shutdown(2)
-        self.sock.close()
+        maintenance.cancel()
+        server.close()
+        await asyncio.gather(*[conn.close() for conn in self.total_nodes],
+                             return_exceptions=True)
+        await server.wait_closed()
+
+    def run(self):
+        self.dispatcher.start()
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.dispatcher.close()
@@ -0,0 +1,395 @@
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Tuple
+
+from blockchain.blockchain import Blockchain
+from blockchain.encoding import encode
+from blockchain.validation import BlockValidator, build_block
+from p2p.node import Node
+
+# Most headers sent in one headers message
+HEADER_BATCH = 2000
+# Most blocks sent in one blocks message
+MAX_BLOCKS = 64
+# Blocks messages stop growing past this many bytes of JSON
+MAX_BLOCKS_BYTES = 8 * 1024 * 1024
+
+
+class ChainSync():
+    def __init__(self, blockchain: Blockchain, node: Node, log_func,
+                 validator: BlockValidator = None, range_size: int = 16,
+                 ranges_per_peer: int = 4, timeout: float = 30,
+                 interval: float = 30) -> None:
+        """Brings the chain up to date with peers that have more work. The
+        hashes of the missing blocks are downloaded first from the best peer,
+        starting where its chain and this one split, then the blocks
+        themselves in ranges spread over every peer that has them. Each range
+        is checked as it arrives on the handler thread it came in on and runs
+        of consecutive blocks are added in one database transaction
+
+        :param blockchain: Blockchain to sync
+        :type blockchain: Blockchain
+        :param node: Node used to talk to peers
+        :type node: Node
+        :param log_func: Function used for logging
+        :type log_func: Callable
+        :param validator: Validator used to check signatures, defaults to None
+        :type validator: BlockValidator, optional
+        :param range_size: Blocks requested at a time, defaults to 16
+        :type range_size: int, optional
+        :param ranges_per_peer: Ranges requested from a peer at once,
+        defaults to 4
+        :type ranges_per_peer: int, optional
+        :param timeout: Seconds before an unanswered request is made again,
+        defaults to 30
+        :type timeout: float, optional
+        :param interval: Seconds between asking peers for their tips when not
+        syncing, defaults to 30
+        :type interval: float, optional
+        """
+        self.blockchain = blockchain
+        self.node = node
+        self.log = log_func
+        self.validator = validator
+        self.range_size = range_size
+        self.ranges_per_peer = ranges_per_peer
+        self.timeout = timeout
+        self.interval = interval
+
+        self.peer_tips = {}  # node id -> (height, work)
+        self.target = None  # Node id headers are being fetched from
+        self.header_time = 0
+        self.base = None  # Height of the first header
+        self.headers = []  # Hashes of the blocks being downloaded
+        self.last_header = None  # Hash the next header has to follow on from
+        self.next_height = 0  # Height of the next block to add
+        self.headers_done = False
+        self.ranges = deque()  # (start, count) waiting to be requested
+        self.in_flight = {}  # start -> (node id, count, time requested)
+        self.downloaded = {}  # height -> Block checked and waiting to be added
+        self.lock = threading.RLock()
+        self.commit_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+
+        node.subscribe(self.new_peer)
+
+    @property
+    def syncing(self) -> bool:
+        return self.target is not None
+
+    def message(self, msg_type: str, data: Dict) -> Dict:
+        return {"type": msg_type, "data": data, "node_id": self.node.id}
+
+    def new_peer(self, conn) -> None:
+        conn.send(self.message("get_tip", {}))
+
+    def request_tip(self, conn_id) -> None:
+        """Asks a peer for its tip, used when it sends a block that doesn't
+        fit on the chain
+
+        :param conn_id: Id of the node to ask
+        :type conn_id: str
+        """
+        self.node.send(conn_id, self.message("get_tip", {}))
+
+    def tip(self, conn_id, data: Dict) -> None:
+        """Records the tip a peer reported and starts syncing from it if it
+        has more work than this node
+
+        :param conn_id: Id of the node it came from
+        :type conn_id: str
+        :param data: Height and cumulative work of the peer's tip
+        :type data: Dict
+        """
+        height, work = int(data["height"]), int(data["work"])
+        tip = self.blockchain.tip
+        with self.lock:
+            self.peer_tips[conn_id] = (height, work)
+            if self.syncing or height < 0:
+                return
+            if tip is None or work > tip.work:
+                self.start_sync(conn_id)
+
+    def start_sync(self, conn_id) -> None:
+        self.target = conn_id
+        self.base = None
+        self.headers = []
+        self.headers_done = False
+        self.ranges.clear()
+        self.in_flight = {}
+        self.downloaded = {}
+        self.log("sync.py", "INFO", f"Syncing with {conn_id[:8]}")
+        self.request_headers()
+
+    def request_headers(self) -> None:
+        self.header_time = time.monotonic()
+        if self.base is None:
+            # The peer starts after the newest block in the locator it has
+            data = {"start": 0, "locator": self.blockchain.get_locator()}
+        else:
+            data = {"start": self.base + len(self.headers)}
+        data["count"] = HEADER_BATCH
+        self.node.send(self.target, self.message("get_headers", data))
+
+    def reset(self, reason: str) -> None:
+        with self.lock:
+            if self.syncing:
+                self.log("sync.py", "ERROR", f"Sync stopped {reason}")
+            self.peer_tips.pop(self.target, None)
+            self.target = None
+            self.base = None
+            self.headers = []
+            self.ranges.clear()
+            self.in_flight = {}
+            self.downloaded = {}
+        self.wake.set()
+
+    def receive_headers(self, conn_id, data: Dict) -> None:
+        """Adds a batch of headers from the peer being synced from, checking
+        they follow on from the chain and from each other
+
+        :param conn_id: Id of the node it came from
+        :type conn_id: str
+        :param data: Height of the first header and the headers
+        :type data: Dict
+        """
+        with self.lock:
+            if conn_id != self.target or self.headers_done:
+                return
+            headers = data["headers"][:HEADER_BATCH]
+            full = len(headers) == HEADER_BATCH
+            if self.base is None:
+                start = int(data["start"])
+                parent = headers[0]["parent_block"] if headers else None
+                # The locator is sparse so the first few may already be here
+                while (headers and self.blockchain.has_block(
+                        headers[0]["hash"], side=False)):
+                    parent = headers.pop(0)["hash"]
+                    start += 1
+                known = parent is None or self.blockchain.has_block(parent)
+                if not known:
+                    self.reset("headers don't join the chain")
+                    return
+                self.base = self.next_height = start
+                self.log("sync.py", "INFO", f"Chains split at height {start}")
+            else:
+                start = self.base + len(self.headers)
+                if int(data["start"]) != start:
+                    return  # Answer to a request that timed out
+                parent = self.last_header
+            for idx, header in enumerate(headers):
+                if (header["parent_block"] != parent
+                        or int(header["height"]) != start + idx):
+                    # Peer is on another chain
+                    self.reset("headers don't follow on from the chain")
+                    return
+                parent = header["hash"]
+            self.last_header = parent
+            for idx in range(0, len(headers), self.range_size):
+                self.ranges.append(
+                    (start + idx, min(self.range_size, len(headers) - idx)))
+            self.headers += [header["hash"] for header in headers]
+            if full:
+                self.request_headers()
+            else:
+                self.headers_done = True
+                self.log("sync.py", "INFO",
+                         f"Downloading {len(self.headers)} blocks")
+            self.request_ranges()
+        self.commit()
+
+    def request_ranges(self) -> None:
+        """Requests waiting ranges from every peer whose tip covers them, up
+        to ranges_per_peer each. Ranges too far ahead of the chain wait so
+        downloaded blocks don't pile up behind a slow range
+        """
+        with self.lock:
+            next_height = self.next_height
+            window = (self.range_size * self.ranges_per_peer
+                      * max(1, len(self.peer_tips)) * 2)
+            busy = {}
+            for peer, _, _ in self.in_flight.values():
+                busy[peer] = busy.get(peer, 0) + 1
+            peers = [i.id for i in self.node.total_nodes
+                     if i.id in self.peer_tips]
+            while self.ranges and self.ranges[0][0] < next_height + window:
+                start, count = self.ranges[0]
+                # Peers can be dropped while this runs by a reply that
+                # failed
+                free = [i for i in peers
+                        if busy.get(i, 0) < self.ranges_per_peer
+                        and i in self.peer_tips
+                        and self.peer_tips[i][0] >= start + count - 1]
+                if not free:
+                    break
+                peer = min(free, key=lambda i: busy.get(i, 0))
+                busy[peer] = busy.get(peer, 0) + 1
+                self.ranges.popleft()
+                self.in_flight[start] = (peer, count, time.monotonic())
+                self.node.send(peer, self.message("get_blocks", {
+                    "start": start,
+                    "count": count
+                }))
+
+    def receive_blocks(self, conn_id, data: Dict) -> None:
+        """Checks a range of blocks against the headers and their signatures
+        then adds whatever can be added to the chain
+
+        :param conn_id: Id of the node it came from
+        :type conn_id: str
+        :param data: Height of the first block and the blocks
+        :type data: Dict
+        """
+        start = int(data["start"])
+        with self.lock:
+            request = self.in_flight.get(start)
+            if request is None or request[0] != conn_id:
+                return
+            count = request[1]
+            expected = self.headers[start-self.base:start-self.base+count]
+        blocks = []
+        try:
+            for idx, block_dict in enumerate(data["blocks"][:count]):
+                if block_dict.get("hash") != expected[idx]:
+                    raise ValueError("Block doesn't match header")
+                block = build_block(block_dict, self.validator)
+                if block.verify() is not True:
+                    raise ValueError("Invalid block hash")
+                blocks.append(block)
+            if not blocks:
+                # Asking the same peer again would get the same answer
+                raise ValueError("No blocks in range")
+        except ValueError as e:
+            self.log("sync.py", "ERROR",
+                     f"Invalid blocks from {conn_id[:8]} {e}")
+            with self.lock:
+                if self.in_flight.get(start, (None,))[0] == conn_id:
+                    del self.in_flight[start]
+                    self.ranges.appendleft((start, count))
+                    self.peer_tips.pop(conn_id, None)
+            self.request_ranges()
+            return
+        with self.lock:
+            if self.in_flight.get(start, (None,))[0] != conn_id:
+                return
+            del self.in_flight[start]
+            for idx, block in enumerate(blocks):
+                self.downloaded[start + idx] = block
+            if len(blocks) < count:
+                # The peer sent part of the range, the rest is asked for again
+                self.ranges.appendleft((start + len(blocks),
+                                        count - len(blocks)))
+        self.commit()
+        self.request_ranges()
+
+    def commit(self) -> None:
+        """Adds every downloaded block that follows on from the tip in one
+        database transaction
+        """
+        with self.commit_lock:
+            with self.lock:
+                if not self.syncing:
+                    return
+                run = []
+                while self.next_height + len(run) in self.downloaded:
+                    run.append(self.downloaded.pop(
+                        self.next_height + len(run)))
+            if run:
+                # A run that doesn't extend the tip is a side chain until it
+                # has more work than the main chain
+                try:
+                    self.blockchain.add_blocks(run)
+                except ValueError as e:
+                    self.reset(f"block rejected {e}")
+                    return
+                with self.lock:
+                    self.next_height += len(run)
+            with self.lock:
+                if (self.headers_done and not self.ranges
+                        and not self.in_flight and not self.downloaded):
+                    self.log("sync.py", "INFO",
+                             f"Synced to height {self.blockchain.height}")
+                    self.target = None
+                    # Check nobody got further while this was syncing
+                    self.wake.set()
+
+    def check(self) -> None:
+        """Asks every peer for its tip when idle and otherwise makes
+        requests again that have timed out or whose peer has disconnected
+        """
+        if not self.syncing:
+            self.node.send_all(self.message("get_tip", {}))
+            return
+        now = time.monotonic()
+        connected = set(i.id for i in self.node.total_nodes)
+        with self.lock:
+            for start, (peer, count, sent) in list(self.in_flight.items()):
+                if peer not in connected or now - sent > self.timeout:
+                    del self.in_flight[start]
+                    self.ranges.appendleft((start, count))
+                    if peer not in connected:
+                        self.peer_tips.pop(peer, None)
+            self.ranges = deque(sorted(self.ranges))
+            if not self.headers_done and (
+                    self.target not in connected
+                    or now - self.header_time > self.timeout):
+                self.reset("peer stopped sending headers")
+                return
+        self.request_ranges()
+
+    def start(self) -> None:
+        while not self.stopped.is_set():
+            self.check()
+            self.wake.clear()
+            self.wake.wait(self.timeout / 2 if self.syncing
+                           else self.interval)
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.wake.set()
+
+
+def serve_headers(blockchain: Blockchain, data: Dict) -> Tuple[int, List]:
+    """Returns the headers a peer asked for. If the peer sent a locator they
+    start after the newest block in it that is on the main chain
+
+    :param blockchain: Blockchain to read from
+    :type blockchain: Blockchain
+    :param data: Height of the first header or a locator and how many
+    :type data: Dict
+    :return: Height of the first header and the headers in height order
+    :rtype: Tuple[int, List]
+    """
+    start = int(data["start"])
+    if "locator" in data:
+        start = 0
+        for block_hash in data["locator"][:64]:
+            if blockchain.has_block(block_hash, side=False):
+                start = blockchain.block_tip(block_hash).height + 1
+                break
+    count = min(int(data["count"]), HEADER_BATCH)
+    return start, blockchain.get_headers(start, count)
+
+
+def serve_blocks(blockchain: Blockchain, data: Dict) -> List[Dict]:
+    """Returns the blocks a peer asked for, fewer if they wouldn't fit in
+    one message
+
+    :param blockchain: Blockchain to read from
+    :type blockchain: Blockchain
+    :param data: Height of the first block and how many
+    :type data: Dict
+    :return: Blocks in height order
+    :rtype: List[Dict]
+    """
+    count = min(int(data["count"]), MAX_BLOCKS)
+    blocks = []
+    size = 0
+    for block in blockchain.get_block_dicts(int(data["start"]), count):
+        size += len(encode(block))
+        if blocks and size > MAX_BLOCKS_BYTES:
+            break
+        blocks.append(block)
+    return blocks
@@ -0,0 +1,64 @@
+import hashlib
+import itertools
+import os
+import sys
+import time
+
+import pytest
+
+# Modules import each other from the crypto_currency directory, the same
+# way main.py is run
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Crypto.PublicKey import RSA  # noqa: E402
+
+from blockchain.block import Block  # noqa: E402
+from blockchain.blockchain import Blockchain  # noqa: E402
+from blockchain.encoding import encode  # noqa: E402
+from blockchain.transaction import Transaction  # noqa: E402
+
+KEYS = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))), "testing")
+
+
+class Wallet():
+    def __init__(self, path: str) -> None:
+        with open(path) as f:
+            key = RSA.import_key(f.read())
+        self.public = key.public_key().export_key("DER").hex()
+        self.private = key.export_key("DER").hex()
+
+    def pay(self, receiver: str, value: int, nonce: int) -> Transaction:
+        tran = Transaction(self.public, receiver, value, "", value * 0.05)
+        tran.sign(self.private, nonce)
+        return tran
+
+
+@pytest.fixture(scope="session")
+def wallets():
+    return [Wallet(os.path.join(KEYS, f"priv-key{i}.pem")) for i in (1, 2)]
+
+
+@pytest.fixture
+def chain(tmp_path):
+    blockchain = Blockchain(lambda *args: None, str(tmp_path / "chain.db"))
+    yield blockchain
+    blockchain.storage.close()
+
+
+@pytest.fixture
+def mine():
+    # Difficulty isn't checked when blocks are added, the nonce is only
+    # picked so no hash starts with a zero and every block has a work of 1
+    def mine(parent: str, transactions: list, coinbase: str,
+             **kwargs) -> Block:
+        block = Block(parent, time.time(), transactions, **kwargs)
+        block.hash, block.coinbase, block.mined = "", coinbase, True
+        for nonce in itertools.count():
+            block.nonce = nonce
+            block_hash = hashlib.sha256(encode(block.header())).hexdigest()
+            if not block_hash.startswith("0"):
+                break
+        assert block.christen(block_hash, nonce, coinbase)
+        return block
+    return mine
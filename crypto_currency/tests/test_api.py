@@ -0,0 +1,32 @@
+import pytest
+
+from web_api import routes
+from web_api.main import create_app
+
+
+@pytest.fixture
+def client(chain, mine, wallets):
+    parent = None
+    for _ in range(3):
+        block = mine(parent, [], wallets[0].public)
+        chain.add_block(block)
+        parent = block.hash
+    return create_app(chain, None, lambda *args: None).test_client()
+
+
+def test_recent_blocks_count_is_capped(client, monkeypatch):
+    monkeypatch.setattr(routes, "MAX_RECENT", 2)
+    res = client.get("/api/get_recent_blocks", query_string={"count": 10**9})
+    assert res.status_code == 200
+    assert res.json["height"] == 2
+    assert len(res.json["blocks"]) == 2
+    res = client.get("/api/get_recent_blocks", query_string={"count": 0})
+    assert res.status_code == 404
+
+
+def test_recent_headers_count_is_capped(client, monkeypatch):
+    monkeypatch.setattr(routes, "MAX_RECENT", 2)
+    res = client.get("/api/get_recent_headers",
+                     query_string={"count": 10**9})
+    assert res.status_code == 200
+    assert [i["height"] for i in res.json["headers"]] == [2, 1]
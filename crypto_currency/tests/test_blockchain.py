@@ -0,0 +1,155 @@
+import sqlite3
+
+import pytest
+
+from blockchain.blockchain import COINBASE_REWARD, Blockchain
+from blockchain.merkle import verify_proof
+
+
+def build(chain, mine, wallets, length: int = 3, **kwargs) -> list:
+    payer, payee = wallets
+    blocks = [mine(None, [], payer.public, **kwargs)]
+    chain.add_block(blocks[0])
+    for nonce in range(length - 1):
+        trans = [payer.pay(payee.public, 1, nonce * 2 + i) for i in range(2)]
+        blocks.append(mine(blocks[-1].hash, trans, payer.public, **kwargs))
+        chain.add_block(blocks[-1])
+    return blocks
+
+
+def balances(chain) -> list:
+    chain.cur.execute("""SELECT account, balance, nonce FROM balances
+                      ORDER BY account""")
+    return chain.cur.fetchall()
+
+
+def assert_balances_consistent(chain) -> None:
+    # The running balances match ones worked out again from every block
+    with chain.storage.writing():
+        before = balances(chain)
+        chain.rebuild_balances()
+        after = balances(chain)
+        chain.conn.rollback()
+    assert [i[0] for i in before] == [i[0] for i in after]
+    for old, new in zip(before, after):
+        assert old[1] == pytest.approx(new[1])
+        assert old[2] == new[2]
+
+
+def test_headers_count_transactions(chain, mine, wallets):
+    blocks = build(chain, mine, wallets)
+    assert chain.get_header(blocks[0].hash).tx_count == 0
+    assert chain.get_header(blocks[-1].hash).tx_count == 2
+    assert [i.tx_count for i in chain.get_recent_headers(3)] == [2, 2, 0]
+
+
+def test_tx_count_migration_backfills(chain, mine, wallets):
+    blocks = build(chain, mine, wallets)
+    with chain.storage.writing():
+        chain.cur.execute("ALTER TABLE blocks DROP COLUMN tx_count;")
+        chain.create_tx_counts()
+        chain.conn.commit()
+    assert chain.get_header(blocks[-1].hash).tx_count == 2
+    assert chain.get_header(blocks[0].hash).tx_count == 0
+
+
+def test_migrates_baseline_database(mine, wallets, tmp_path):
+    payer, payee = wallets
+    genesis = mine("", [], payer.public)
+    block = mine(genesis.hash, [payer.pay(payee.public, 4, 0)],
+                 payee.public)
+    path = str(tmp_path / "baseline.db")
+    # The tables as the first release made them, with no schema version
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE blocks (hash VARCHAR(64), nonce INT,
+                 coinbase VARCHAR(2000), parent_block VARCHAR(64),
+                 timestamp INT);""")
+    conn.execute("""CREATE TABLE transactions (sender VARCHAR(2000),
+                 receiver VARCHAR(2000), value INT, data VARCHAR(256),
+                 fee INT, signature VARCHAR(512), nonce INT,
+                 parent_block VARCHAR(64));""")
+    conn.execute("CREATE TABLE mempool (tran VARCHAR(10));")
+    for item in (genesis, block):
+        conn.execute("INSERT INTO blocks VALUES (?, ?, ?, ?, ?);",
+                     (item.hash, item.nonce, item.coinbase,
+                      item.parent_block, item.timestamp))
+        conn.executemany("INSERT INTO transactions VALUES "
+                         "(?, ?, ?, ?, ?, ?, ?, ?);",
+                         [tuple(tran) + (item.hash,)
+                          for tran in item.transactions])
+    conn.commit()
+    conn.close()
+
+    chain = Blockchain(lambda *args: None, path)
+    chain.cur.execute("PRAGMA user_version;")
+    assert chain.cur.fetchone()[0] == 7
+    assert chain.height == 1 and chain.prev_hash == block.hash
+    assert chain.tip.work == 2
+    assert chain.get_balance(payer.public) == pytest.approx(
+        COINBASE_REWARD - 4.2)
+    assert chain.get_balance(payee.public) == COINBASE_REWARD + 4
+    assert chain.get_tran_nonce(payer.public) == 1
+    assert chain.get_header(block.hash).tx_count == 1
+    assert chain.get_block(block.hash, verify=True).valid is True
+    assert_balances_consistent(chain)
+    chain.storage.close()
+
+
+def test_reorganises_onto_heavier_side_chain(chain, mine, wallets):
+    payer, payee = wallets
+    main = [mine(None, [], payer.public)]
+    chain.add_block(main[0])
+    for nonce in range(4):
+        main.append(mine(main[-1].hash, [payer.pay(payee.public, 1, nonce)],
+                         payer.public))
+        chain.add_block(main[-1])
+    assert chain.height == 4
+    # The side chain splits off after height 2, repeats the transaction at
+    # height 3 and leaves out the one at height 4
+    side = [mine(main[2].hash, main[3].transactions, payee.public)]
+    side.append(mine(side[-1].hash, [], payee.public))
+    chain.add_block(side[0])
+    chain.add_block(side[1])
+    assert chain.prev_hash == main[4].hash
+    assert len(chain.mempool) == 0
+    side.append(mine(side[-1].hash, [], payee.public))
+    chain.add_block(side[2])
+
+    assert chain.prev_hash == side[2].hash
+    assert chain.height == 5 and chain.tip.work == 6
+    assert chain.has_block(main[4].hash)
+    assert not chain.has_block(main[4].hash, side=False)
+    assert chain.get_block(main[4].hash).hash == main[4].hash
+    assert [tran.digest for tran in chain.mempool.transactions()] == [
+        main[4].transactions[0].digest]
+    assert chain.get_tran_nonce(payer.public) == 3
+    assert_balances_consistent(chain)
+
+
+def test_rejects_block_on_unknown_parent(chain, mine, wallets):
+    build(chain, mine, wallets, 2)
+    with pytest.raises(ValueError):
+        chain.add_block(mine("ab" * 32, [], wallets[0].public))
+    assert chain.height == 1
+
+
+def test_merkle_proofs_match_header(chain, mine, wallets):
+    blocks = build(chain, mine, wallets, version=2)
+    header = chain.get_header(blocks[-1].hash)
+    for tran in blocks[-1].transactions:
+        proof = chain.get_proof(blocks[-1].hash, tran.digest)
+        assert proof["merkle_root"] == header.merkle_root
+        assert verify_proof(tran.digest, proof["proof"], header.merkle_root)
+        assert not verify_proof(tran.digest, proof["proof"], "00" * 32)
+    with pytest.raises(ValueError):
+        chain.get_proof(blocks[-1].hash, "00" * 32)
+    assert chain.get_proof("00" * 32, "00" * 32) is None
+
+
+def test_mempool_refuses_mined_nonces(chain, mine, wallets):
+    payer, payee = wallets
+    blocks = build(chain, mine, wallets)
+    for tran in blocks[-1].transactions:
+        assert not chain.add_to_mempool(tran)
+    assert chain.add_to_mempool(payer.pay(payee.public, 1, 4))
+    assert len(chain.mempool) == 1
@@ -0,0 +1,52 @@
+import pytest
+
+from p2p import codec
+
+
+def frame(value) -> bytes:
+    out = bytearray()
+    codec.encode_value(value, out)
+    return bytes(out)
+
+
+@pytest.mark.parametrize("msg", [
+    {},
+    {"type": "heart_beat", "data": {}, "node_id": "ab" * 32},
+    {"type": "new_block", "data": {
+        "parent_block": None, "timestamp": 1.5, "nonce": 0,
+        "transactions": [{"sender": "0a1b", "value": -3, "fee": 0.25,
+                          "data": "not hex", "signature": "ABCD"}]}},
+    {"big": 2**80, "small": -2**63, "flags": [True, False, None],
+     "unicode": "café", "odd_hex": "abc", "empty": ""},
+])
+def test_round_trip(msg):
+    payload = codec.encode_message(msg)
+    assert codec.LENGTH.unpack_from(payload)[0] == len(payload) - 4
+    assert codec.decode_message(payload[4:]) == msg
+
+
+def test_unencodable_value():
+    with pytest.raises(ValueError):
+        codec.encode_message({"data": object()})
+
+
+@pytest.mark.parametrize("payload", [
+    b"",
+    b"m",
+    b"Z",
+    frame({"type": "inv"})[:-1],
+    frame({"type": "inv"}) + b"N",
+    frame(["not", "a", "map"]),
+    b"m" + codec.LENGTH.pack(1) + b"k\xff" + b"N",
+    b"m" + codec.LENGTH.pack(1) + frame(["list", "key"]) + b"N",
+    b"m" + codec.LENGTH.pack(1) + frame({"map": "key"}) + b"N",
+    b"m" + codec.LENGTH.pack(1) + b"i" + codec.INT.pack(1) + b"N",
+    b"m" + codec.LENGTH.pack(1) + b"k\x00" + b"s" + codec.LENGTH.pack(1)
+    + b"\xff",
+    b"m" + codec.LENGTH.pack(1) + b"k\x00" + b"I" + codec.LENGTH.pack(2)
+    + b"zz",
+    (b"l" + codec.LENGTH.pack(1)) * 100000,
+])
+def test_malformed_frames_raise_value_error(payload):
+    with pytest.raises(ValueError):
+        codec.decode_message(payload)
@@ -0,0 +1,57 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from p2p.connection import Connection
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+
+    async def cancel_tasks():
+        tasks = [task for task in asyncio.all_tasks()
+                 if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    asyncio.run_coroutine_threadsafe(cancel_tasks(), loop).result(2)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def connect(loop, logs: list, **kwargs) -> Connection:
+    async def build():
+        return Connection(None, None, None, "peer", 1, True,
+                          lambda *args: logs.append(args), **kwargs)
+    return asyncio.run_coroutine_threadsafe(build(), loop).result()
+
+
+def test_send_from_other_thread(loop):
+    logs = []
+    conn = connect(loop, logs, queue_size=1, timeout=0.2)
+    conn.send({"type": "heart_beat"})
+    assert conn.outbox.qsize() == 1
+    # The queue is full and nothing drains it
+    conn.send({"type": "heart_beat"})
+    assert conn.outbox.qsize() == 1
+    assert "dropped" in logs[-1][2]
+
+
+def test_send_to_stalled_loop_times_out(loop):
+    logs = []
+    conn = connect(loop, logs, timeout=0.2)
+    loop.call_soon_threadsafe(time.sleep, 1)
+    start = time.monotonic()
+    conn.send({"type": "heart_beat"})
+    assert time.monotonic() - start < 0.8
+    assert "dropped" in logs[-1][2]
+    # Once the loop recovers the abandoned send never reaches the queue
+    asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop).result(2)
+    assert conn.outbox.qsize() == 0
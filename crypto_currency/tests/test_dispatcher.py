@@ -0,0 +1,107 @@
+import asyncio
+import threading
+
+from p2p.dispatcher import Dispatcher, priority
+
+
+class Peer():
+    def __init__(self, host: str) -> None:
+        self.host = host
+        self.loop = asyncio.get_running_loop()
+        self.pending = asyncio.Semaphore(64)
+        self.dropped = 0
+
+
+def message(msg_type: str, seq: int = 0) -> dict:
+    return {"type": msg_type, "data": {"seq": seq}}
+
+
+def test_priority():
+    assert priority(message("new_block")) < priority(message("inv"))
+    assert priority(message("inv")) < priority(message("add_transaction"))
+    assert priority(message("unknown")) == priority(message("inv"))
+    assert priority("not a dict") == priority(message("heart_beat"))
+
+
+def test_handles_most_urgent_first():
+    handled = []
+    done = threading.Event()
+
+    def callback(msg):
+        handled.append((msg["type"], msg["data"]["seq"]))
+        if len(handled) == 5:
+            done.set()
+
+    async def run():
+        dispatcher = Dispatcher(callback, lambda *args: None, workers=1)
+        peers = [Peer(str(i)) for i in range(5)]
+        msgs = [message("heart_beat"), message("add_transaction", 1),
+                message("add_transaction", 2), message("inv"),
+                message("new_block")]
+        for peer, msg in zip(peers, msgs):
+            await dispatcher.submit(peer, msg)
+        dispatcher.start()
+        await asyncio.get_running_loop().run_in_executor(None, done.wait, 5)
+        dispatcher.close()
+        return dispatcher.stats()
+
+    stats = asyncio.run(run())
+    assert handled == [("new_block", 0), ("inv", 0), ("add_transaction", 1),
+                       ("add_transaction", 2), ("heart_beat", 0)]
+    assert stats["handled"] == 5 and stats["queued"] == 0
+
+
+def test_one_message_per_peer_at_a_time():
+    handled = []
+    running = set()
+    overlap = []
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def callback(msg):
+        with lock:
+            overlap.append(msg["type"] in running)
+            running.add(msg["type"])
+        threading.Event().wait(0.01)
+        with lock:
+            running.discard(msg["type"])
+            handled.append(msg["data"]["seq"])
+            if len(handled) == 6:
+                done.set()
+
+    async def run():
+        dispatcher = Dispatcher(callback, lambda *args: None, workers=3)
+        peer = Peer("a")
+        for seq in range(6):
+            await dispatcher.submit(peer, message("new_block", seq))
+        dispatcher.start()
+        await asyncio.get_running_loop().run_in_executor(None, done.wait, 5)
+        dispatcher.close()
+
+    asyncio.run(run())
+    # Blocks from one peer are added in the order it sent them
+    assert handled == list(range(6))
+    assert not any(overlap)
+
+
+def test_full_queue_drops_least_urgent():
+    logs = []
+
+    async def run():
+        dispatcher = Dispatcher(lambda msg: None,
+                                lambda *args: logs.append(args), workers=1,
+                                max_queue=2)
+        peer = Peer("a")
+        await dispatcher.submit(peer, message("add_transaction"))
+        await dispatcher.submit(peer, message("heart_beat"))
+        await dispatcher.submit(peer, message("new_block"))
+        await dispatcher.submit(peer, message("heart_beat", 1))
+        queued = sorted(item[3]["type"] for item in dispatcher.queue)
+        await asyncio.sleep(0)
+        return dispatcher, peer, queued
+
+    dispatcher, peer, queued = asyncio.run(run())
+    assert queued == ["add_transaction", "new_block"]
+    assert dispatcher.stats()["dropped"] == 2
+    assert peer.dropped == 2
+    assert all("dropped heart_beat" in log[2] for log in logs)
@@ -0,0 +1,30 @@
+import hashlib
+
+from blockchain.encoding import digest, digest_bytes, encode
+
+
+def test_encode_is_canonical():
+    assert encode({"b": 1, "a": [1, 2]}) == b'{"a": [1, 2], "b": 1}'
+    assert digest({"b": 1, "a": 2}) == digest({"a": 2, "b": 1})
+    assert digest("x") == hashlib.sha256(b'"x"').hexdigest()
+    assert digest_bytes(encode([1])) == digest([1])
+
+
+def test_transaction_digest_follows_fields(wallets):
+    payer, payee = wallets
+    tran = payer.pay(payee.public, 5, 0)
+    first = tran.digest
+    assert first == digest(tran.tran_dict())
+    tran.keep("digest")
+    assert tran.digest == first
+    tran.value = 6
+    assert tran.digest == digest(tran.tran_dict()) != first
+
+
+def test_block_hash_is_header_digest(mine, wallets):
+    payer, payee = wallets
+    for version in (1, 2):
+        block = mine(None, [payer.pay(payee.public, 1, 0)], payer.public,
+                     version=version)
+        assert block.hash == digest(block.header())
+        assert block.verify() is True
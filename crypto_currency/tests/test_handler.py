@@ -0,0 +1,70 @@
+import pytest
+
+from handler import Handler, SeenMessages
+
+
+def message(data) -> dict:
+    return {"type": "add_transaction", "data": data, "node_id": "ab" * 32}
+
+
+def quiet(*args) -> None:
+    pass
+
+
+class Counting(Handler):
+    calls = 0
+    result = True
+
+    def add_transaction(self):
+        Counting.calls += 1
+        return Counting.result
+
+
+def test_seen_messages_add_and_forget():
+    seen = SeenMessages(max_size=2)
+    assert seen.add("a")
+    assert not seen.add("a")
+    seen.forget("a")
+    seen.forget("missing")
+    assert seen.add("a")
+    seen.add("b")
+    seen.add("c")
+    assert len(seen) == 2
+    assert seen.add("a")
+
+
+def test_seen_messages_expire():
+    seen = SeenMessages(ttl=0)
+    assert seen.add("a")
+    assert seen.add("a")
+
+
+def test_failed_payload_is_forgotten():
+    seen = SeenMessages()
+    msg = message({"sender": "aa"})
+    # A transaction missing its fields fails and must not block a retry
+    for _ in range(2):
+        with pytest.raises(KeyError):
+            Handler(msg, None, None, quiet, seen=seen)
+        assert len(seen) == 0
+
+
+def test_invalid_payload_is_forgotten():
+    seen = SeenMessages()
+    msg = message({"sender": "aa", "receiver": "bb", "value": 1,
+                   "data": "", "fee": 0, "signature": "00", "nonce": 0})
+    with pytest.raises(ValueError):
+        Handler(msg, None, None, quiet, seen=seen)
+    assert len(seen) == 0
+
+
+def test_handled_payload_is_remembered():
+    seen = SeenMessages()
+    msg = message({"sender": "aa"})
+    Counting.calls, Counting.result = 0, False
+    Counting(msg, None, None, quiet, seen=seen)
+    Counting.result = True
+    Counting(msg, None, None, quiet, seen=seen)
+    Counting(msg, None, None, quiet, seen=seen)
+    assert Counting.calls == 2
+    assert len(seen) == 1
@@ -0,0 +1,80 @@
+from blockchain.mempool import Mempool
+from blockchain.transaction import Transaction
+
+
+def transaction(sender: str, nonce: int, fee: int) -> Transaction:
+    # The pool never checks signatures so any hex will do
+    return Transaction(sender, "ff" * 32, 1, "", fee,
+                       signature=f"{nonce:04x}{fee:08x}", nonce=nonce)
+
+
+def test_replacement_needs_higher_fee_rate():
+    pool = Mempool()
+    first = transaction("aa", 0, 100)
+    assert pool.add(first)
+    assert not pool.add(first)
+    assert not pool.add(transaction("aa", 0, 50))
+    better = transaction("aa", 0, 500)
+    assert pool.add(better)
+    assert len(pool) == 1
+    assert first.digest not in pool
+    assert pool.get(better.digest) is better
+    assert pool.next_nonce("aa") == 1
+
+
+def test_eviction_keeps_nonces_contiguous():
+    pool = Mempool(max_size=3)
+    # The cheapest transaction is the sender's first, it must not be evicted
+    # while the later ones wait on it
+    chain = [transaction("aa", 0, 10), transaction("aa", 1, 900),
+             transaction("aa", 2, 800)]
+    for tran in chain:
+        assert pool.add(tran)
+    assert pool.lowest() == chain[2].digest
+    assert pool.add(transaction("bb", 0, 850))
+    held = [tran for tran in pool.transactions() if tran.sender == "aa"]
+    assert sorted(tran.nonce for tran in held) == [0, 1]
+    assert chain[2].digest not in pool
+
+
+def test_eviction_rejects_lower_fee_rate():
+    pool = Mempool(max_size=2)
+    assert pool.add(transaction("aa", 0, 500))
+    assert pool.add(transaction("bb", 0, 500))
+    assert not pool.add(transaction("cc", 0, 100))
+    assert len(pool) == 2
+
+
+def test_eviction_never_strands_own_nonce():
+    pool = Mempool(max_size=2)
+    assert pool.add(transaction("aa", 0, 500))
+    assert pool.add(transaction("aa", 1, 100))
+    # Making room would evict nonce 1 which nonce 2 depends on
+    assert not pool.add(transaction("aa", 2, 900))
+    assert pool.next_nonce("aa") == 2
+
+
+def test_by_fee_keeps_sender_nonce_order():
+    pool = Mempool()
+    trans = [transaction("aa", 0, 10), transaction("aa", 1, 900),
+             transaction("bb", 0, 500), transaction("bb", 1, 20)]
+    for tran in trans:
+        pool.add(tran)
+    order = [(tran.sender, tran.nonce) for tran in pool.by_fee()]
+    assert order == [("bb", 0), ("bb", 1), ("aa", 0), ("aa", 1)]
+    assert len(pool.by_fee(2)) == 2
+    pool.remove(trans[:1])
+    assert pool.by_fee(1)[0].nonce == 1
+
+
+def test_remove_digests_and_clear():
+    pool = Mempool()
+    trans = [transaction("aa", nonce, 100) for nonce in range(3)]
+    for tran in trans:
+        pool.add(tran)
+    pool.remove_digests([trans[0].digest])
+    assert trans[0].digest not in pool
+    assert len(pool) == 2
+    pool.clear()
+    assert len(pool) == 0
+    assert pool.lowest() is None
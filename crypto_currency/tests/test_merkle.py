@@ -0,0 +1,44 @@
+import hashlib
+
+import pytest
+
+from blockchain.merkle import (EMPTY_ROOT, hash_pair, merkle_proof,
+                               merkle_root, verify_proof)
+
+
+def leaves(count: int) -> list:
+    return [hashlib.sha256(bytes([i])).hexdigest() for i in range(count)]
+
+
+def test_small_roots():
+    a, b, c = leaves(3)
+    assert merkle_root([]) == EMPTY_ROOT
+    assert merkle_root([a]) == a
+    assert merkle_root([a, b]) == hash_pair(a, b)
+    # The odd node moves up rather than being paired with itself
+    assert merkle_root([a, b, c]) == hash_pair(hash_pair(a, b), c)
+    assert merkle_root([a, b, c]) != merkle_root([a, b, c, c])
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 5, 8, 13])
+def test_every_proof_verifies(count):
+    digests = leaves(count)
+    root = merkle_root(digests)
+    for index, digest in enumerate(digests):
+        proof = merkle_proof(digests, index)
+        assert verify_proof(digest, proof, root)
+        other = digests[(index + 1) % count]
+        if other != digest:
+            assert not verify_proof(other, proof, root)
+
+
+def test_bad_proofs():
+    digests = leaves(4)
+    root = merkle_root(digests)
+    proof = merkle_proof(digests, 0)
+    assert not verify_proof(digests[0], [["x", digests[1]]] + proof[1:],
+                            root)
+    assert not verify_proof(digests[0], [["r", "zz"]], root)
+    assert not verify_proof(digests[0], [["r"]], root)
+    with pytest.raises(IndexError):
+        merkle_proof(digests, 4)
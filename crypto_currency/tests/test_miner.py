@@ -0,0 +1,71 @@
+import hashlib
+import json
+
+import pytest
+
+from blockchain.miner import Miner, MiningPool
+
+
+@pytest.fixture
+def pool():
+    pool = MiningPool(2, check_every=100)
+    pool.start()
+    yield pool
+    pool.close()
+
+
+def template(parent: str, version: int = 1) -> dict:
+    block = {"parent_block": parent, "timestamp": 1, "transactions": []}
+    if version > 1:
+        block.update({"version": version, "merkle_root": "ab" * 32})
+    return block
+
+
+@pytest.mark.parametrize("version", [1, 2])
+def test_split_block_matches_full_encoding(version):
+    miner = Miner(template("a", version), "0", "cd")
+    block = dict(miner.block, nonce=42)
+    if version > 1:
+        block.pop("transactions")
+    assert (miner.prefix + b"42" + miner.suffix
+            == json.dumps(block, sort_keys=True).encode("UTF-8"))
+
+
+def test_mines_valid_hash(pool):
+    miner = Miner(template("a"), "00", "cd")
+    assert miner.mine_block(pool=pool)
+    attempt = miner.prefix + str(miner.nonce).encode() + miner.suffix
+    assert hashlib.sha256(attempt).hexdigest() == miner.hash
+    assert miner.hash.startswith("00")
+    assert pool.attempts > 0
+
+
+def test_counts_every_attempt():
+    pool = MiningPool(1, check_every=7)
+    pool.start()
+    try:
+        for parent in "abc":
+            miner = Miner(template(parent), "00", "cd")
+            assert miner.mine_block(pool=pool)
+            # One worker tries every nonce in order up to the one found
+            assert miner.attempts == miner.nonce + 1
+    finally:
+        pool.close()
+
+
+def test_cancelled_pool_stays_stopped(pool):
+    pool.cancel()
+    job_id = pool.submit(b"{", b"}", "0" * 64)
+    assert pool.stop_event.is_set()
+    assert pool.wait(job_id, 1) is None
+    pool.resume()
+    pool.submit(b"{", b"}", "0" * 64)
+    assert not pool.stop_event.is_set()
+    miner = Miner(template("b"), "0", "cd")
+    assert miner.mine_block(pool=pool)
+
+
+def test_timeout_gives_up(pool):
+    miner = Miner(template("c"), "0" * 64, "cd")
+    assert not miner.mine_block(pool=pool, timeout=0.3)
+    assert pool.stop_event.is_set()
@@ -0,0 +1,54 @@
+import threading
+import time
+
+import pytest
+
+from miner import minerAgent
+
+
+@pytest.fixture
+def agent(chain, mine, wallets):
+    chain.add_block(mine(None, [], wallets[0].public))
+    chain.calculate_diff = lambda: "0"
+    agent = minerAgent(chain, lambda *args: None, wallets[1].public, None,
+                       workers=1, batch_delay=0.01, max_latency=0.05)
+    yield agent
+    agent.stop()
+
+
+def run(agent, seconds: float) -> None:
+    thread = threading.Thread(target=agent.start, daemon=True)
+    thread.start()
+    time.sleep(seconds)
+    agent.stopped.set()
+    agent.wake.set()
+    thread.join(5)
+
+
+def test_mines_mempool_transactions(agent, chain, wallets):
+    agent.share_block = lambda block: None
+    payer, payee = wallets
+    chain.add_to_mempool(payer.pay(payee.public, 1, 0))
+    run(agent, 1)
+    assert chain.height == 1
+    assert len(chain.mempool) == 0
+    assert chain.get_balance(payee.public) == 11
+
+
+def test_rejected_block_is_not_mined_again(agent, chain, wallets):
+    attempts = []
+    mine_block = agent.mine_block
+
+    def counting(block):
+        attempts.append(block)
+        return mine_block(block)
+
+    def reject(block):
+        raise ValueError("Rejected")
+
+    agent.mine_block = counting
+    chain.add_block = reject
+    payer, payee = wallets
+    chain.add_to_mempool(payer.pay(payee.public, 1, 0))
+    run(agent, 1)
+    assert len(attempts) == 1
@@ -0,0 +1,120 @@
+import pytest
+
+from blockchain.blockchain import Blockchain
+from handler import Handler
+from sync import ChainSync
+
+
+class Loopback():
+    """Stands in for a Node, messages are handed straight to the peer's
+    handler on the calling thread
+    """
+    def __init__(self, node_id: str, chain: Blockchain) -> None:
+        self.id = node_id
+        self.chain = chain
+        self.peers = {}
+        self.sent = []
+        self.sync = ChainSync(chain, self, lambda *args: None,
+                              range_size=2, ranges_per_peer=2)
+
+    def subscribe(self, callback) -> None:
+        pass
+
+    @property
+    def total_nodes(self) -> list:
+        return list(self.peers.values())
+
+    def send(self, conn_id, msg) -> None:
+        self.sent.append(msg["type"])
+        peer = self.peers[conn_id]
+        Handler(msg, peer.chain, peer, lambda *args: None, sync=peer.sync)
+
+    def send_all(self, msg) -> None:
+        for conn_id in list(self.peers):
+            self.send(conn_id, msg)
+
+
+@pytest.fixture
+def nodes(tmp_path):
+    chains = [Blockchain(lambda *args: None, str(tmp_path / f"{i}.db"))
+              for i in range(2)]
+    a, b = Loopback("a" * 64, chains[0]), Loopback("b" * 64, chains[1])
+    a.peers[b.id], b.peers[a.id] = b, a
+    yield a, b
+    for chain in chains:
+        chain.storage.close()
+
+
+def extend(chain, mine, coinbase: str, count: int, parent=None) -> list:
+    blocks = []
+    for _ in range(count):
+        block = mine(parent, [], coinbase)
+        chain.add_block(block)
+        blocks.append(block)
+        parent = block.hash
+    return blocks
+
+
+def test_syncs_headers_first(nodes, mine, wallets):
+    a, b = nodes
+    blocks = extend(a.chain, mine, wallets[0].public, 7)
+    for block in blocks[:2]:
+        b.chain.add_block(block)
+    b.send(a.id, b.sync.message("get_tip", {}))
+    assert b.chain.prev_hash == a.chain.prev_hash
+    assert b.chain.height == 6
+    assert not b.sync.syncing
+    # Only the missing blocks were fetched, after their headers
+    assert b.sent.index("get_headers") < b.sent.index("get_blocks")
+    assert b.sent.count("get_blocks") == 3
+
+
+def test_syncs_onto_heavier_fork(nodes, mine, wallets):
+    a, b = nodes
+    shared = extend(a.chain, mine, wallets[0].public, 2)
+    for block in shared:
+        b.chain.add_block(block)
+    extend(a.chain, mine, wallets[0].public, 4, shared[-1].hash)
+    extend(b.chain, mine, wallets[1].public, 2, shared[-1].hash)
+    b.send(a.id, b.sync.message("get_tip", {}))
+    assert b.chain.prev_hash == a.chain.prev_hash
+    assert b.chain.height == 5
+
+
+def test_ignores_lighter_peer(nodes, mine, wallets):
+    a, b = nodes
+    extend(a.chain, mine, wallets[0].public, 2)
+    extend(b.chain, mine, wallets[1].public, 3)
+    tip = b.chain.prev_hash
+    b.send(a.id, b.sync.message("get_tip", {}))
+    assert b.chain.prev_hash == tip
+    assert "get_headers" not in b.sent
+
+
+def test_syncs_onto_fork_partly_held_as_side_blocks(nodes, mine, wallets):
+    a, b = nodes
+    shared = extend(a.chain, mine, wallets[0].public, 2)
+    for block in shared:
+        b.chain.add_block(block)
+    fork = extend(a.chain, mine, wallets[0].public, 4, shared[-1].hash)
+    extend(b.chain, mine, wallets[1].public, 3, shared[-1].hash)
+    # The start of the heavier branch is already here as a side chain
+    for block in fork[:2]:
+        b.chain.add_block(block)
+    assert b.chain.has_block(fork[1].hash)
+    assert not b.chain.has_block(fork[1].hash, side=False)
+    b.send(a.id, b.sync.message("get_tip", {}))
+    assert b.chain.prev_hash == fork[-1].hash
+    assert not b.sync.syncing
+
+
+def test_empty_blocks_reply_drops_peer(nodes, mine, wallets):
+    a, b = nodes
+    extend(a.chain, mine, wallets[0].public, 3)
+    # The peer answers headers but has nothing to send for the blocks
+    a.chain.get_block_dicts = lambda start, count: []
+    b.send(a.id, b.sync.message("get_tip", {}))
+    assert b.chain.height == -1
+    assert a.id not in b.sync.peer_tips
+    assert b.sync.ranges
+    assert b.sent.count("get_blocks") == 1
@@ -0,0 +1,46 @@
+import pytest
+
+from blockchain.block import Block, BlockHeader
+from blockchain.transaction import Transaction, raw_signature
+
+
+def test_signature_round_trip(wallets):
+    payer, payee = wallets
+    tran = payer.pay(payee.public, 2, 0)
+    assert isinstance(tran.raw_signature, bytes)
+    assert len(tran.raw_signature) * 2 == len(tran.signature)
+    copy = Transaction.from_dict(tran.tran_dict())
+    assert copy.signature == tran.signature
+    assert copy.digest == tran.digest
+    assert copy.verify_signature() is True
+
+
+@pytest.mark.parametrize("signature", ["ABCD", "abc", "zz", 5])
+def test_signature_must_be_lowercase_hex(signature):
+    with pytest.raises(ValueError):
+        raw_signature(signature)
+    with pytest.raises(ValueError):
+        Transaction("aa", "bb", 1, "", 0.05, signature, 0)
+
+
+def test_unsigned_transaction():
+    tran = Transaction("aa", "bb", 1, "", 0.05)
+    assert not tran.signed
+    assert tran.signature is None and tran.nonce is None
+
+
+def test_addresses_are_shared():
+    first = Transaction("".join(["ab"] * 4), "cd", 1, "", 0.05, "00", 0)
+    second = Transaction("".join(["ab"] * 4), "cd", 1, "", 0.05, "01", 1)
+    assert first.sender is second.sender
+
+
+@pytest.mark.parametrize("obj", [
+    Transaction("aa", "bb", 1, "", 0.05, "00", 0),
+    Block(None, 1, []),
+    BlockHeader("ab", None, 1, 0, "cd", 0, 0, 1, None),
+])
+def test_no_instance_dict(obj):
+    assert not hasattr(obj, "__dict__")
+    with pytest.raises(AttributeError):
+        obj.unknown = 1
@@ -0,0 +1,30 @@
+import pytest
+
+from blockchain.validation import BlockValidator, build_block
+
+
+@pytest.fixture(scope="module")
+def validator():
+    validator = BlockValidator(2, min_parallel=2)
+    yield validator
+    validator.close()
+
+
+def test_parallel_signature_checks(validator, wallets):
+    payer, payee = wallets
+    trans = [payer.pay(payee.public, 1, nonce) for nonce in range(4)]
+    assert validator.verify_signatures(trans)
+    forged = payer.pay(payee.public, 1, 9)
+    forged.value = 1000
+    assert not validator.verify_signatures(
+        [payer.pay(payee.public, 2, n) for n in range(3)] + [forged])
+
+
+def test_build_block_checks_merkle_root(validator, mine, wallets):
+    payer, payee = wallets
+    block = mine(None, [payer.pay(payee.public, 3, 0)], payer.public,
+                 version=2)
+    assert build_block(dict(block), validator).hash == block.hash
+    tampered = dict(block, merkle_root="00" * 32)
+    with pytest.raises(ValueError):
+        build_block(tampered, validator)
@@ -1,14 +1,15 @@
-from blockchain.blockchain import Blockchain
 from blockchain.transaction import Transaction
 from Crypto.PublicKey import RSA
 from flask import Blueprint, g, jsonify, request
 
 bp = Blueprint("routes", __name__)
+# Most blocks or headers returned by one request
+MAX_RECENT = 100
 
 
 @bp.route("/get_bal", methods=["GET"])
 def get_bal():
-    blockchain = Blockchain(g.log, db=g.blockchain)
+    blockchain = g.blockchain
     account = request.args.get("address", None)
     if account is None:
         return {"msg": "Invalid address", "error": True}, 404
@@ -23,7 +24,7 @@ def get_bal():
 
 @bp.route("/get_block", methods=["GET"])
 def get_block():
-    blockchain = Blockchain(g.log, db=g.blockchain)
+    blockchain = g.blockchain
     block_hash = request.args.get("hash", None)
     if block_hash is None:
         return {"msg": "Invalid hash", "error": True}, 404
@@ -31,20 +32,84 @@ def get_block():
         block = blockchain.get_block(block_hash)
     except Exception as e:
         return {"msg": str(e), "error": True}, 500
+    if block is None:
+        return {"msg": "Block not found", "error": True}, 404
     return dict(block), 200
 
 
+@bp.route("/get_header", methods=["GET"])
+def get_header():
+    blockchain = g.blockchain
+    block_hash = request.args.get("hash", None)
+    if block_hash is None:
+        return {"msg": "Invalid hash", "error": True}, 404
+    header = blockchain.get_header(block_hash)
+    if header is None:
+        return {"msg": "Block not found", "error": True}, 404
+    return dict(header), 200
+
+
+@bp.route("/get_proof", methods=["GET"])
+def get_proof():
+    blockchain = g.blockchain
+    block_hash = request.args.get("hash", None)
+    digest = request.args.get("transaction", None)
+    if None in [block_hash, digest]:
+        return {"msg": "Missing attribute", "error": True}, 404
+    try:
+        proof = blockchain.get_proof(block_hash, digest)
+    except ValueError as e:
+        return {"msg": str(e), "error": True}, 400
+    if proof is None:
+        return {"msg": "Block not found", "error": True}, 404
+    return proof, 200
+
+
 @bp.route("/get_recent_block", methods=["GET"])
 def get_recent_block():
-    blockchain = Blockchain(g.log, db=g.blockchain)
+    blockchain = g.blockchain
     block_hash = blockchain.prev_hash
     block = blockchain.get_block(block_hash)
     return dict(block)
 
 
+@bp.route("/get_block_at", methods=["GET"])
+def get_block_at():
+    blockchain = g.blockchain
+    height = request.args.get("height", None, type=int)
+    if height is None:
+        return {"msg": "Invalid height", "error": True}, 404
+    block = blockchain.get_block_at(height)
+    if block is None:
+        return {"msg": "No block at height", "error": True}, 404
+    return dict(block), 200
+
+
+@bp.route("/get_recent_blocks", methods=["GET"])
+def get_recent_blocks():
+    blockchain = g.blockchain
+    count = request.args.get("count", 10, type=int)
+    if count < 1:
+        return {"msg": "Invalid count", "error": True}, 404
+    blocks = blockchain.get_recent_blocks(min(count, MAX_RECENT))
+    return jsonify(height=blockchain.height,
+                   blocks=[dict(block) for block in blocks]), 200
+
+
+@bp.route("/get_recent_headers", methods=["GET"])
+def get_recent_headers():
+    blockchain = g.blockchain
+    count = request.args.get("count", 10, type=int)
+    if count < 1:
+        return {"msg": "Invalid count", "error": True}, 404
+    headers = blockchain.get_recent_headers(min(count, MAX_RECENT))
+    return jsonify(height=blockchain.height,
+                   headers=[dict(header) for header in headers]), 200
+
+
 @bp.route("/get_history", methods=["GET"])
 def get_history():
-    blockchain = Blockchain(g.log, db=g.blockchain)
+    blockchain = g.blockchain
     account = request.args.get("address", None)
     if account is None:
         return {"msg": "Invalid address", "error": True}, 404
@@ -64,13 +129,13 @@ def add_transaction():
     if None in [private_key, amount, receiver]:
         return {"msg": "Missing attribute", "error": True}, 404
 
-    blockchain = Blockchain(g.log, db=g.blockchain)
+    blockchain = g.blockchain
 
     priv_key_obj = RSA.import_key(bytes.fromhex(private_key))
     public_key = priv_key_obj.public_key().export_key("DER").hex()
 
     transaction = Transaction(public_key, receiver, amount, data, amount*0.005)
-    nonce = blockchain.get_tran_nonce(public_key)
+    nonce = blockchain.get_pending_nonce(public_key)
     transaction.sign(private_key, nonce)
     transaction.verify_signature()
     if transaction.valid:
@@ -81,13 +146,8 @@ def add_transaction():
         for idx, i in enumerate(transaction):
             signed_tran[keys[idx]] = i
 
-        blockchain.add_to_mempool(signed_tran)
-        msg = {
-            "type": "add_transaction",
-            "data": signed_tran,
-            "node_id": g.node.id
-        }
-        g.node.send_all(msg)
+        if blockchain.add_to_mempool(transaction):
+            g.node.announce("transactions", [transaction.digest])
         return signed_tran, 200
     else:
         return {"msg": "Unable to verify signature", "error": True}, 500